@@ -3,12 +3,94 @@ Use Brian's python client to query the SRS datacatalog.
 """
 
 import os
+import copy
+import time
+import json
+import pickle
+import hashlib
+import tempfile
+import threading
 import subprocess
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
 import datacat
 import datacat.error
+from json_io import write_json
 
 remote_hosts = {'SLAC' : 'rhel6-64.slac.stanford.edu'}
 
+# Compact records of the datacat Dataset attributes used by
+# DatasetList, for the find_datasets query cache.
+DatasetRecord = namedtuple('DatasetRecord', 'name path locations metadata')
+LocationRecord = namedtuple('LocationRecord', 'site resource size checksum')
+LocationRecord.__new__.__defaults__ = (None, None)
+
+def _dataset_record(dataset, metadata_fields=None):
+    try:
+        metadata = dict(dataset.metadata or {})
+    except (AttributeError, TypeError, ValueError):
+        metadata = {}
+    if metadata_fields is not None:
+        metadata = dict((key, metadata[key]) for key in metadata_fields
+                        if key in metadata)
+    return DatasetRecord(str(dataset.name), str(dataset.path),
+                         [LocationRecord(str(x.site), str(x.resource),
+                                         getattr(x, 'size', None),
+                                         getattr(x, 'checksum', None))
+                          for x in dataset.locations], metadata)
+
+def _from_json(entry):
+    name, path, locations, metadata = entry
+    return DatasetRecord(name, path,
+                         [LocationRecord(*x) for x in locations], metadata)
+
+class QueryCache(object):
+    """
+    On-disk cache of find_datasets results, with one JSON file of
+    DatasetRecords per (config url, folder, search patterns, query).
+    """
+    def __init__(self, cache_dir, ttl=600):
+        """
+        Parameters
+        ----------
+        cache_dir : str
+            Directory containing the cache files.
+        ttl : float, optional
+            Lifetime in seconds of the cached results.  Default: 600.
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def _cache_file(self, key):
+        digest = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest + '.json')
+
+    def get(self, key):
+        "Return the cached DatasetRecords for key, or None."
+        cache_file = self._cache_file(key)
+        try:
+            if time.time() - os.path.getmtime(cache_file) > self.ttl:
+                return None
+            with open(cache_file) as fd:
+                entries = json.load(fd)
+        except (IOError, OSError, ValueError):
+            return None
+        return [_from_json(x) for x in entries]
+
+    def put(self, key, datasets):
+        "Cache the datasets for key, and return them as DatasetRecords."
+        records = [_dataset_record(x) for x in datasets]
+        try:
+            _makedirs(self.cache_dir)
+            write_json(self._cache_file(key), records, default=str)
+        except (IOError, OSError) as eobj:
+            print("Unable to write datacat query cache: %s" % eobj)
+        return records
+
 def _get_job_id(dataset):
     folder = os.path.split(dataset.path)[0]
     return str(os.path.split(folder)[1])
@@ -18,19 +100,320 @@ def _get_job_name(dataset):
     folder = os.path.split(dataset.path)[0]
     return str(folder.split(os.path.sep)[-3])
 
-def _get_filter(**kwds):
-    components = ['(True)']
-    for key, value in kwds.items():
-        if value is not None:
-            components.append('(_get_%s(x) == "%s")' % (key, value))
-    condition = ' and '.join(components)
-    return lambda x : eval(condition)
+class Range(object):
+    """
+    Predicate for DatasetList selections that accepts values in the
+    closed interval [low, high].  Either bound may be None.  Values
+    are compared as floats if the bounds are numbers.
+    """
+    def __init__(self, low=None, high=None):
+        self.low = low
+        self.high = high
+        bounds = [x for x in (low, high) if x is not None]
+        self._numeric = bool(bounds) and all(isinstance(x, (int, float))
+                                             for x in bounds)
+    def __call__(self, value):
+        if value is None:
+            return False
+        if self._numeric:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                return False
+        if self.low is not None and value < self.low:
+            return False
+        if self.high is not None and value > self.high:
+            return False
+        return True
+
+# Columns that are derived from the dataset path.  All other selection
+# keywords refer to dataset metadata fields.
+_path_columns = {'job_id': _get_job_id, 'job_name': _get_job_name}
+
+class _Columns(object):
+    """
+    Per-dataset name, path, job_id, job_name, and site->resource
+    columns, computed once, with lazily built metadata columns and
+    value indexes for selections.
+    """
+    def __init__(self, datasets):
+        self.size = len(datasets)
+        self.datasets = datasets
+        self.columns = dict((key, [func(x) for x in datasets])
+                            for key, func in _path_columns.items())
+        self.columns['name'] = [str(x.name) for x in datasets]
+        self.columns['path'] = [str(x.path) for x in datasets]
+        self.resources = []
+        for dataset in datasets:
+            resources = {}
+            for location in dataset.locations:
+                resources.setdefault(location.site, str(location.resource))
+            self.resources.append(resources)
+        self._indexes = {}
+
+    def take(self, rows):
+        "Return the columns of the given rows."
+        columns = _Columns.__new__(_Columns)
+        columns.size = len(rows)
+        columns.datasets = [self.datasets[i] for i in rows]
+        columns.columns = dict((key, [values[i] for i in rows])
+                               for key, values in self.columns.items())
+        columns.resources = [self.resources[i] for i in rows]
+        columns._indexes = {}
+        return columns
+
+    def column(self, key):
+        if key not in self.columns:
+            values = []
+            for dataset in self.datasets:
+                metadata = getattr(dataset, 'metadata', None) or {}
+                try:
+                    values.append(metadata.get(key))
+                except AttributeError:
+                    values.append(None)
+            self.columns[key] = values
+        return self.columns[key]
+
+    def index(self, key):
+        "Dictionary of row numbers keyed by column value as a string."
+        if key not in self._indexes:
+            index = {}
+            for i, value in enumerate(self.column(key)):
+                index.setdefault(str(value), []).append(i)
+            self._indexes[key] = index
+        return self._indexes[key]
+
+    def select(self, **constraints):
+        """
+        Return the sorted row numbers satisfying all of the constraints:
+        callables, e.g., Range objects, are applied to the column
+        values, sets, lists, and tuples select any of their members,
+        and other values select equal values.  None-valued constraints
+        are ignored.
+        """
+        rows = None
+        for key, value in constraints.items():
+            if value is None:
+                continue
+            if callable(value):
+                column = self.column(key)
+                candidates = range(self.size) if rows is None else rows
+                selected = set(i for i in candidates if value(column[i]))
+            else:
+                # Values are compared as strings, as the catalog
+                # returns them, using the column index.
+                if not isinstance(value, (set, frozenset, list, tuple)):
+                    value = (value,)
+                index = self.index(key)
+                selected = set()
+                for item in value:
+                    selected.update(index.get(str(item), ()))
+            rows = selected if rows is None else rows & selected
+            if not rows:
+                return []
+        if rows is None:
+            return list(range(self.size))
+        return sorted(rows)
+
+def _resource(location_map, dataset, site):
+    """
+    The resource of a dataset at site or, as full_paths has always
+    done, at its last location if it has none at site.
+    """
+    try:
+        return location_map[site]
+    except KeyError:
+        return str(dataset.locations[-1].resource)
+
+def _relative_key(path, folder):
+    """
+    The '/'-separated path of a catalog or mirror file relative to
+    folder, or None if it is not under folder.
+    """
+    if folder is None:
+        return None
+    folder = folder.rstrip('/')
+    if not path.startswith(folder + '/'):
+        return None
+    return path[len(folder) + 1:]
+
+class MirrorIndex(object):
+    """
+    Persistent index of the files under local mirror roots, e.g., the
+    NFS mirrors of the SRS data.  A mirror root is a copy of a catalog
+    folder, so a dataset is matched with the mirror file that has the
+    same path relative to the root as the dataset has relative to the
+    folder.  A root can be bound to a specific catalog folder, e.g.,
+    to keep the Prod and Dev mirrors apart; otherwise it is used for
+    any folder.
+
+    The index is built when it is first used.  Rescans are
+    incremental: the file listing of a directory is reused if the
+    directory's modification time has not changed, so an update costs
+    one stat per directory.  Symbolic links to directories are not
+    followed.
+    """
+    def __init__(self, roots, index_file=None):
+        """
+        Parameters
+        ----------
+        roots : sequence
+            The mirror root directories, or (catalog folder, directory)
+            tuples for roots that only mirror that folder.
+        index_file : str, optional
+            JSON file to store the index in.  Default: None (not saved).
+        """
+        self.roots = []
+        for root in roots:
+            folder = None
+            if isinstance(root, (tuple, list)):
+                folder, root = root
+            self.roots.append((folder, os.path.abspath(root)))
+        self.index_file = index_file
+        self.dirs = None
+        self._files = None
+        self._lock = threading.Lock()
+
+    @property
+    def files(self):
+        "Dictionaries of (path, size) of the files, keyed by root."
+        with self._lock:
+            if self._files is None:
+                self._update()
+            return self._files
+
+    def _load(self):
+        self.dirs = {}
+        if self.index_file is not None and os.path.isfile(self.index_file):
+            try:
+                with open(self.index_file) as fd:
+                    self.dirs = json.load(fd)
+            except ValueError:
+                # Ignore a corrupted index file.
+                pass
+
+    def _scan(self, path, key, dirs, files):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return
+        entry = self.dirs.get(path)
+        if entry is None or entry['mtime'] != mtime:
+            subdirs, file_sizes = [], {}
+            try:
+                names = os.listdir(path)
+            except OSError:
+                return
+            for name in names:
+                full_path = os.path.join(path, name)
+                if os.path.islink(full_path) and os.path.isdir(full_path):
+                    continue
+                if os.path.isdir(full_path):
+                    subdirs.append(name)
+                else:
+                    try:
+                        file_sizes[name] = os.path.getsize(full_path)
+                    except OSError:
+                        pass
+            entry = dict(mtime=mtime, subdirs=subdirs, files=file_sizes)
+        dirs[path] = entry
+        for name, size in entry['files'].items():
+            files[key + name] = (os.path.join(path, name), size)
+        for name in entry['subdirs']:
+            self._scan(os.path.join(path, name), key + name + '/',
+                       dirs, files)
+
+    def _update(self):
+        if self.dirs is None:
+            self._load()
+        dirs = {}
+        self._files = OrderedDict()
+        for root in self.roots:
+            self._files[root] = {}
+            self._scan(root[1], '', dirs, self._files[root])
+        self.dirs = dirs
+        if self.index_file is not None:
+            try:
+                write_json(self.index_file, dirs)
+            except (IOError, OSError) as eobj:
+                print("Unable to write mirror index: %s" % eobj)
+
+    def update(self):
+        "Rescan the mirror roots, and save the index."
+        with self._lock:
+            self._update()
+
+    def local_path(self, dataset_path, folder, size):
+        """
+        Return the local copy of the dataset with the given catalog
+        path in folder, or None if there is none or its size is not
+        the size of the catalog location.  Copies of datasets with
+        unknown size are not used.
+        """
+        if size is None:
+            return None
+        for (root_folder, _), files in self.files.items():
+            key = _relative_key(dataset_path, root_folder or folder)
+            if key is None or key not in files:
+                continue
+            local_path, local_size = files[key]
+            if int(size) == local_size:
+                return local_path
+        return None
+
+def _site_size(dataset, site):
+    for location in dataset.locations:
+        if location.site == site:
+            return getattr(location, 'size', None)
+    return None
+
+_mirror_indexes = {}
+_mirror_indexes_lock = threading.Lock()
+
+def _default_mirror_index():
+    """
+    The MirrorIndex of the roots in DATACAT_MIRROR_ROOTS, an
+    os.pathsep-separated list of directories or of
+    <catalog folder>=<directory> entries, or None if it is not set.
+    The index is stored in DATACAT_MIRROR_INDEX or
+    ~/.datacat_mirror_index.json, and is shared by all of the
+    DataCatalog objects in the process.
+    """
+    roots = []
+    for item in os.environ.get('DATACAT_MIRROR_ROOTS', '').split(os.pathsep):
+        if '=' in item:
+            roots.append(tuple(item.split('=', 1)))
+        elif item:
+            roots.append(item)
+    if not roots:
+        return None
+    index_file = os.environ.get('DATACAT_MIRROR_INDEX',
+                                os.path.join(os.path.expanduser('~'),
+                                             '.datacat_mirror_index.json'))
+    key = (tuple(roots), index_file)
+    with _mirror_indexes_lock:
+        if key not in _mirror_indexes:
+            _mirror_indexes[key] = MirrorIndex(roots, index_file=index_file)
+        return _mirror_indexes[key]
 
 class DatasetList(list):
+    """
+    List of datacat datasets, stored as compact DatasetRecords with
+    a columnar index of their names, paths, job ids, job names, site
+    resources, and metadata fields.  Datasets can be selected with
+    job_id, job_name, or metadata field constraints, given as values,
+    sets of values, Range objects, or other predicates, or with
+    boolean masks.  DatasetLists can be pickled, e.g., with save and
+    load, for reuse in other jobs.
+    """
     def __init__(self, input_list, datacat_obj, sort_by_name=True,
-                 job_id=None, job_name=None):
-        accept = _get_filter(job_id=job_id, job_name=job_name)
-        my_list = [x for x in input_list if accept(x)]
+                 job_id=None, job_name=None, metadata_fields=None):
+        my_list = [x if isinstance(x, DatasetRecord)
+                   else _dataset_record(x, metadata_fields)
+                   for x in input_list]
+        if job_id is not None or job_name is not None:
+            rows = _Columns(my_list).select(job_id=job_id, job_name=job_name)
+            my_list = [my_list[i] for i in rows]
         if sort_by_name:
             super(DatasetList, self).__init__(sorted(my_list,
                                                      key=lambda x : x.name))
@@ -39,59 +422,349 @@ class DatasetList(list):
         self.folder = datacat_obj.folder
         self.login = datacat_obj.remote_login
         self.site = datacat_obj.site
+        self.mirror = getattr(datacat_obj, 'mirror_index', None)
+        self._columns = None
+    def _get_columns(self):
+        if self._columns is None:
+            self._columns = _Columns(list(self))
+        return self._columns
+    def _invalidate(self):
+        "Drop the columnar index after the list has been modified."
+        self._columns = None
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        # The mirror index is specific to the host, and the value
+        # indexes are cheap to rebuild.
+        state['mirror'] = None
+        if state['_columns'] is not None:
+            state['_columns'] = copy.copy(state['_columns'])
+            state['_columns']._indexes = {}
+        return state
+    def column(self, key):
+        """
+        The list of values of a column: 'name', 'path', 'job_id',
+        'job_name', or a metadata field.
+        """
+        return self._get_columns().column(key)
+    def resources(self, site=None):
+        "The list of the dataset resources at site, or None if absent."
+        if site is None:
+            site = self.site
+        return [x.get(site) for x in self._get_columns().resources]
+    def mask(self, **constraints):
+        "Boolean mask of the datasets satisfying the constraints."
+        my_mask = [False]*len(self)
+        for i in self._get_columns().select(**constraints):
+            my_mask[i] = True
+        return my_mask
+    def subset(self, mask):
+        "Return a DatasetList of the datasets selected by a boolean mask."
+        rows = [i for i, selected in enumerate(mask) if selected]
+        columns = self._get_columns()
+        my_subset = DatasetList.__new__(DatasetList)
+        list.__init__(my_subset, [self[i] for i in rows])
+        my_subset.__dict__.update(self.__dict__)
+        my_subset._columns = columns.take(rows)
+        return my_subset
+    def select(self, **constraints):
+        "Return the list of datasets satisfying the constraints."
+        return [self[i] for i in self._get_columns().select(**constraints)]
     def job_ids(self):
-        my_job_ids = []
-        for item in self:
-            my_job_ids.append(_get_job_id(item))
-        return my_job_ids
-    def filenames(self, job_id=None, job_name=None):
-        accept = _get_filter(job_id=job_id, job_name=job_name)
-        return [str(x.name) for x in self if accept(x)]
-    def full_paths(self, job_id=None, job_name=None):
-        accept = _get_filter(job_id=job_id, job_name=job_name)
-        my_full_paths = []
-        for dataset in self:
-            if not accept(dataset):
-                continue
-            for location in dataset.locations:
-                if location.site == self.site:
-                    break
-            my_full_paths.append(str(location.resource))
-        return my_full_paths
+        return list(self._get_columns().column('job_id'))
+    def filenames(self, job_id=None, job_name=None, **constraints):
+        columns = self._get_columns()
+        rows = columns.select(job_id=job_id, job_name=job_name, **constraints)
+        names = columns.column('name')
+        return [names[i] for i in rows]
+    def save(self, filename):
+        "Pickle the DatasetList to filename."
+        with open(filename, 'wb') as output:
+            pickle.dump(self, output, protocol=2)
+    @staticmethod
+    def load(filename):
+        "Return the DatasetList pickled in filename."
+        with open(filename, 'rb') as fd:
+            return pickle.load(fd)
+    def _local_path(self, dataset, site):
+        if self.mirror is None:
+            return None
+        return self.mirror.local_path(dataset.path, self.folder,
+                                      _site_size(dataset, site))
+    def iter_full_paths(self, job_id=None, job_name=None, prefer_local=True,
+                        **constraints):
+        """
+        Generator of the full paths at self.site of the selected
+        datasets, or of their local mirror copies, if there are any
+        and prefer_local is True.
+        """
+        columns = self._get_columns()
+        for i in columns.select(job_id=job_id, job_name=job_name,
+                                **constraints):
+            local_path = None
+            if prefer_local:
+                local_path = self._local_path(self[i], self.site)
+            if local_path is not None:
+                yield local_path
+            else:
+                yield _resource(columns.resources[i], self[i], self.site)
+    def full_paths(self, job_id=None, job_name=None, prefer_local=True,
+                   **constraints):
+        return list(self.iter_full_paths(job_id=job_id, job_name=job_name,
+                                         prefer_local=prefer_local,
+                                         **constraints))
     def download(self, site='SLAC', rootpath='.', nfiles=None, dryrun=True,
-                 job_id=None, job_name=None, clobber=False):
+                 job_id=None, job_name=None, clobber=False, streams=4,
+                 batch_size=100, verify=True, checksum_field=None,
+                 checksum_algorithm=None):
+        """
+        Download the selected datasets from site with rsync, using
+        up to streams concurrent transfers that share one ssh
+        connection, and at most batch_size files per transfer.
+        Interrupted transfers are resumed.  If verify is True, each
+        downloaded file is checked against the size and checksum of
+        its catalog location, or against the checksum_field metadata
+        value, if they are available.  The checksum algorithm is
+        inferred from the length of the hex digest, unless
+        checksum_algorithm is given; checksums of unknown format are
+        not checked.  Files that fail verification are renamed with a
+        '.failed' suffix.  Existing files are skipped unless clobber
+        is True.
+
+        Datasets with a copy in the local mirror index are symlinked
+        instead of downloaded.
+
+        Returns an OrderedDict with the number of files and bytes
+        transferred, the elapsed time, and the list of failed files.
+        """
         user_host = '@'.join((self.login, remote_hosts[site]))
         if nfiles is not None:
             print("Downloading the first %i files:\n" % nfiles)
         if dryrun:
             print("Dry run. The following commands would be executed:\n")
-        my_datasets = []
-        accept = _get_filter(job_id=job_id, job_name=job_name)
-        for dataset in self[:nfiles]:
-            if not accept(dataset):
-                continue
-            for location in dataset.locations:
-                if location.site == site:
-                    my_datasets.append(dataset)
-        for dataset in my_datasets:
+        columns = self._get_columns()
+        nmax = len(self) if nfiles is None else nfiles
+        rows = [i for i in columns.select(job_id=job_id, job_name=job_name)
+                if i < nmax and site in columns.resources[i]]
+        transfers = []
+        for i in rows:
+            dataset = self[i]
             output = os.path.join(rootpath,
                                   dataset.path[len(self.folder)+1:])
-            outdir = os.path.split(output)[0]
-            if not os.path.isdir(outdir):
-                os.makedirs(outdir)
-            for location in dataset.locations:
-                if location.site == site:
-                    command = "scp %s:%s %s" \
-                              % (user_host, location.resource, output)
-                    print(command)
-                    if not dryrun:
-                        if os.path.isfile(output) and clobber:
-                            os.remove(output)
-                        if not os.path.isfile(output):
-                            subprocess.call(command, shell=True)
-                        else:
-                            print("%s already exists." % output)
-                    break  # Just need one location at this site.
+            if not dryrun:
+                if os.path.isfile(output) and clobber:
+                    os.remove(output)
+                if os.path.isfile(output):
+                    print("%s already exists." % output)
+                    continue
+            local_path = self._local_path(dataset, site)
+            if local_path is not None:
+                print("Using mirror copy %s" % local_path)
+                if not dryrun:
+                    _makedirs(os.path.dirname(output))
+                    if os.path.lexists(output):
+                        os.remove(output)
+                    os.symlink(local_path, output)
+                continue
+            transfers.append(FileTransfer(dataset, site,
+                                          columns.resources[i][site],
+                                          output, checksum_field))
+        engine = BulkTransfer(user_host, streams=streams,
+                              batch_size=batch_size, verify=verify,
+                              checksum_algorithm=checksum_algorithm)
+        return engine.run(transfers, dryrun=dryrun)
+
+def _invalidating(name):
+    "Wrap the list method name so that it drops the DatasetList columns."
+    method = getattr(list, name)
+    def wrapper(self, *args, **kwds):
+        self._invalidate()
+        return method(self, *args, **kwds)
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+# In-place changes to the list make the columnar index stale.
+for _name in ('__setitem__', '__delitem__', '__setslice__', '__delslice__',
+              '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop',
+              'remove', 'reverse', 'sort'):
+    if hasattr(list, _name):
+        setattr(DatasetList, _name, _invalidating(_name))
+del _name
+
+class FileTransfer(object):
+    "A dataset file to be downloaded from a remote resource."
+    def __init__(self, dataset, site, resource, output, checksum_field=None):
+        self.resource = resource
+        self.output = output
+        self.size = None
+        self.checksum = None
+        for location in dataset.locations:
+            if location.site == site:
+                self.size = getattr(location, 'size', None)
+                self.checksum = getattr(location, 'checksum', None)
+                break
+        if checksum_field is not None:
+            metadata = getattr(dataset, 'metadata', None) or {}
+            self.checksum = metadata.get(checksum_field, self.checksum)
+
+def _makedirs(path):
+    "Create a directory, allowing for concurrent creation by other threads."
+    if not path or os.path.isdir(path):
+        return
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+# hashlib algorithms of the hex digests, keyed by their length.
+_CHECKSUM_ALGORITHMS = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+def _checksum_algorithm(checksum):
+    """
+    The hashlib algorithm of a hex digest, inferred from its length,
+    or None if it is not a recognized hex digest.
+    """
+    try:
+        int(checksum, 16)
+    except (TypeError, ValueError):
+        return None
+    return _CHECKSUM_ALGORITHMS.get(len(checksum))
+
+def _file_checksum(path, algorithm, blocksize=2**20):
+    hasher = hashlib.new(algorithm)
+    with open(path, 'rb') as fd:
+        for block in iter(lambda: fd.read(blocksize), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+class BulkTransfer(object):
+    """
+    rsync-based engine for downloading many files from one host.
+    Files with the same remote and local directories and basenames
+    are batched into a single rsync invocation with a --files-from
+    list, the invocations run concurrently over a shared ssh control
+    connection, and partially transferred files are kept in a
+    .rsync-partial directory so that a rerun resumes them.
+    """
+    def __init__(self, user_host, streams=4, batch_size=100, verify=True,
+                 checksum_algorithm=None):
+        self.user_host = user_host
+        self.streams = max(1, streams)
+        self.batch_size = max(1, batch_size)
+        self.verify = verify
+        self.checksum_algorithm = checksum_algorithm
+        control_path = os.path.join(tempfile.gettempdir(),
+                                    'datacat-ssh-%r@%h:%p')
+        self.ssh_command = ('ssh -o ControlMaster=auto -o ControlPath=%s '
+                            '-o ControlPersist=60' % control_path)
+
+    def batches(self, transfers):
+        "Group the transfers by remote and local directory."
+        groups = OrderedDict()
+        for transfer in transfers:
+            remote_dir, basename = os.path.split(transfer.resource)
+            local_dir, local_name = os.path.split(transfer.output)
+            if basename == local_name:
+                key = (remote_dir, local_dir)
+            else:
+                key = (transfer.resource, transfer.output)
+            groups.setdefault(key, []).append(transfer)
+        batches = []
+        for key, group in groups.items():
+            for i in range(0, len(group), self.batch_size):
+                batches.append((key, group[i:i + self.batch_size]))
+        return batches
+
+    def command(self, key, batch, files_from=None):
+        "The rsync command for a batch."
+        command = ['rsync', '-t', '--partial-dir=.rsync-partial',
+                   '-e', self.ssh_command]
+        remote, local = key
+        if files_from is None and len(batch) == 1 \
+           and remote == batch[0].resource:
+            return command + ['%s:%s' % (self.user_host, remote), local]
+        if files_from is None:
+            files_from = '<list of %i files>' % len(batch)
+        return command + ['--files-from=%s' % files_from,
+                          '%s:%s/' % (self.user_host, remote), local + '/']
+
+    def check(self, transfer):
+        "Return an error message if the downloaded file is not valid."
+        if not os.path.isfile(transfer.output):
+            return 'missing'
+        if not self.verify:
+            return None
+        if transfer.size is not None \
+           and os.path.getsize(transfer.output) != int(transfer.size):
+            return 'size mismatch'
+        if transfer.checksum is None:
+            return None
+        expected = str(transfer.checksum).strip().lower()
+        algorithm = self.checksum_algorithm
+        if algorithm is None:
+            algorithm = _checksum_algorithm(expected)
+            if algorithm is None:
+                # Unknown checksum format, so only the size is checked.
+                return None
+        if _file_checksum(transfer.output, algorithm) != expected:
+            return 'checksum mismatch'
+        return None
+
+    def _run_batch(self, args):
+        key, batch = args
+        remote, local = key
+        if len(batch) == 1 and remote == batch[0].resource:
+            _makedirs(os.path.dirname(local))
+            subprocess.call(self.command(key, batch))
+        else:
+            _makedirs(local)
+            fd, files_from = tempfile.mkstemp(suffix='.txt')
+            try:
+                with os.fdopen(fd, 'w') as output:
+                    for transfer in batch:
+                        output.write(os.path.basename(transfer.resource)
+                                     + '\n')
+                subprocess.call(self.command(key, batch, files_from))
+            finally:
+                os.remove(files_from)
+        return [(transfer, self.check(transfer)) for transfer in batch]
+
+    def run(self, transfers, dryrun=False):
+        "Run the transfers, print progress, and return a summary."
+        batches = self.batches(transfers)
+        summary = OrderedDict([('nfiles', 0), ('nbytes', 0),
+                               ('elapsed', 0), ('failed', [])])
+        if dryrun:
+            for key, batch in batches:
+                print(' '.join(quote(x) for x in self.command(key, batch)))
+            return summary
+        t0 = time.time()
+        pool = ThreadPool(min(self.streams, max(1, len(batches))))
+        try:
+            for results in pool.imap_unordered(self._run_batch, batches):
+                for transfer, error in results:
+                    if error is not None:
+                        print("%s: %s" % (transfer.output, error))
+                        if error != 'missing':
+                            # Keep the file for inspection, but out of
+                            # the way of the next download attempt.
+                            os.rename(transfer.output,
+                                      transfer.output + '.failed')
+                        summary['failed'].append(transfer.output)
+                        continue
+                    summary['nfiles'] += 1
+                    summary['nbytes'] += os.path.getsize(transfer.output)
+                elapsed = time.time() - t0
+                print("%i/%i files, %.1f MB, %.2f MB/s"
+                      % (summary['nfiles'], len(transfers),
+                         summary['nbytes']/1e6,
+                         summary['nbytes']/1e6/elapsed if elapsed > 0 else 0))
+        finally:
+            pool.close()
+            pool.join()
+        summary['elapsed'] = time.time() - t0
+        return summary
 
 class DataCatalogException(RuntimeError):
     def __init__(self, value):
@@ -99,10 +772,22 @@ class DataCatalogException(RuntimeError):
 
 class DataCatalog(object):
     def __init__(self, folder=None, experiment="LSST",
-                 mode="dev", remote_login=None, site='SLAC', config_url=None):
+                 mode="dev", remote_login=None, site='SLAC', config_url=None,
+                 cache_dir=None, cache_ttl=600, mirror_index=None):
+        """
+        If cache_dir is given, or if cache_dir is None and the
+        DATACAT_CACHE_DIR environment variable is set, find_datasets
+        results are cached in that directory for cache_ttl seconds.
+        Otherwise, or if cache_ttl=0, every query goes to the catalog.
+
+        mirror_index is a MirrorIndex of local copies of the catalog
+        files.  If None, the mirror roots are taken from the
+        DATACAT_MIRROR_ROOTS environment variable, if it is set.
+        """
         self.folder = folder
         if remote_login is None:
-            self.remote_login = os.getlogin()
+            remote_login = os.getlogin()
+        self.remote_login = remote_login
         self.site = site
         my_config_url = datacat.config.default_url(experiment, mode=mode)
         if my_config_url is None:
@@ -111,43 +796,108 @@ class DataCatalog(object):
         if config_url is not None:
             # Override the computed value.
             my_config_url = config_url
+        self.config_url = my_config_url
         self.client = datacat.Client(my_config_url)
+        if cache_dir is None:
+            cache_dir = os.environ.get('DATACAT_CACHE_DIR')
+        self.query_cache = None
+        if cache_dir is not None and cache_ttl > 0:
+            self.query_cache = QueryCache(cache_dir, ttl=cache_ttl)
+        if mirror_index is None:
+            mirror_index = _default_mirror_index()
+        self.mirror_index = mirror_index
+    def _pattern_path(self, folder, pattern):
+        my_folder = folder
+        if folder is None:
+            my_folder = self.folder
+        if pattern is not None:
+            return os.path.join(my_folder.rstrip('/'), pattern)
+        return my_folder.rstrip('/')
+    def _search(self, pattern_path, query, **kwds):
+        try:
+            return self.client.search(pattern_path, query=query, **kwds)
+        except datacat.error.DcException as eobj:
+            print("Caught datacat.error.DcException:")
+            print(str(eobj))
+            raise
     def find_datasets(self, query, folder=None, job_id=None, job_name=None,
-                      datacat_search_patterns = (None, '**')):
+                      datacat_search_patterns = (None, '**'), refresh=False,
+                      concurrent=False):
         """
         Find datasets in the Data Catalog given the self.folder
         attribute or the specified folder.  For the default value of
         datacat_search_patterns, do a recursive search only if no
-        files are found in the desired folder.
+        files are found in the desired folder.  If concurrent is True,
+        the searches for all of the patterns are issued at once, and
+        the first non-empty result, in pattern order, is used.
+
+        Non-empty results are served from the query cache, if it is
+        enabled, unless refresh is True.
         """
         my_folder = folder
         if folder is None:
             my_folder = self.folder
-        for pattern in datacat_search_patterns:
-            if pattern is not None:
-                pattern_path = os.path.join(my_folder.rstrip('/'), pattern)
-            else:
-                pattern_path = my_folder.rstrip('/')
+        cache_key = [self.config_url, my_folder,
+                     list(datacat_search_patterns), query]
+        if self.query_cache is not None and not refresh:
+            records = self.query_cache.get(cache_key)
+            if records is not None:
+                return DatasetList(records, self, job_id=job_id,
+                                   job_name=job_name)
+        pattern_paths = [self._pattern_path(folder, pattern)
+                         for pattern in datacat_search_patterns]
+        if concurrent and len(pattern_paths) > 1:
+            pool = ThreadPool(len(pattern_paths))
             try:
-                resp = self.client.search(pattern_path, query=query)
-            except datacat.error.DcException as eobj:
-                print("Caught datacat.error.DcException:")
-                print(str(eobj))
-                raise
-            if resp:
-                # resp has data, so no need to try remaining search patterns.
-                break
-
-#        try:
-#            if folder is not None:
-#                resp = self.client.search(folder, query=query)
-#            else:
-#                resp = self.client.search(self.folder, query=query)
-#        except datacat.error.DcException as eobj:
-#            print("Caught datacat.error.DcException:")
-#            print(str(eobj.raw))
-#            raise
+                for resp in pool.imap(lambda x: self._search(x, query),
+                                      pattern_paths):
+                    if resp:
+                        break
+            finally:
+                # Don't wait for the searches whose results aren't needed.
+                pool.close()
+        else:
+            for pattern_path in pattern_paths:
+                resp = self._search(pattern_path, query)
+                if resp:
+                    # resp has data, so no need to try remaining search
+                    # patterns.
+                    break
+        if self.query_cache is not None and resp:
+            resp = self.query_cache.put(cache_key, resp)
         return DatasetList(resp, self, job_id=job_id, job_name=job_name)
+    def iter_datasets(self, query, folder=None, page_size=1000,
+                      datacat_search_patterns=(None, '**')):
+        """
+        Generator of the datasets matching the query, retrieved from
+        the Data Catalog in pages of up to page_size datasets.  The
+        next page is requested while the current one is being
+        consumed, until an empty page is returned, since the server
+        may return fewer datasets per page than requested.  As for
+        find_datasets, the search patterns after the first one are
+        only used if the earlier ones find nothing.
+        """
+        pool = ThreadPool(1)
+        try:
+            for pattern in datacat_search_patterns:
+                pattern_path = self._pattern_path(folder, pattern)
+                offset = 0
+                page = self._search(pattern_path, query, offset=offset,
+                                    max_num=page_size)
+                found = bool(page)
+                while page:
+                    offset += len(page)
+                    next_page = pool.apply_async(
+                        self._search, (pattern_path, query),
+                        dict(offset=offset, max_num=page_size))
+                    for dataset in page:
+                        yield dataset
+                    page = next_page.get()
+                if found:
+                    # No need to try the remaining search patterns.
+                    return
+        finally:
+            pool.close()
 
 if __name__ == '__main__':
     folder = '/LSST/mirror/BNL3'
@@ -77,37 +77,73 @@ class CcsJythonInterpreter:
             fileContent = fd.read()
         return self.sendInterpreterServer(fileContent)
 
-    def syncScriptExecution(self, filename, setup_commands=(), verbose=False):
-        if verbose and setup_commands:
-            print("Executing setup commands for", filename)
-        for command in setup_commands:
+    def syncScriptExecution(self, filename, setup_commands=(), verbose=False,
+                            output_callback=None, keep_output=True):
+        """
+        Execute the setup commands and then the script in filename.
+
+        setup_commands may be a sequence of statements or a single
+        script block.  Either way, they are sent to the interpreter
+        in one request.
+
+        output_callback, if given, is called with each chunk of script
+        output as it arrives.  If it returns True, the execution is
+        abandoned and result.thread.aborted is set.  If keep_output is
+        False, the script output is not accumulated in memory.
+        """
+        if not isinstance(setup_commands, str):
+            setup_commands = '\n'.join(setup_commands)
+        if setup_commands:
             if verbose:
-                print(command)
-            self.syncExecution(command)
+                print("Executing setup commands for", filename)
+                print(setup_commands)
+            self.syncExecution(setup_commands)
 
         if verbose:
             print("Executing %s..." % filename)
         with open(filename, "r") as fd:
             fileContent = fd.read()
-        result = self.sendInterpreterServer(fileContent)
+        result = self.sendInterpreterServer(fileContent,
+                                            output_callback=output_callback,
+                                            keep_output=keep_output)
         # Calling .getOutput() here causes the object to wait for the
         # underlying thread to stop running.
         result.getOutput()
         return result
 
-    def sendInterpreterServer(self, content):
+    def sendInterpreterServer(self, content, output_callback=None,
+                              keep_output=True):
         thread_id = str(uuid.uuid4())
         executor_thread = CcsPythonExecutorThread(thread_id,
-                                                  self.socket_connection)
+                                                  self.socket_connection,
+                                                  output_callback,
+                                                  keep_output)
         return executor_thread.executePythonContent(content)
 
+    def close(self):
+        """
+        Close the connection to the interpreter server.  This is the
+        only way to abandon an execution that is still running: its
+        result.thread.aborted is set, even if it produces no further
+        output.
+        """
+        try:
+            self.socket_connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket_connection.close()
+
 
 class CcsPythonExecutorThread:
-    def __init__(self, thread_id, socket_connection):
+    def __init__(self, thread_id, socket_connection, output_callback=None,
+                 keep_output=True):
         self.socket_connection = socket_connection
         self.thread_id = thread_id
         self.output_thread = threading.Thread(target=self.listenToSocketOutput)
         self.java_exceptions = []
+        self.output_callback = output_callback
+        self.keep_output = keep_output
+        self.aborted = False
 
     def executePythonContent(self, content):
         self.running = True
@@ -124,15 +160,28 @@ class CcsPythonExecutorThread:
             try:
                 output = self.socket_connection.recv(1024).decode('utf-8')
             except Exception as eobj:
+                self.aborted = True
+                self.running = False
                 print(eobj)
                 raise CcsException("Communication Problem with Socket")
+            if not output:
+                # The connection was closed, e.g., by
+                # CcsJythonInterpreter.close().
+                self.aborted = True
+                self.running = False
+                break
             for item in output.split('\n'):
                 if re_obj.match(item):
                     self.java_exceptions.append(item)
             if "doneExecution:" + self.thread_id not in output:
                 sys.stdout.write(output)
                 sys.stdout.flush()
-                self.execution_output += output
+                if self.keep_output:
+                    self.execution_output += output
+                if (self.output_callback is not None
+                        and self.output_callback(output)):
+                    self.aborted = True
+                    self.running = False
             else:
                 self.running = False
         del self.output_thread
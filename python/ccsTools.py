@@ -4,24 +4,47 @@ interpreter.
 """
 from __future__ import print_function
 import os
+import re
+import time
+import hashlib
 import glob
+import fnmatch
 import shutil
-from collections import OrderedDict
+import threading
+from collections import OrderedDict, deque
 try:
     import ConfigParser as configparser
 except ImportError:
     import configparser
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 from PythonBinding import CcsJythonInterpreter
 import lcatr.schema
 import siteUtils
 import camera_components
 
+# Glob patterns, relative to the job working directory, of the files
+# persisted by ccsValidator.
+CCS_FILE_PATTERNS = ('*/*.fits', '*/*.txt', 'pd-values*.txt', '*.png',
+                     '*.seq')
+
 class CcsSetup(OrderedDict):
     """
     The context-specific setup commands for executing a CCS script
     written in jython.  These commands set variables and paths that
     are known in the calling python code and which are needed by the
     jython script.
+
+    The rendered preamble is memoized and only rebuilt if the setup
+    items or commands, the python directory, or the CCS subsystem
+    config file, i.e., LCATR_CCS_SUBSYSTEM_CONFIG or the file's size
+    or modification time, change, so calling the object is idempotent.
     """
     def __init__(self, configFile, sys_paths=()):
         """
@@ -32,6 +55,7 @@ class CcsSetup(OrderedDict):
         """
         super(CcsSetup, self).__init__()
         self.commands = []
+        self._preamble = None
         self['tsCWD'] = os.getcwd()
         self['labname'] = siteUtils.getSiteName()
         self['jobname'] = siteUtils.getJobName()
@@ -59,34 +83,63 @@ class CcsSetup(OrderedDict):
         self.sys_paths = sys_paths
 
     def __setitem__(self, key, value):
+        self._preamble = None
         super(CcsSetup, self).__setitem__(key, "'%s'" % str(value))
 
+    def __delitem__(self, key):
+        self._preamble = None
+        super(CcsSetup, self).__delitem__(key)
+
     def set_item(self, key, value):
         "Use the OrderedDict.__setitem__ for values that don't need quotes."
+        self._preamble = None
         super(CcsSetup, self).__setitem__(key, value)
 
     def _read(self, configFile):
         if configFile is None:
             return
-        configDir = siteUtils.configDir()
-        for line in open(configFile):
-            key, value = line.strip().split("=")
-            self[key.strip()] = os.path.realpath(os.path.join(configDir, value.strip()))
+        for key, value in _resolved_config_paths(configFile,
+                                                 siteUtils.configDir()):
+            self[key] = value
 
     def __call__(self):
         """
         Return the setup commands for the CCS script.
         """
+        return list(self._build()[0])
+
+    def _build(self):
+        key = (tuple(self.commands), tuple(self.sys_paths),
+               siteUtils.pythonDir(), _subsystem_config_id())
+        if self._preamble is not None and self._preamble[0] == key:
+            return self._preamble[1]
         # Insert path to the modules used by the jython code.
-        for item in self.sys_paths:
-            self.commands.insert(0, 'sys.path.append("%s")' % item)
-        self.commands.insert(0, 'sys.path.append("%s")' % siteUtils.pythonDir())
-        self.commands.insert(0, 'import sys')
+        commands = ['import sys',
+                    'sys.path.append("%s")' % siteUtils.pythonDir()]
+        commands.extend(['sys.path.append("%s")' % item
+                         for item in reversed(self.sys_paths)])
+        commands.extend(self.commands)
         # Set the local variables.
-        self.commands.extend(['%s = %s' % item for item in self.items()])
+        commands.extend(['%s = %s' % item for item in self.items()])
         # Create the CCS subsystems mapping object.
-        self.commands.extend(CcsSetup.set_ccs_subsystems())
-        return self.commands
+        commands.extend(CcsSetup.set_ccs_subsystems())
+        commands.extend(CcsSetup.set_ccs_subsystem_limits())
+        script = '\n'.join(commands) + '\n'
+        digest = hashlib.sha1(script.encode('utf-8')).hexdigest()
+        self._preamble = (key, (tuple(commands), script, digest))
+        return self._preamble[1]
+
+    def render(self):
+        """
+        Return the setup commands as a single script block that can
+        be sent to the CCS jython interpreter in one request.
+        """
+        return self._build()[1]
+
+    @property
+    def digest(self):
+        "SHA1 hash of the rendered setup commands."
+        return self._build()[2]
 
     @staticmethod
     def set_ccs_subsystems():
@@ -100,6 +153,17 @@ class CcsSetup(OrderedDict):
             commands.append("subsystems['%s'] = '%s'" % (key, value))
         return commands
 
+    @staticmethod
+    def set_ccs_subsystem_limits():
+        "Return the setup commands for the CCS subsystem command limits."
+        limits = ccs_subsystem_limits()
+        if limits is None:
+            return ['subsystem_limits = None']
+        commands = ['subsystem_limits = dict()']
+        for key, value in limits.items():
+            commands.append("subsystem_limits['%s'] = %s" % (key, repr(value)))
+        return commands
+
 
 class CcsRaftSetup(CcsSetup):
     """
@@ -154,28 +218,575 @@ class CcsRaftSetup(CcsSetup):
                     self['tsCWD'].strip("'"))
 
 
+# Default pattern of the script output lines that cause ccsProducer
+# to abandon the CCS script execution.
+JAVA_EXCEPTION_PATTERN = r'.*java.lang.\w*Exception.*'
+
+class CcsOutputMonitor(object):
+    """
+    Callback for CcsJythonInterpreter.syncScriptExecution that streams
+    the CCS script output to a log file as it arrives, retains the
+    most recent lines as context, and signals an abort when a line
+    matches one of the abort patterns or the cancel_event is set.
+    """
+    def __init__(self, log_file, abort_patterns=(), context_lines=100,
+                 cancel_event=None):
+        """
+        Parameters
+        ----------
+        log_file : str
+            The log file to write.
+        abort_patterns : sequence of str, optional
+            Regular expressions that are matched against the start of
+            each output line.  Default: () (never abort).
+        context_lines : int, optional
+            Number of recent output lines to retain.  Default: 100.
+        cancel_event : threading.Event, optional
+            Event that signals an abort at the next output chunk when
+            it is set.  Default: None.
+        """
+        self.output = open(log_file, 'w')
+        self.abort_patterns = [re.compile(x) for x in abort_patterns]
+        self.context = deque(maxlen=context_lines)
+        self.cancel_event = cancel_event
+        self.abort_line = None
+        self.cancelled = False
+        self.nbytes = 0
+        self.nlines = 0
+        self._partial = ''
+
+    def __call__(self, chunk):
+        self.output.write(chunk)
+        self.output.flush()
+        self.nbytes += len(chunk)
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            self.cancelled = True
+            return True
+        lines = (self._partial + chunk).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            if self._check_line(line):
+                return True
+        return False
+
+    def _check_line(self, line):
+        "Record a complete output line, and return True if it aborts."
+        self.nlines += 1
+        self.context.append(line)
+        for pattern in self.abort_patterns:
+            if pattern.match(line):
+                self.abort_line = line
+                return True
+        return False
+
+    def close(self):
+        """
+        Close the log file.  A trailing partial line, e.g., an
+        exception printed just before the interpreter closed the
+        connection, is checked against the abort patterns first.
+        """
+        if self.output.closed:
+            return
+        if self._partial and self.abort_line is None:
+            self._check_line(self._partial)
+        self._partial = ''
+        self.output.close()
+
+def _abort_patterns(abort_patterns=None):
+    "The ccsProducer abort patterns, with the defaults applied."
+    if abort_patterns is not None:
+        return abort_patterns
+    if 'LCATR_CCS_ABORT_PATTERNS' in os.environ:
+        return os.environ['LCATR_CCS_ABORT_PATTERNS'].split(';')
+    return (JAVA_EXCEPTION_PATTERN,)
+
 def ccsProducer(jobName, ccsScript, ccs_setup_class=None, sys_paths=(),
-                verbose=True):
+                verbose=True, abort_patterns=None, watch_files=True,
+                ccs_name='ts', host=None, port=4444, log_file=None,
+                setup_items=None, cancel_event=None, output_monitor=None,
+                ccs=None):
     """
     Run the CCS data acquistion script under the CCS jython interpreter.
+
+    The script output is written to log_file, <jobName>.log by
+    default, as it arrives.  If an output line matches one of the
+    abort_patterns, the execution is abandoned and a RuntimeError is
+    raised with the preceding output as context.  If abort_patterns is
+    None, the patterns are taken from the LCATR_CCS_ABORT_PATTERNS
+    environment variable, a ';'-separated list, if it is set, or else
+    JAVA_EXCEPTION_PATTERN is used.  Set abort_patterns=() to run the
+    script to completion.
+
+    If watch_files is True, a FilerefWatcher computes the filerefs of
+    the output files for ccsValidator while the script is running.
+
+    The script is run by the interpreter ccs_name on host:port.
+    setup_items are added to the ccs_setup_class setup commands, e.g.,
+    to override the 'ts' or 'archon' subsystem names for a particular
+    test stand.  If cancel_event is set, the execution is abandoned at
+    the next script output.  output_monitor and ccs, if given, are
+    used in place of the CcsOutputMonitor and CcsJythonInterpreter
+    created here.  Closing ccs from another thread abandons the
+    execution even if the script produces no further output.
     """
     if ccs_setup_class is None:
         ccs_setup_class = CcsSetup
+    abort_patterns = _abort_patterns(abort_patterns)
+    if log_file is None:
+        log_file = "%s.log" % jobName
 
-    ccs = CcsJythonInterpreter("ts")
+    if ccs is None:
+        ccs = CcsJythonInterpreter(ccs_name, host=host, port=port)
     configDir = siteUtils.configDir()
     setup = ccs_setup_class('%s/acq.cfg' % configDir, sys_paths=sys_paths)
+    if setup_items:
+        for key, value in setup_items.items():
+            setup[key] = value
 
     full_script_path = siteUtils.jobDirPath(ccsScript, jobName=jobName)
-    result = ccs.syncScriptExecution(full_script_path, setup(), verbose=verbose)
-
-    output = open("%s.log" % jobName, "w")
-    output.write(result.getOutput())
-    output.close()
+    monitor = output_monitor
+    if monitor is None:
+        monitor = CcsOutputMonitor(log_file, abort_patterns=abort_patterns,
+                                   cancel_event=cancel_event)
+    watcher = FilerefWatcher().start() if watch_files else None
+    try:
+        result = ccs.syncScriptExecution(full_script_path, setup.render(),
+                                         verbose=verbose,
+                                         output_callback=monitor,
+                                         keep_output=False)
+    finally:
+        monitor.close()
+        if watcher is not None:
+            watcher.stop()
+    if result.thread.aborted:
+        ccs.close()
+        if (monitor.cancelled
+                or (cancel_event is not None and cancel_event.is_set())):
+            raise RuntimeError("CCS script execution cancelled.")
+    if (result.thread.aborted
+            or getattr(monitor, 'abort_line', None) is not None):
+        raise RuntimeError("CCS script execution aborted at:\n%s\n"
+                           "Preceding output:\n%s"
+                           % (monitor.abort_line, '\n'.join(monitor.context)))
     if result.thread.java_exceptions:
         raise RuntimeError("java.lang.Exceptions raised:\n%s"
                            % '\n'.join(result.thread.java_exceptions))
 
+class CcsStandRun(object):
+    """
+    A ccsProducer execution on one test stand, run by
+    CcsStandOrchestrator.
+
+    Attributes
+    ----------
+    status : str
+        'pending', 'running', 'succeeded', 'failed', or 'cancelled'.
+    error : Exception
+        The exception raised by ccsProducer, if any.
+    start_time, end_time : float
+        Start and end times of the execution.
+    monitor : CcsOutputMonitor
+        The output monitor of the execution.
+    ccs : CcsJythonInterpreter
+        The interpreter connection, while the execution is running.
+    """
+    def __init__(self, name, jobName, ccsScript, host=None, ccs_name='ts',
+                 port=4444, ccs_setup_class=None, log_file=None,
+                 setup_items=None, **kwds):
+        """
+        Parameters
+        ----------
+        name : str
+            Label of the test stand.
+        jobName, ccsScript : str
+            The ccsProducer job name and script.
+        host : str, optional
+            Host of the CCS jython interpreter.  Default: None (local host).
+        ccs_name : str, optional
+            Name of the CCS jython interpreter.  Default: 'ts'.
+        port : int, optional
+            Port of the CCS jython interpreter.  Default: 4444.
+        ccs_setup_class : CcsSetup subclass, optional
+            Default: None (CcsSetup).
+        log_file : str, optional
+            The log file of the script output.  Default: <name>.log.
+        setup_items : dict, optional
+            Additional setup items.  Default: None.
+        kwds : dict
+            Further ccsProducer keyword arguments.
+        """
+        self.name = name
+        self.jobName = jobName
+        self.ccsScript = ccsScript
+        self.host = host
+        self.ccs_name = ccs_name
+        self.port = port
+        self.ccs_setup_class = ccs_setup_class
+        self.log_file = log_file if log_file is not None else "%s.log" % name
+        self.setup_items = setup_items
+        self.kwds = kwds
+        self.status = 'pending'
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+        self.monitor = None
+        self.ccs = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+
+    def run(self, cancel_event):
+        "Run ccsProducer for this stand."
+        self.status = 'running'
+        self.start_time = time.time()
+        kwds = dict(watch_files=False)
+        kwds.update(self.kwds)
+        abort_patterns = _abort_patterns(kwds.pop('abort_patterns', None))
+        try:
+            self.monitor = CcsOutputMonitor(self.log_file,
+                                            abort_patterns=abort_patterns,
+                                            cancel_event=cancel_event)
+            ccs = CcsJythonInterpreter(self.ccs_name, host=self.host,
+                                       port=self.port)
+            with self._lock:
+                self.ccs = ccs
+                if cancel_event.is_set():
+                    self._cancelled = True
+                    raise RuntimeError("CCS script execution cancelled.")
+            ccsProducer(self.jobName, self.ccsScript,
+                        ccs_setup_class=self.ccs_setup_class,
+                        ccs_name=self.ccs_name, host=self.host,
+                        port=self.port, log_file=self.log_file,
+                        setup_items=self.setup_items,
+                        cancel_event=cancel_event,
+                        output_monitor=self.monitor, ccs=ccs, **kwds)
+            self.status = 'succeeded'
+        except Exception as eobj:
+            self.error = eobj
+            cancelled = (self._cancelled or (self.monitor is not None
+                                             and self.monitor.cancelled))
+            self.status = 'cancelled' if cancelled else 'failed'
+        finally:
+            if self.monitor is not None:
+                self.monitor.close()
+            with self._lock:
+                if self.ccs is not None:
+                    self.ccs.close()
+                    self.ccs = None
+            self.end_time = time.time()
+
+    def cancel(self):
+        """
+        Close the interpreter connection, so that the execution is
+        abandoned even if the script produces no further output.
+        """
+        with self._lock:
+            if self.ccs is not None:
+                self._cancelled = True
+                self.ccs.close()
+
+    @property
+    def elapsed(self):
+        "Elapsed execution time in seconds."
+        if self.start_time is None:
+            return 0
+        end_time = self.end_time if self.end_time is not None else time.time()
+        return end_time - self.start_time
+
+    def summary(self):
+        "Dictionary of the run status and output throughput."
+        nlines = self.monitor.nlines if self.monitor is not None else 0
+        nbytes = self.monitor.nbytes if self.monitor is not None else 0
+        elapsed = self.elapsed
+        return OrderedDict([('name', self.name),
+                            ('host', self.host),
+                            ('ccs_name', self.ccs_name),
+                            ('status', self.status),
+                            ('elapsed', elapsed),
+                            ('nlines', nlines),
+                            ('nbytes', nbytes),
+                            ('lines_per_sec',
+                             nlines/elapsed if elapsed > 0 else 0),
+                            ('error', str(self.error)
+                             if self.error is not None else '')])
+
+class CcsStandOrchestrator(object):
+    """
+    Run ccsProducer executions on several test stands concurrently,
+    with shared cancellation and a combined status report.
+    """
+    def __init__(self, runs, cancel_on_failure=True, join_timeout=10):
+        """
+        Parameters
+        ----------
+        runs : sequence of CcsStandRun
+            The test stand executions.
+        cancel_on_failure : bool, optional
+            Cancel the other executions if one of them fails.
+            Default: True.
+        join_timeout : float, optional
+            Time in seconds to wait for the executions to stop after
+            they are cancelled at the run timeout.  Default: 10.
+        """
+        self.runs = list(runs)
+        self.cancel_on_failure = cancel_on_failure
+        self.join_timeout = join_timeout
+        self.cancel_event = threading.Event()
+        self._threads = []
+
+    def _run(self, stand_run):
+        stand_run.run(self.cancel_event)
+        if stand_run.status == 'failed' and self.cancel_on_failure:
+            self.cancel()
+
+    def start(self):
+        "Start all of the executions."
+        for stand_run in self.runs:
+            thread = threading.Thread(target=self._run, args=(stand_run,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def cancel(self):
+        """
+        Cancel all of the executions.  The interpreter connections are
+        closed, so that stands which produce no further output stop too.
+        """
+        self.cancel_event.set()
+        for stand_run in self.runs:
+            stand_run.cancel()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the executions to finish.  Returns True if they all
+        finished within the timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.time())
+            thread.join(remaining)
+        return not any(thread.is_alive() for thread in self._threads)
+
+    def running(self):
+        "List of the names of the stands whose executions are running."
+        return [stand_run.name for stand_run, thread
+                in zip(self.runs, self._threads) if thread.is_alive()]
+
+    def run(self, timeout=None):
+        """
+        Start the executions, and wait for them to finish.  At the
+        timeout, the executions are cancelled and joined for up to
+        join_timeout seconds, and any that are still running are
+        reported.
+        """
+        self.start()
+        if not self.wait(timeout):
+            self.cancel()
+            if not self.wait(self.join_timeout):
+                print("CcsStandOrchestrator: executions still running "
+                      "after cancellation: %s" % ', '.join(self.running()))
+        return self
+
+    def status(self):
+        "List of the run summary dictionaries."
+        return [stand_run.summary() for stand_run in self.runs]
+
+    def report(self):
+        "Return the combined status and throughput report as a string."
+        lines = ['%-12s %-16s %-8s %-10s %10s %10s %10s'
+                 % ('stand', 'host', 'ccs_name', 'status', 'elapsed (s)',
+                    'lines', 'lines/s')]
+        for summary in self.status():
+            lines.append('%-12s %-16s %-8s %-10s %10.1f %10d %10.2f'
+                         % (summary['name'], summary['host'],
+                            summary['ccs_name'], summary['status'],
+                            summary['elapsed'], summary['nlines'],
+                            summary['lines_per_sec']))
+            if summary['error']:
+                lines.append('    %s' % summary['error'])
+        return '\n'.join(lines) + '\n'
+
+def ccsMultiProducer(runs, cancel_on_failure=True, timeout=None,
+                     report_file='ccs_stands_report.txt', join_timeout=10):
+    """
+    Run ccsProducer on several test stands concurrently, write the
+    combined status report, and raise a RuntimeError if any of the
+    executions did not succeed.
+
+    Parameters
+    ----------
+    runs : sequence of CcsStandRun
+        The test stand executions.
+    cancel_on_failure : bool, optional
+        Cancel the other executions if one of them fails.  Default: True.
+    timeout : float, optional
+        Time in seconds after which the remaining executions are
+        cancelled.  Default: None (no timeout).
+    report_file : str, optional
+        File to write the report to.  Default: 'ccs_stands_report.txt'.
+    join_timeout : float, optional
+        Time in seconds to wait for the executions to stop after they
+        are cancelled at the timeout.  Default: 10.
+
+    Returns
+    -------
+    CcsStandOrchestrator
+    """
+    orchestrator = CcsStandOrchestrator(runs,
+                                        cancel_on_failure=cancel_on_failure,
+                                        join_timeout=join_timeout)
+    orchestrator.run(timeout=timeout)
+    report = orchestrator.report()
+    print(report)
+    if report_file is not None:
+        with open(report_file, 'w') as output:
+            output.write(report)
+    failed = [x.name for x in orchestrator.runs if x.status != 'succeeded']
+    if failed:
+        raise RuntimeError("CCS executions did not succeed for: %s"
+                           % ', '.join(failed))
+    return orchestrator
+
+class FilerefWatcher(object):
+    """
+    Background watcher of the current working directory that computes
+    the lcatr.schema filerefs of completed output files while the data
+    acquisition is running, and stores them in the
+    siteUtils.FilerefCache used by ccsValidator, so that only the last
+    few files need to be processed at the end of the job.
+
+    A file is complete when it is closed after writing, if pyinotify
+    is available, or else when its size and modification time have
+    been unchanged for settle_time seconds.
+    """
+    def __init__(self, patterns=CCS_FILE_PATTERNS,
+                 cache_file='.fileref_cache.json', poll_interval=5,
+                 settle_time=10, use_inotify=True):
+        """
+        Parameters
+        ----------
+        patterns : sequence of str, optional
+            Glob patterns of the files to process.
+            Default: CCS_FILE_PATTERNS.
+        cache_file : str, optional
+            The FilerefCache file.  Default: '.fileref_cache.json'.
+        poll_interval : float, optional
+            Time in seconds between directory scans when polling.
+            Default: 5.
+        settle_time : float, optional
+            Time in seconds that a file must be unchanged to be
+            considered complete when polling.  Default: 10.
+        use_inotify : bool, optional
+            Use pyinotify if it is available.  Default: True.
+        """
+        self.patterns = patterns
+        self.cache = siteUtils.FilerefCache(cache_file)
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.use_inotify = use_inotify and pyinotify is not None
+        self.nprocessed = 0
+        self._completed = queue.Queue()
+        self._stop = threading.Event()
+        self._threads = []
+        self._notifier = None
+
+    def _matches(self, path):
+        for pattern in self.patterns:
+            if (path.count('/') == pattern.count('/')
+                    and fnmatch.fnmatch(path, pattern)):
+                return True
+        return False
+
+    def start(self):
+        "Start watching for completed files."
+        if self.use_inotify:
+            self._start_notifier()
+        else:
+            self._threads.append(threading.Thread(target=self._poll))
+        self._threads.append(threading.Thread(target=self._process))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def _start_notifier(self):
+        topdir = os.getcwd()
+        completed = self._completed
+        matches = self._matches
+
+        class Handler(pyinotify.ProcessEvent):
+            def _queue(self, event):
+                path = os.path.relpath(event.pathname, topdir)
+                if matches(path):
+                    completed.put(path)
+            process_IN_CLOSE_WRITE = _queue
+            process_IN_MOVED_TO = _queue
+
+        watch_manager = pyinotify.WatchManager()
+        self._notifier = pyinotify.ThreadedNotifier(watch_manager, Handler())
+        self._notifier.daemon = True
+        self._notifier.start()
+        watch_manager.add_watch(topdir, pyinotify.IN_CLOSE_WRITE |
+                                pyinotify.IN_MOVED_TO, rec=True,
+                                auto_add=True)
+
+    def _poll(self):
+        previous = dict()
+        queued = set()
+        while not self._stop.wait(self.poll_interval):
+            current = dict()
+            for pattern in self.patterns:
+                for path in glob.glob(pattern):
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    current[path] = (stat.st_size, stat.st_mtime)
+            now = time.time()
+            for path, (size, mtime) in current.items():
+                if (previous.get(path) == (size, mtime)
+                        and now - mtime >= self.settle_time
+                        and (path, size, mtime) not in queued):
+                    queued.add((path, size, mtime))
+                    self._completed.put(path)
+            previous = current
+
+    def _process(self):
+        while True:
+            try:
+                path = self._completed.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return
+                continue
+            try:
+                self.cache.make(path)
+                self.nprocessed += 1
+            except (IOError, OSError) as eobj:
+                print("FilerefWatcher: %s" % eobj)
+            if self._completed.empty():
+                self.cache.save()
+
+    def stop(self, timeout=None):
+        """
+        Stop watching, finish processing the completed files, and save
+        the cache.
+        """
+        if self._notifier is not None:
+            self._notifier.stop()
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self.cache.save()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
 def ccsValidator(results=None):
     """
     Persist standard file patterns, e.g., '*.fits', 'pd-values*.txt', 'Photo*.txt',
@@ -183,19 +794,76 @@ def ccsValidator(results=None):
     """
     if results is None:
         results = []
-    files = glob.glob('*/*.fits')
-    files += glob.glob('*/*.txt')
-    files += glob.glob('pd-values*.txt')
-    files += glob.glob('*.png')
-    files += glob.glob('*.seq')
-    unique_files = set(files)
-    results.extend([lcatr.schema.fileref.make(item) for item in unique_files])
+    files = []
+    for pattern in CCS_FILE_PATTERNS:
+        files += glob.glob(pattern)
+    results.extend(siteUtils.make_filerefs(files))
     results.extend(siteUtils.jobInfo())
     results = siteUtils.persist_ccs_versions(results)
 #hn    results = siteUtils.persist_reb_info(results)
     lcatr.schema.write_file(results)
     lcatr.schema.validate_file()
 
+_config_path_cache = dict()
+
+def _resolved_config_paths(config_file, config_dir):
+    """
+    The (key, realpath) pairs of an acq.cfg-style file of config file
+    basenames relative to config_dir.  Results are memoized by the
+    file's path, size, and modification time.
+    """
+    stat = os.stat(config_file)
+    key = (os.path.abspath(config_file), stat.st_size, stat.st_mtime,
+           config_dir)
+    if key not in _config_path_cache:
+        pairs = []
+        with open(config_file) as fd:
+            for line in fd:
+                name, value = line.strip().split("=")
+                pairs.append((name.strip(), os.path.realpath(
+                    os.path.join(config_dir, value.strip()))))
+        _config_path_cache[key] = tuple(pairs)
+    return _config_path_cache[key]
+
+_config_section_cache = dict()
+
+def _subsystem_config_id():
+    """
+    The LCATR_CCS_SUBSYSTEM_CONFIG path, resolved, with the size and
+    modification time of the file, or None if the variable is not set.
+    """
+    config_file = os.environ.get('LCATR_CCS_SUBSYSTEM_CONFIG')
+    if config_file is None:
+        return None
+    try:
+        stat = os.stat(config_file)
+        file_id = (stat.st_size, stat.st_mtime)
+    except OSError:
+        file_id = None
+    return (os.path.realpath(config_file), file_id)
+
+def _config_section_items(config_file, section):
+    """
+    The (option, value) pairs of a config file section, or None if the
+    section is not present.  Results are memoized by the file's path,
+    size, and modification time.
+    """
+    try:
+        stat = os.stat(config_file)
+        file_id = (stat.st_size, stat.st_mtime)
+    except OSError:
+        file_id = None
+    key = (os.path.abspath(config_file), file_id, section)
+    if key not in _config_section_cache:
+        parser = configparser.ConfigParser()
+        parser.optionxform = str
+        parser.read(config_file)
+        items = None
+        if parser.has_section(section):
+            items = tuple(parser.items(section))
+        _config_section_cache[key] = items
+    return _config_section_cache[key]
+
 def ccs_subsystem_mapping(config_file=None, section='ccs_subsystems'):
     """
     Function to find the mapping of abstracted to concrete CCS subsystem
@@ -221,7 +889,53 @@ def ccs_subsystem_mapping(config_file=None, section='ccs_subsystems'):
             config_file = os.environ['LCATR_CCS_SUBSYSTEM_CONFIG']
         else:
             return None
-    parser = configparser.ConfigParser()
-    parser.optionxform = str
-    parser.read(config_file)
-    return OrderedDict([pair for pair in parser.items(section)])
+    items = _config_section_items(config_file, section)
+    if items is None:
+        raise configparser.NoSectionError(section)
+    return OrderedDict(items)
+
+def ccs_subsystem_limits(config_file=None, section='ccs_subsystem_limits'):
+    """
+    Function to read the per-subsystem command concurrency and rate
+    limits for use by ccs_scripting_tools.CcsSubsystems.  Each entry
+    in the config section is keyed by the abstracted subsystem name,
+    with comma-separated CommandGovernor keyword values, e.g.,
+
+    [ccs_subsystem_limits]
+    rebps = max_concurrent=1, rate=5, burst=2
+
+    Parameters
+    ----------
+    config_file : str, optional
+         The configuration file containing the limits.  If None
+         (default), then the file pointed to by the
+         LCATR_CCS_SUBSYSTEM_CONFIG environment variable is used.  If
+         that is not set, then None is returned.
+    section : str, optional
+         The section of the config file that contains the limits.
+         Default:  'ccs_subsystem_limits'.
+
+    Returns
+    -------
+    dict : A dictionary of keyword dictionaries keyed by subsystem
+         name, or None if the config file or section is not available.
+    """
+    if config_file is None:
+        if 'LCATR_CCS_SUBSYSTEM_CONFIG' in os.environ:
+            config_file = os.environ['LCATR_CCS_SUBSYSTEM_CONFIG']
+        else:
+            return None
+    items = _config_section_items(config_file, section)
+    if items is None:
+        return None
+    casts = dict(max_concurrent=int, rate=float, burst=int)
+    limits = OrderedDict()
+    for key, value in items:
+        limits[key] = dict()
+        for item in value.split(','):
+            name, setting = [x.strip() for x in item.split('=')]
+            if name not in casts:
+                raise RuntimeError("Invalid CCS subsystem limit for %s: %s"
+                                   % (key, name))
+            limits[key][name] = casts[name](setting)
+    return limits
@@ -0,0 +1,189 @@
+"""
+Model of the raft/REB/CCD geometry reported by the CCS printGeometry
+command.
+"""
+import weakref
+from collections import namedtuple, OrderedDict
+
+__all__ = ['Ccd', 'CcsGeometry', 'wg_reb_name']
+
+Ccd = namedtuple('Ccd', 'ccd_id reb_name ccd_num slot raft_name'.split())
+
+def _is_ccd_slot(name):
+    "CCD slot names are of the form 'S20'."
+    return len(name) == 3 and name[0] == 'S'
+
+class CcsGeometry(object):
+    """
+    Indexed tree of rafts, REBs, and CCDs parsed from printGeometry
+    output of any depth, e.g.,
+
+    --> R00
+    ---> R00.Reb2
+    ----> R00.Reb2.S20
+
+    CCDs are the entries whose last component is a slot name, REBs
+    are the parents of CCDs, and rafts are the parents of REBs, if
+    they are present.
+
+    Attributes
+    ----------
+    entries : list
+        (number of dashes, entry name) tuples in printGeometry order.
+    rafts : OrderedDict
+        Lists of REB names keyed by raft name.
+    rebs : OrderedDict
+        Lists of Ccd tuples keyed by REB name.
+    ccds : OrderedDict
+        Ccd tuples keyed by CCD ID, e.g., 'R00.Reb2.S20'.
+    """
+    _text_cache = dict()
+    _subsystem_cache = weakref.WeakKeyDictionary()
+
+    def __init__(self, text):
+        """
+        Parameters
+        ----------
+        text : str
+            The printGeometry output.
+        """
+        self.entries = []
+        parents = dict()
+        stack = []
+        for line in text.split('\n'):
+            tokens = line.strip().split()
+            if len(tokens) != 2 or not tokens[0].endswith('>'):
+                continue
+            ndashes = len(tokens[0]) - 1
+            while stack and stack[-1][0] >= ndashes:
+                stack.pop()
+            parents[tokens[1]] = stack[-1][1] if stack else None
+            stack.append((ndashes, tokens[1]))
+            self.entries.append((ndashes, tokens[1]))
+
+        self.rafts = OrderedDict()
+        self.rebs = OrderedDict()
+        self.ccds = OrderedDict()
+        self._slots = dict()
+        for _, name in self.entries:
+            slot = name.split('.')[-1]
+            if not _is_ccd_slot(slot):
+                continue
+            reb_name = parents[name]
+            raft_name = parents.get(reb_name)
+            ccd_num = int(slot[2]) if slot[2].isdigit() else None
+            ccd = Ccd(name, reb_name, ccd_num, slot, raft_name)
+            self.ccds[name] = ccd
+            self.rebs.setdefault(reb_name, []).append(ccd)
+            if raft_name is not None:
+                reb_names = self.rafts.setdefault(raft_name, [])
+                if reb_name not in reb_names:
+                    reb_names.append(reb_name)
+            self._slots.setdefault(slot, ccd)
+            self._slots[(raft_name, slot)] = ccd
+
+    @classmethod
+    def from_text(cls, text):
+        "Return the, possibly cached, geometry for the printGeometry text."
+        try:
+            return cls._text_cache[text]
+        except KeyError:
+            geometry = cls(text)
+            cls._text_cache[text] = geometry
+            return geometry
+
+    @classmethod
+    def from_subsystem(cls, ccs_subsystem, depth=3, refresh=False):
+        """
+        Return the geometry reported by 'printGeometry <depth>' for a
+        CCS subsystem object or SubsystemDecorator.  The result is
+        cached per subsystem object, for as long as the object exists,
+        unless refresh is True.
+        """
+        try:
+            geometries = cls._subsystem_cache.setdefault(ccs_subsystem, {})
+        except TypeError:
+            # The subsystem object does not support weak references.
+            geometries = {}
+        if not refresh and depth in geometries:
+            return geometries[depth]
+        try:
+            send = ccs_subsystem.sendSynchCommand
+        except AttributeError:
+            send = ccs_subsystem.synchCommand
+        reply = send('printGeometry %d' % depth)
+        try:
+            text = reply.getResult()
+        except AttributeError:
+            text = reply
+        geometry = cls.from_text(str(text))
+        geometries[depth] = geometry
+        return geometry
+
+    @classmethod
+    def from_layout(cls, layout, raft_name=None):
+        """
+        Create a geometry from an ordered sequence of (REB name, CCD
+        slot names) pairs, e.g., [('Reb0', ['S00', 'S01', 'S02'])].
+        If raft_name is given, the REBs are placed in that raft and
+        the entry names are prefixed with it.
+        """
+        lines = []
+        ndashes = 2
+        prefix = ''
+        if raft_name is not None:
+            lines.append('--> %s' % raft_name)
+            ndashes = 3
+            prefix = raft_name + '.'
+        for reb, slots in layout:
+            reb_name = prefix + reb
+            lines.append('%s> %s' % ('-'*ndashes, reb_name))
+            lines.extend(['%s> %s.%s' % ('-'*(ndashes + 1), reb_name, slot)
+                          for slot in slots])
+        return cls.from_text('\n'.join(lines) + '\n')
+
+    def render(self):
+        "Return the geometry in printGeometry format."
+        return ''.join(['%s> %s\n' % ('-'*ndashes, name)
+                        for ndashes, name in self.entries])
+
+    def slot(self, slot, raft_name=None):
+        """
+        The Ccd for a slot name.  If raft_name is None, the first CCD
+        with that slot name is returned.
+        """
+        if raft_name is None:
+            return self._slots[slot]
+        return self._slots[(raft_name, slot)]
+
+    def ccd(self, ccd_id):
+        "The Ccd for a CCD ID."
+        return self.ccds[ccd_id]
+
+    def reb_ccds(self, reb_name):
+        "The list of Ccds read out by a REB."
+        return self.rebs[reb_name]
+
+    def slot_map(self, raft_name=None):
+        """
+        OrderedDict of the Ccds keyed by slot name, for the specified
+        raft or, if raft_name is None, for the first raft.
+        """
+        if raft_name is None and self.rafts:
+            raft_name = list(self.rafts.keys())[0]
+        return OrderedDict([(ccd.slot, ccd) for ccd in self.ccds.values()
+                            if ccd.raft_name == raft_name])
+
+# REB names of the wavefront and guide sensor slots of a corner raft.
+_wg_slot_patterns = (('ccd1', 'WREB0'), ('ccd2', 'WREB0'),
+                     ('guidesensor1', 'GREB0'), ('guidesensor2', 'GREB1'))
+
+def wg_reb_name(slot):
+    """
+    The REB name of a corner raft slot, or None if the slot is not a
+    wavefront or guide sensor slot.
+    """
+    for pattern, name in _wg_slot_patterns:
+        if pattern in slot:
+            return name
+    return None
@@ -2,6 +2,17 @@
 Do-nothing python versions of CCS jython objects and classes to
 enable testing.
 """
+import time
+import json
+import random
+import threading
+from collections import OrderedDict
+from ccs_geometry import CcsGeometry
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
 class CcsType(object):
     "Python proxy for the org.lsst.ccs.scripting.CCS jython object."
     def __init__(self):
@@ -17,6 +28,63 @@ class CcsType(object):
         except KeyError:
             return NullSubsystem()
 
+    def load_session(self, filename, realtime=False):
+        """
+        Load a CCS session recorded by SessionRecorder and register a
+        ReplaySubsystem for each recorded subsystem.
+
+        Parameters
+        ----------
+        filename : str
+            The session file written by SessionRecorder.save.
+        realtime : bool, optional
+            If True, each replayed command sleeps for its recorded
+            duration.  Default: False.
+
+        Returns
+        -------
+        list : The names of the subsystems that were loaded.
+        """
+        with open(filename) as fd:
+            session = json.load(fd)
+        for name, entries in session['subsystems'].items():
+            self.proxies[str(name)] = ReplaySubsystem(entries,
+                                                      realtime=realtime)
+        return [str(name) for name in session['subsystems']]
+
+    def add_simulated_subsystems(self, latency_scale=1., error_rate=0.,
+                                 timeout=None, seed=None):
+        """
+        Register simulated ts8, REB power supply, photodiode, and
+        monochromator subsystems as 'ts8-sim', 'rebps-sim', 'pd-sim',
+        and 'mono-sim'.
+
+        Parameters
+        ----------
+        latency_scale : float, optional
+            Factor to apply to the nominal command latencies.
+            Default: 1.
+        error_rate : float, optional
+            Probability that any command raises a
+            SimulatedCommandError.  Default: 0.
+        timeout : float, optional
+            Command timeout in seconds.  Commands whose simulated
+            latency exceeds this raise SimulatedTimeout.  Default: None.
+        seed : int, optional
+            Seed for the random number generators.  Default: None.
+
+        Returns
+        -------
+        list : The names of the simulated subsystems.
+        """
+        kwds = dict(latency_scale=latency_scale, error_rate=error_rate,
+                    timeout=timeout, seed=seed)
+        self.proxies['ts8-sim'] = simulated_ts8(**kwds)
+        self.proxies['rebps-sim'] = simulated_rebps(**kwds)
+        self.proxies['pd-sim'] = simulated_photodiode(**kwds)
+        self.proxies['mono-sim'] = simulated_monochromator(**kwds)
+        return ['ts8-sim', 'rebps-sim', 'pd-sim', 'mono-sim']
+
     def setThrowExceptions(self, value):
         "Do-nothing function."
         pass
@@ -43,6 +111,14 @@ class NullSubsystem(object):
         "Execute an asynchronous CCS command."
         return NullResponse(*args)
 
+    def sendSynchCommand(self, *args):
+        "Execute a synchronous CCS command."
+        return NullResponse(*args)
+
+    def sendAsynchCommand(self, *args):
+        "Execute an asynchronous CCS command."
+        return NullResponse(*args)
+
 class Ts8Proxy(NullSubsystem):
     "Fake ts8 subsystem with canned responses to CCS commands."
     def __init__(self):
@@ -65,20 +141,10 @@ class Ts8Proxy(NullSubsystem):
         # ETU1 REBs:
         self.responses['getREBSerialNumbers'] \
             = ProxyResponse([412165857, 412223738, 412160431])
-        self.responses['printGeometry 3'] = ProxyResponse('''--> R00
----> R00.Reb2
-----> R00.Reb2.S20
-----> R00.Reb2.S21
-----> R00.Reb2.S22
----> R00.Reb1
-----> R00.Reb1.S10
-----> R00.Reb1.S11
-----> R00.Reb1.S12
----> R00.Reb0
-----> R00.Reb0.S00
-----> R00.Reb0.S01
-----> R00.Reb0.S02
-''')
+        geometry = CcsGeometry.from_layout(
+            [('Reb%i' % reb, ['S%i%i' % (reb, ccd) for ccd in range(3)])
+             for reb in (2, 1, 0)], raft_name='R00')
+        self.responses['printGeometry 3'] = ProxyResponse(geometry.render())
         self.responses['getREBIds'] = ProxyResponse((0, 1, 2))
         self.responses['getSequencerParameter CleaningNumber'] = ProxyResponse([0, 0, 0])
         self.responses['getSequencerParameter ClearCount'] = ProxyResponse([1, 1, 1])
@@ -96,6 +162,428 @@ class Ts8Proxy(NullSubsystem):
         except KeyError:
             return NullResponse()
 
+    def sendSynchCommand(self, *args):
+        command = ' '.join([str(x) for x in args])
+        try:
+            return self.responses[command]
+        except KeyError:
+            return NullResponse()
+
+    def sendAsynchCommand(self, *args):
+        return self.sendSynchCommand(*args)
+
+def _command_key(method, args):
+    """
+    Key to identify a command, independent of the timeout argument
+    of the older synchCommand interface.
+    """
+    if method == 'synchCommand':
+        args = args[1:]
+    return ' '.join([str(x) for x in args])
+
+def _serializable(value):
+    """
+    Convert a CCS command result, which may be a Java object, to a
+    JSON-serializable python object.
+    """
+    if value is None or isinstance(value, (bool, int, float,
+                                           _string_types)):
+        return value
+    if isinstance(value, dict):
+        return OrderedDict([(str(key), _serializable(item))
+                            for key, item in value.items()])
+    try:
+        return [_serializable(item) for item in value]
+    except TypeError:
+        return str(value)
+
+class RecordingSubsystem(object):
+    """
+    Wrapper of a CCS subsystem object that records the commands sent,
+    their responses, and timing with a SessionRecorder.
+    """
+    def __init__(self, ccs_subsystem, name, recorder):
+        self.ccs_subsystem = ccs_subsystem
+        self.name = name
+        self.recorder = recorder
+
+    def _execute(self, method, args):
+        t0 = time.time()
+        try:
+            reply = getattr(self.ccs_subsystem, method)(*args)
+        except Exception as eobj:
+            self.recorder.record(self.name, method, args, None,
+                                 time.time() - t0, error=eobj)
+            raise
+        self.recorder.record(self.name, method, args, reply,
+                             time.time() - t0)
+        return reply
+
+    def synchCommand(self, *args):
+        "Execute and record a synchronous CCS command."
+        return self._execute('synchCommand', args)
+
+    def asynchCommand(self, *args):
+        "Execute and record an asynchronous CCS command."
+        return self._execute('asynchCommand', args)
+
+    def sendSynchCommand(self, *args):
+        "Execute and record a synchronous CCS command."
+        return self._execute('sendSynchCommand', args)
+
+    def sendAsynchCommand(self, *args):
+        "Execute and record an asynchronous CCS command."
+        return self._execute('sendAsynchCommand', args)
+
+class RecordingCcs(object):
+    """
+    Wrapper of the CCS scripting object whose attachSubsystem method
+    returns RecordingSubsystems.
+    """
+    def __init__(self, ccs, recorder):
+        self.ccs = ccs
+        self.recorder = recorder
+
+    def attachSubsystem(self, value):
+        "Attach a CCS subsystem and record the commands sent to it."
+        return self.recorder.wrap(self.ccs.attachSubsystem(value), value)
+
+    def __getattr__(self, attr):
+        return getattr(self.ccs, attr)
+
+class SessionRecorder(object):
+    """
+    Recorder of the commands sent to CCS subsystems and of their
+    responses and timing.  The saved session can be loaded with
+    CcsType.load_session to replay the subsystems offline.
+    """
+    def __init__(self):
+        self.subsystems = OrderedDict()
+        self._lock = threading.Lock()
+
+    def wrap(self, ccs_subsystem, name):
+        "Return a RecordingSubsystem for the CCS subsystem object."
+        return RecordingSubsystem(ccs_subsystem, name, self)
+
+    def wrap_ccs(self, ccs):
+        "Return a RecordingCcs for the CCS scripting object."
+        return RecordingCcs(ccs, self)
+
+    def record(self, name, method, args, reply, duration, error=None):
+        "Record a command and its response."
+        wrapped = hasattr(reply, 'getResult')
+        result = reply.getResult() if wrapped else reply
+        entry = OrderedDict([('method', method),
+                             ('command', _command_key(method, args)),
+                             ('args', _serializable(list(args))),
+                             ('result', _serializable(result)),
+                             ('wrapped', wrapped),
+                             ('duration', duration),
+                             ('error', None if error is None
+                              else str(error))])
+        with self._lock:
+            self.subsystems.setdefault(name, []).append(entry)
+
+    def save(self, filename):
+        "Write the recorded session to a JSON file."
+        with self._lock:
+            session = dict(subsystems=self.subsystems)
+            with open(filename, 'w') as output:
+                json.dump(session, output, indent=1)
+
+class ReplayError(RuntimeError):
+    "Exception raised for a command that failed when it was recorded."
+    def __init__(self, value):
+        super(ReplayError, self).__init__(value)
+
+class ReplaySubsystem(NullSubsystem):
+    """
+    Proxy subsystem that replays recorded responses.  Repeated
+    commands are answered with the recorded responses in order, and
+    the last one is repeated once they are exhausted.  Commands that
+    were not recorded return a NullResponse.
+    """
+    def __init__(self, entries, realtime=False):
+        super(ReplaySubsystem, self).__init__()
+        self.realtime = realtime
+        self.responses = dict()
+        for entry in entries:
+            self.responses.setdefault(entry['command'], []).append(entry)
+        self._calls = dict()
+        self._lock = threading.Lock()
+
+    def _replay(self, method, args):
+        command = _command_key(method, args)
+        try:
+            entries = self.responses[command]
+        except KeyError:
+            return NullResponse()
+        with self._lock:
+            index = self._calls.get(command, 0)
+            self._calls[command] = index + 1
+        entry = entries[min(index, len(entries) - 1)]
+        if self.realtime:
+            time.sleep(entry['duration'])
+        if entry['error'] is not None:
+            raise ReplayError(entry['error'])
+        if entry['wrapped']:
+            return ProxyResponse(entry['result'])
+        return entry['result']
+
+    def synchCommand(self, *args):
+        "Replay a synchronous CCS command."
+        return self._replay('synchCommand', args)
+
+    def asynchCommand(self, *args):
+        "Replay an asynchronous CCS command."
+        return self._replay('asynchCommand', args)
+
+    def sendSynchCommand(self, *args):
+        "Replay a synchronous CCS command."
+        return self._replay('sendSynchCommand', args)
+
+    def sendAsynchCommand(self, *args):
+        "Replay an asynchronous CCS command."
+        return self._replay('sendAsynchCommand', args)
+
+class LatencyModel(object):
+    """
+    Distribution of simulated command latencies in seconds.
+    """
+    def __init__(self, mean=0., jitter=0., distribution='gauss',
+                 minimum=0.):
+        """
+        Parameters
+        ----------
+        mean : float, optional
+            Mean latency (median for the 'lognormal' distribution).
+            Default: 0.
+        jitter : float, optional
+            Width of the distribution: the half-width for 'uniform',
+            the standard deviation for 'gauss', and the standard
+            deviation of the log of the latency for 'lognormal'.  It
+            is ignored for 'fixed'.  Default: 0.
+        distribution : str, optional
+            One of 'fixed', 'uniform', 'gauss', or 'lognormal'.
+            Default: 'gauss'.
+        minimum : float, optional
+            Lower bound of the sampled latencies.  Default: 0.
+        """
+        if distribution not in ('fixed', 'uniform', 'gauss', 'lognormal'):
+            raise RuntimeError("Invalid latency distribution: %s"
+                               % distribution)
+        self.mean = mean
+        self.jitter = jitter
+        self.distribution = distribution
+        self.minimum = minimum
+
+    def sample(self, rng=random):
+        "Draw a latency value using the random number generator rng."
+        if self.distribution == 'fixed' or self.jitter == 0:
+            value = self.mean
+        elif self.distribution == 'uniform':
+            value = rng.uniform(self.mean - self.jitter,
+                                self.mean + self.jitter)
+        elif self.distribution == 'gauss':
+            value = rng.gauss(self.mean, self.jitter)
+        else:
+            value = self.mean*rng.lognormvariate(0, self.jitter)
+        return max(self.minimum, value)
+
+    def scaled(self, factor):
+        "Return a copy with the mean and jitter scaled by factor."
+        jitter = self.jitter
+        if self.distribution != 'lognormal':
+            jitter *= factor
+        return LatencyModel(self.mean*factor, jitter, self.distribution,
+                            self.minimum*factor)
+
+class SimulatedCommandError(RuntimeError):
+    "Exception raised for an injected command error."
+    def __init__(self, value):
+        super(SimulatedCommandError, self).__init__(value)
+
+class SimulatedTimeout(SimulatedCommandError):
+    "Exception raised when a simulated command exceeds its timeout."
+    def __init__(self, value):
+        super(SimulatedTimeout, self).__init__(value)
+
+class SimulatedSubsystem(NullSubsystem):
+    """
+    Proxy subsystem with configurable per-command latencies, timeouts,
+    and injected errors for benchmarking the concurrency of the
+    acquisition code.  The number of commands in flight is tracked to
+    check the concurrency limits of the calling code.
+    """
+    def __init__(self, responses=None, latencies=None,
+                 default_latency=None, error_rate=0., error_rates=None,
+                 timeout=None, latency_scale=1., seed=None):
+        """
+        Parameters
+        ----------
+        responses : dict, optional
+            Results keyed by either the full command string or by the
+            command name.  Values may be callables that take the
+            command arguments and return the result.  Commands without
+            a response return a NullResponse.  Default: None.
+        latencies : dict, optional
+            LatencyModels keyed by command name.  Default: None.
+        default_latency : LatencyModel, optional
+            Latency model for commands not in latencies.
+            Default: None (no latency).
+        error_rate : float, optional
+            Probability that a command raises SimulatedCommandError.
+            Default: 0.
+        error_rates : dict, optional
+            Error probabilities keyed by command name, overriding
+            error_rate.  Default: None.
+        timeout : float, optional
+            Commands whose sampled latency exceeds this value raise
+            SimulatedTimeout after waiting for timeout seconds.
+            Default: None.
+        latency_scale : float, optional
+            Factor to apply to all of the latency models.  Default: 1.
+        seed : int, optional
+            Seed for the random number generator.  Default: None.
+        """
+        super(SimulatedSubsystem, self).__init__()
+        self.responses = dict() if responses is None else dict(responses)
+        if latencies is None:
+            latencies = dict()
+        self.latencies = dict([(key, value.scaled(latency_scale))
+                               for key, value in latencies.items()])
+        if default_latency is None:
+            default_latency = LatencyModel(distribution='fixed')
+        self.default_latency = default_latency.scaled(latency_scale)
+        self.error_rate = error_rate
+        self.error_rates = dict() if error_rates is None else error_rates
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.ncalls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def _execute(self, args):
+        command = ' '.join([str(x) for x in args])
+        name = command.split(' ', 1)[0]
+        with self._lock:
+            latency = self.latencies.get(name, self.default_latency)\
+                          .sample(self.rng)
+            failed = (self.rng.random()
+                      < self.error_rates.get(name, self.error_rate))
+            self.ncalls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.timeout is not None and latency > self.timeout:
+                time.sleep(self.timeout)
+                raise SimulatedTimeout("%s timed out after %s s"
+                                       % (command, self.timeout))
+            time.sleep(latency)
+            if failed:
+                raise SimulatedCommandError("Injected error for %s"
+                                            % command)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        try:
+            response = self.responses[command]
+        except KeyError:
+            try:
+                response = self.responses[name]
+            except KeyError:
+                return NullResponse()
+        if callable(response):
+            response = response(*args)
+        if isinstance(response, NullResponse):
+            return response
+        return ProxyResponse(response)
+
+    def synchCommand(self, *args):
+        "Execute a simulated synchronous CCS command."
+        return self._execute(args[1:])
+
+    def asynchCommand(self, *args):
+        "Execute a simulated asynchronous CCS command."
+        return self._execute(args)
+
+    def sendSynchCommand(self, *args):
+        "Execute a simulated synchronous CCS command."
+        return self._execute(args)
+
+    def sendAsynchCommand(self, *args):
+        "Execute a simulated asynchronous CCS command."
+        return self._execute(args)
+
+def _channel_value(*args):
+    "Simulated getChannelValue result for temperature and bias channels."
+    channel = args[-1]
+    if 'Temp' in channel:
+        return -95. if 'CCD' in channel else 25.
+    if 'hvbias' in channel:
+        return -50.
+    return 0.
+
+def simulated_ts8(**kwds):
+    """
+    Simulated ts8 (raft) subsystem with the Ts8Proxy canned responses.
+    The keyword arguments are passed to SimulatedSubsystem.
+    """
+    responses = dict([(key, value.getResult()) for key, value
+                      in Ts8Proxy().responses.items()])
+    responses['getChannelValue'] = _channel_value
+    latencies = dict(getChannelValue=LatencyModel(0.02, 0.005),
+                     printGeometry=LatencyModel(0.05, 0.01),
+                     ccdSpecificHeaderKeywords=LatencyModel(0.01, 0.002),
+                     setSequencerParameter=LatencyModel(0.05, 0.01),
+                     exposeAcquireAndSave=LatencyModel(5., 0.1,
+                                                       distribution='uniform'))
+    kwds.setdefault('default_latency', LatencyModel(0.03, 0.3,
+                                                    distribution='lognormal'))
+    return SimulatedSubsystem(responses=responses, latencies=latencies,
+                              **kwds)
+
+def simulated_rebps(**kwds):
+    """
+    Simulated REB power supply subsystem.  The keyword arguments are
+    passed to SimulatedSubsystem.
+    """
+    latencies = dict(getChannelValue=LatencyModel(0.05, 0.01),
+                     powerOn=LatencyModel(2., 0.2),
+                     powerOff=LatencyModel(1., 0.1))
+    kwds.setdefault('default_latency', LatencyModel(0.05, 0.01))
+    return SimulatedSubsystem(responses=dict(getChannelValue=_channel_value),
+                              latencies=latencies, **kwds)
+
+def simulated_photodiode(**kwds):
+    """
+    Simulated photodiode (Keithley picoammeter) subsystem.  The
+    keyword arguments are passed to SimulatedSubsystem.
+    """
+    responses = dict(readBuffer=lambda *args: 'pd-values.txt',
+                     getChannelValue=lambda *args: 1e-9)
+    latencies = dict(accumBuffer=LatencyModel(0.2, 0.02),
+                     readBuffer=LatencyModel(0.5, 0.1),
+                     waitAccum=LatencyModel(1., 0.1))
+    kwds.setdefault('default_latency', LatencyModel(0.02, 0.005))
+    return SimulatedSubsystem(responses=responses, latencies=latencies,
+                              **kwds)
+
+def simulated_monochromator(**kwds):
+    """
+    Simulated monochromator subsystem.  The keyword arguments are
+    passed to SimulatedSubsystem.
+    """
+    latencies = dict(setWaveAndFilter=LatencyModel(3., 0.5),
+                     setWave=LatencyModel(2., 0.5),
+                     setFilter=LatencyModel(1., 0.2),
+                     openShutter=LatencyModel(0.1, 0.02),
+                     closeShutter=LatencyModel(0.1, 0.02))
+    kwds.setdefault('default_latency', LatencyModel(0.05, 0.01))
+    return SimulatedSubsystem(responses=dict(getWave=lambda *args: 500.),
+                              latencies=latencies, **kwds)
+
 class NullResponse(object):
     """
     Do-nothing response class to act as a return object by the
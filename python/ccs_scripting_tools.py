@@ -1,46 +1,650 @@
 """
 Tools for CCS jython scripts.
 """
-from collections import namedtuple, OrderedDict
+import os
+import time
+import json
+import threading
+from collections import namedtuple, OrderedDict, deque
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 import ccs_python_proxies
+from json_io import write_json
 try:
     from org.lsst.ccs.scripting import CCS
 except ImportError:
     CCS = ccs_python_proxies.CCS
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
+class CcsCommandTimeout(RuntimeError):
+    "Exception raised when a CCS command does not complete in time."
+    def __init__(self, value):
+        super(CcsCommandTimeout, self).__init__(value)
+
+class CommandFuture(object):
+    """
+    Handle to the result of a CCS command that is executing in a
+    worker thread.
+    """
+    def __init__(self, args=()):
+        self.args = args
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        "Return True if the command has completed."
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the command to complete, and return True if it has.
+        """
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Return the command result, waiting up to timeout seconds for
+        it.  The exception raised by the command, if any, is
+        re-raised, and CcsCommandTimeout is raised if the command has
+        not completed in time.
+        """
+        if not self.wait(timeout):
+            raise CcsCommandTimeout("%s did not complete within %s s"
+                                    % (self._command_string(), timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def getResult(self, timeout=None):
+        """
+        Return the command result as the responses returned by
+        sendAsynchCommand do, i.e., unwrapped from the sendSynchCommand
+        response if needed, so that existing scripts that call
+        getResult() on the return value of asynchCommand still work.
+        Otherwise the same as result().
+        """
+        reply = self.result(timeout)
+        try:
+            return reply.getResult()
+        except AttributeError:
+            return reply
+
+    def exception(self, timeout=None):
+        """
+        Return the exception raised by the command, or None if it
+        succeeded, waiting up to timeout seconds for it to complete.
+        """
+        if not self.wait(timeout):
+            raise CcsCommandTimeout("%s did not complete within %s s"
+                                    % (self._command_string(), timeout))
+        return self._exception
+
+    def add_done_callback(self, func):
+        """
+        Call func(future) when the command completes, or immediately
+        if it already has.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def set_result(self, result):
+        "Set the command result and mark the future as done."
+        self._result = result
+        self._set_done()
+
+    def set_exception(self, exception):
+        "Set the exception raised by the command and mark it as done."
+        self._exception = exception
+        self._set_done()
+
+    def _set_done(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            func(self)
+
+    def _command_string(self):
+        return str(_CommandString(self.args))
+
+class CommandExecutor(object):
+    """
+    Bounded pool of daemon worker threads to execute CCS commands.
+    The workers are started on demand and persist for the lifetime of
+    the executor.
+    """
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self._tasks = queue.Queue()
+        self._workers = []
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """
+        Schedule func(*args) for execution and return a CommandFuture
+        for its result.
+        """
+        future = CommandFuture(args)
+        with self._lock:
+            self._tasks.put((future, func, args))
+            if self._idle > 0:
+                self._idle -= 1
+            elif len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                self._workers.append(worker)
+                worker.start()
+        return future
+
+    def _work(self):
+        while True:
+            future, func, args = self._tasks.get()
+            try:
+                future.set_result(func(*args))
+            except Exception as eobj:
+                future.set_exception(eobj)
+            with self._lock:
+                self._idle += 1
+
+_default_executor = CommandExecutor()
+
+def wait_all(futures, timeout=None, return_exceptions=False):
+    """
+    Wait for a collection of CommandFutures and return their results.
+
+    Parameters
+    ----------
+    futures : sequence of CommandFuture
+        The pending commands.
+    timeout : float, optional
+        Overall time in seconds to wait for all of the commands.
+        Default: None (wait indefinitely).
+    return_exceptions : bool, optional
+        If True, exceptions (including CcsCommandTimeout) are returned
+        in place of the corresponding results instead of being raised.
+        Default: False.
+
+    Returns
+    -------
+    list : The command results in the same order as futures.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    results = []
+    for future in futures:
+        remaining = None if deadline is None \
+                    else max(0, deadline - time.time())
+        try:
+            results.append(future.result(remaining))
+        except Exception as eobj:
+            if not return_exceptions:
+                raise
+            results.append(eobj)
+    return results
+
+def gather(requests, timeout=None, return_exceptions=False):
+    """
+    Send a batch of commands, possibly to several subsystems, so that
+    they execute concurrently, and wait for all of them to complete.
+
+    Parameters
+    ----------
+    requests : sequence
+        Each entry is either a tuple (subsystem, arg1, arg2, ...),
+        where subsystem is a SubsystemDecorator and the remaining
+        items are the arguments of its asynchCommand method, or a
+        CommandFuture for a command that has already been sent.
+    timeout : float, optional
+        Overall time in seconds to wait for all of the commands.
+        Default: None (wait indefinitely).
+    return_exceptions : bool, optional
+        If True, exceptions are returned in place of the corresponding
+        results instead of being raised.  Default: False.
+
+    Returns
+    -------
+    list : The command results in the same order as requests.
+    """
+    futures = []
+    for request in requests:
+        if isinstance(request, CommandFuture):
+            futures.append(request)
+        else:
+            futures.append(request[0].asynchCommand(*request[1:]))
+    return wait_all(futures, timeout=timeout,
+                    return_exceptions=return_exceptions)
+
+class _CommandString(object):
+    """
+    Wrapper to defer the formatting of command arguments until a log
+    message is actually emitted.
+    """
+    def __init__(self, args):
+        self.args = args
+
+    def __str__(self):
+        return " ".join(["%s" % arg for arg in self.args])
+
+def _command_name(args):
+    """
+    The CCS command name, i.e., the first token of the first string
+    argument, skipping any leading timeout value.
+    """
+    for arg in args:
+        if isinstance(arg, _string_types):
+            return arg.split(' ', 1)[0]
+    return str(args[0]) if args else ''
+
+def _jsonable(value):
+    "Cast non-JSON-serializable command arguments as strings."
+    if value is None or isinstance(value, (bool, int, float,
+                                           _string_types)):
+        return value
+    return str(value)
+
+def _percentile(sorted_values, fraction):
+    "Nearest-rank percentile of a sorted, non-empty list."
+    index = int(round(fraction*(len(sorted_values) - 1)))
+    return sorted_values[index]
+
+class CommandJournal(object):
+    """
+    Bounded, append-only record of the CCS commands sent through
+    SubsystemDecorators and how long they took.  Entries are stored as
+    unformatted tuples of (timestamp, subsystem, args, duration,
+    outcome); they are only converted to text when the journal is
+    written out.
+    """
+    def __init__(self, maxlen=100000):
+        """
+        Parameters
+        ----------
+        maxlen : int, optional
+            Maximum number of entries to retain.  Once full, the oldest
+            entries are discarded.  Default: 100000.
+        """
+        self.entries = deque(maxlen=maxlen)
+
+    def record(self, subsystem, args, timestamp, duration, outcome='ok'):
+        "Append a command entry to the journal."
+        self.entries.append((timestamp, subsystem, args, duration, outcome))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def write(self, outfile):
+        """
+        Write the journal entries as JSON lines with fields timestamp,
+        subsystem, command, args, duration, and outcome.
+        """
+        with open(outfile, 'w') as output:
+            for timestamp, subsystem, args, duration, outcome \
+                    in list(self.entries):
+                entry = OrderedDict([('timestamp', timestamp),
+                                     ('subsystem', subsystem),
+                                     ('command', _command_name(args)),
+                                     ('args', [_jsonable(x) for x in args]),
+                                     ('duration', duration),
+                                     ('outcome', outcome)])
+                output.write(json.dumps(entry) + '\n')
+
+    def latency_stats(self):
+        """
+        Compute the latency statistics for each command.
+
+        Returns
+        -------
+        OrderedDict : (count, p50, p95, max, total) tuples of command
+            durations in seconds, keyed by (subsystem, command) and
+            ordered by decreasing total time.
+        """
+        durations = dict()
+        for _, subsystem, args, duration, _ in list(self.entries):
+            key = (subsystem, _command_name(args))
+            durations.setdefault(key, []).append(duration)
+        stats = []
+        for key, values in durations.items():
+            values.sort()
+            stats.append((key, (len(values), _percentile(values, 0.5),
+                                _percentile(values, 0.95), values[-1],
+                                sum(values))))
+        stats.sort(key=lambda x: x[1][-1], reverse=True)
+        return OrderedDict(stats)
+
+    def write_latency_summary(self, outfile):
+        "Write a table of the per-command latency statistics."
+        with open(outfile, 'w') as output:
+            output.write('%-20s %-30s %7s %10s %10s %10s %10s\n'
+                         % ('subsystem', 'command', 'count', 'p50 (s)',
+                            'p95 (s)', 'max (s)', 'total (s)'))
+            for (subsystem, command), values \
+                    in self.latency_stats().items():
+                output.write('%-20s %-30s %7i %10.4f %10.4f %10.4f %10.3f\n'
+                             % ((subsystem, command) + values))
+
+class CommandGovernor(object):
+    """
+    Concurrency limit and token-bucket rate limit for the commands
+    sent to a CCS subsystem.  Waiting commands are admitted in the
+    order in which they arrived, and the time each one spends waiting
+    is recorded.
+    """
+    def __init__(self, max_concurrent=None, rate=None, burst=1,
+                 maxlen=10000):
+        """
+        Parameters
+        ----------
+        max_concurrent : int, optional
+            Maximum number of commands in flight.  Default: None
+            (no limit).
+        rate : float, optional
+            Sustained number of commands per second.  Default: None
+            (no limit).
+        burst : int, optional
+            Number of commands that can be sent at once before the
+            rate limit applies.  Default: 1.
+        maxlen : int, optional
+            Number of queue-wait times to retain for the statistics.
+            Default: 10000.
+        """
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst
+        self.active = 0
+        self.wait_times = deque(maxlen=maxlen)
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._waiting = deque()
+        self._cond = threading.Condition()
+
+    def _token_delay(self):
+        "Time until a rate-limit token is available."
+        if self.rate is None:
+            return 0
+        now = time.time()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last)*self.rate)
+        self._last = now
+        if self._tokens >= 1:
+            return 0
+        return (1. - self._tokens)/self.rate
+
+    def acquire(self, since=None):
+        """
+        Wait until a command can be sent, and return the time waited.
+
+        Parameters
+        ----------
+        since : float, optional
+            Time at which the command was queued, if it was queued
+            before this call.  Default: None (now).
+        """
+        if since is None:
+            since = time.time()
+        ticket = object()
+        with self._cond:
+            self._waiting.append(ticket)
+            while True:
+                delay = None
+                if (self._waiting[0] is ticket and
+                        (self.max_concurrent is None
+                         or self.active < self.max_concurrent)):
+                    delay = self._token_delay()
+                    if delay == 0:
+                        break
+                self._cond.wait(delay)
+            self._waiting.popleft()
+            self.active += 1
+            if self.rate is not None:
+                self._tokens -= 1
+            wait = time.time() - since
+            self.wait_times.append(wait)
+            self._cond.notify_all()
+        return wait
+
+    def release(self):
+        "Signal that a command has completed."
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        Queue-wait statistics.
+
+        Returns
+        -------
+        dict : count, p50, p95, and max of the queue-wait times in
+            seconds.
+        """
+        values = sorted(self.wait_times)
+        if not values:
+            return dict(count=0, p50=0, p95=0, max=0)
+        return dict(count=len(values), p50=_percentile(values, 0.5),
+                    p95=_percentile(values, 0.95), max=values[-1])
 
 class SubsystemDecorator(object):
     """
     Decorator class to overlay logging of the commands sent to a CCS
     subsystem object.
     """
-    def __init__(self, ccs_subsystem, logger=None, name=None):
+    def __init__(self, ccs_subsystem, logger=None, name=None,
+                 executor=None, journal=None, governor=None):
         self.ccs_subsystem = ccs_subsystem
         self.logger = logger
         self.name = name
+        if executor is None:
+            executor = _default_executor
+        self.executor = executor
+        self.journal = journal
+        self.governor = governor
 
     def _log_command(self, args):
         if self.logger is not None:
-            command_string = " ".join(["%s" % arg for arg in args])
-            self.logger.info(command_string)
+            self.logger.info('%s', _CommandString(args))
+
+    def _send(self, *args):
+        if self.journal is None:
+            return self.ccs_subsystem.sendSynchCommand(*args)
+        outcome = 'ok'
+        t0 = time.time()
+        try:
+            return self.ccs_subsystem.sendSynchCommand(*args)
+        except Exception as eobj:
+            outcome = type(eobj).__name__
+            raise
+        finally:
+            self.journal.record(self.name, args, t0, time.time() - t0,
+                                outcome)
+
+    def _governed_send(self, since, args):
+        if self.governor is None:
+            return self._send(*args)
+        self.governor.acquire(since)
+        try:
+            return self._send(*args)
+        finally:
+            self.governor.release()
 
     def synchCommand(self, *args):
         "Decorator method for a synchronous command."
         self._log_command(args)
-        return self.ccs_subsystem.sendSynchCommand(*args)
+        return self._governed_send(None, args)
 
     def asynchCommand(self, *args):
-        "Decorator method for an asynchronous command."
+        """
+        Decorator method for an asynchronous command.  The command is
+        executed synchronously in a worker thread, and a CommandFuture
+        for its result is returned.
+        """
         self._log_command(args)
-        return self.ccs_subsystem.sendAsynchCommand(*args)
+        future = self.executor.submit(self._governed_send, time.time(), args)
+        future.args = args
+        return future
 
 CcsVersionInfo = namedtuple('CcsVersionInfo', 'project version rev')
 
+class CcsVersionCache(object):
+    """
+    Persistent cache of CcsVersionInfo records, keyed by CCS subsystem
+    name, so that jobs can reuse the version information retrieved by
+    earlier jobs instead of re-sending getDistributionInfo.
+
+    A cached record is considered valid if the result of the probe
+    command, e.g., one that returns the subsystem's build id or start
+    time, is unchanged, so that a restarted subsystem is queried
+    again.  If no probe command is given, nothing is sent to the
+    subsystem, and records are only valid for max_age seconds, so that
+    a restart goes unnoticed for at most that long.
+    """
+    def __init__(self, filename, probe_command=None, max_age=600):
+        """
+        Parameters
+        ----------
+        filename : str
+            JSON file containing the cached records.
+        probe_command : str, optional
+            CCS command whose result identifies the running build of a
+            subsystem.  Default: None.
+        max_age : float, optional
+            Lifetime in seconds of the cached records if probe_command
+            is None.  Default: 600.
+        """
+        self.filename = filename
+        self.probe_command = probe_command
+        self.max_age = max_age
+        self.entries = dict()
+        if os.path.isfile(filename):
+            try:
+                with open(filename) as fd:
+                    self.entries = json.load(fd)
+            except ValueError:
+                # Ignore a corrupted cache file.
+                pass
+        self._lock = threading.Lock()
+
+    def probe(self, subsystem):
+        """
+        Return the probe command result for the subsystem as a string,
+        or None if there is no probe command.
+        """
+        if self.probe_command is None:
+            return None
+        reply = CCS.attachSubsystem(subsystem)\
+                   .sendSynchCommand(self.probe_command)
+        try:
+            return str(reply.getResult())
+        except AttributeError:
+            return str(reply)
+
+    def get(self, subsystem, probe_value=None):
+        """
+        Return the cached CcsVersionInfo for the subsystem, or None if
+        there is no valid record.
+        """
+        with self._lock:
+            entry = self.entries.get(subsystem)
+        if entry is None:
+            return None
+        if self.probe_command is not None:
+            if entry['probe'] != probe_value:
+                return None
+        elif time.time() - entry['timestamp'] > self.max_age:
+            return None
+        return CcsVersionInfo(str(entry['project']), str(entry['version']),
+                              str(entry['rev']))
+
+    def update(self, subsystem, version_info, probe_value=None):
+        "Add or replace the record for a subsystem."
+        with self._lock:
+            self.entries[subsystem] = dict(project=version_info.project,
+                                           version=version_info.version,
+                                           rev=version_info.rev,
+                                           probe=probe_value,
+                                           timestamp=time.time())
+
+    def save(self):
+        "Write the cache file."
+        with self._lock:
+            write_json(self.filename, self.entries, indent=1)
+
+def _parallel_map(func, items, max_workers=8, timeout=None):
+    """
+    Apply func to each item using a bounded pool of daemon threads.
+
+    Parameters
+    ----------
+    func : callable
+        Function of a single argument.
+    items : sequence
+        The arguments to pass to func.
+    max_workers : int, optional
+        Maximum number of worker threads. Default: 8.
+    timeout : float, optional
+        Overall time in seconds to wait for the results.  Items that
+        have not completed by then are reported as timed out, and
+        their worker threads are abandoned.  Default: None (wait
+        indefinitely).
+
+    Returns
+    -------
+    list : (status, value) tuples in the same order as items, where
+        status is 'ok' (value is the return value of func), 'error'
+        (value is the exception raised) or 'timeout' (value is None).
+    """
+    items = list(items)
+    outcomes = [('timeout', None)]*len(items)
+    tasks = queue.Queue()
+    for index, item in enumerate(items):
+        tasks.put((index, item))
+    stop = threading.Event()
+
+    def worker():
+        while not stop.is_set():
+            try:
+                index, item = tasks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                outcomes[index] = ('ok', func(item))
+            except Exception as eobj:
+                outcomes[index] = ('error', eobj)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    if timeout is None:
+        for thread in threads:
+            thread.join()
+    else:
+        deadline = time.time() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+    stop.set()
+    return list(outcomes)
+
 class CcsSubsystems(object):
     """
     Container for collections of CCS subsystems.
     """
     def __init__(self, subsystems, logger=None,
-                 version_file='ccs_versions.txt'):
+                 version_file='ccs_versions.txt', max_workers=8,
+                 version_timeout=30, journal=None, recorder=None,
+                 version_cache=None, limits=None):
         """
         Constructor.
 
@@ -56,39 +660,134 @@ class CcsSubsystems(object):
             Text file to contain the CCS subsystem version information.
             This can be set to None to suppress writing the file.
             Default: 'ccs_versions.txt'.
+        max_workers : int, optional
+            Maximum number of subsystems to attach or query
+            concurrently for their version information and maximum
+            number of asynchronous commands to execute concurrently.
+            Default: 8.
+        version_timeout : float, optional
+            Time in seconds to wait for all of the subsystem attaches,
+            and then for all of the version information queries.
+            CcsCommandTimeout is raised if a subsystem cannot be
+            attached in time.  Subsystems that have not responded to
+            the version queries by then are recorded with placeholder
+            version info.  Default: 30.
+        journal : CommandJournal, optional
+            Journal to record the commands sent to the subsystems and
+            their latencies.  If None (default), a new CommandJournal
+            is created.
+        recorder : ccs_python_proxies.SessionRecorder, optional
+            Recorder of the commands sent to, and responses from, the
+            (non-proxy) subsystems for later replay.  Default: None.
+        version_cache : CcsVersionCache or str, optional
+            Cache, or the name of the cache file, of the version
+            information from previous jobs.  Subsystems with valid
+            cached records are not queried with getDistributionInfo.
+            A cache file name gives a CcsVersionCache without a probe
+            command, i.e., with the default max_age.
+            Default: None (always query).
+        limits : dict, optional
+            Dictionaries of CommandGovernor keyword arguments, e.g.,
+            dict(max_concurrent=1, rate=5.), keyed by the attribute
+            names in subsystems.  Subsystems with a max_concurrent
+            limit get their own worker threads for asynchronous
+            commands, so that their queued commands do not delay those
+            of other subsystems.  Default: None (no limits).
         """
         self._proxy_subsystems = ccs_python_proxies.CCS.subsystem_names
-        for key, value in subsystems.items():
-            if value in self._proxy_subsystems:
-                proxy_subsystem = ccs_python_proxies.CCS.attachSubsystem(value)
-                self.__dict__[key] = SubsystemDecorator(proxy_subsystem,
-                                                        logger=logger,
-                                                        name=value)
-                continue
-            self.__dict__[key] = SubsystemDecorator(CCS.attachSubsystem(value),
-                                                    logger=logger, name=value)
-        self._get_version_info(subsystems)
+        self._executor = CommandExecutor(max_workers)
+        if journal is None:
+            journal = CommandJournal()
+        self.journal = journal
+        if limits is None:
+            limits = dict()
+        items = list(subsystems.items())
+        attached = self._attach_subsystems([value for _, value in items],
+                                           max_workers=max_workers,
+                                           timeout=version_timeout)
+        for (key, value), ccs_subsystem in zip(items, attached):
+            if recorder is not None and value not in self._proxy_subsystems:
+                ccs_subsystem = recorder.wrap(ccs_subsystem, value)
+            executor = self._executor
+            governor = None
+            if key in limits:
+                governor = CommandGovernor(**limits[key])
+                if governor.max_concurrent is not None:
+                    executor = CommandExecutor(governor.max_concurrent)
+            self.__dict__[key] = SubsystemDecorator(ccs_subsystem,
+                                                    logger=logger, name=value,
+                                                    executor=executor,
+                                                    journal=journal,
+                                                    governor=governor)
+        if isinstance(version_cache, _string_types):
+            version_cache = CcsVersionCache(version_cache)
+        self._get_version_info(subsystems, max_workers=max_workers,
+                               timeout=version_timeout,
+                               version_cache=version_cache)
 
-    def _get_version_info(self, subsystems):
+    def _attach_subsystems(self, names, max_workers=8, timeout=30):
+        "Attach the named subsystems concurrently."
+        def attach(name):
+            if name in self._proxy_subsystems:
+                return ccs_python_proxies.CCS.attachSubsystem(name)
+            return CCS.attachSubsystem(name)
+        outcomes = _parallel_map(attach, names, max_workers=max_workers,
+                                 timeout=timeout)
+        for name, (status, value) in zip(names, outcomes):
+            if status == 'error':
+                raise value
+            if status == 'timeout':
+                raise CcsCommandTimeout("attachSubsystem %s did not complete "
+                                        "within %s s" % (name, timeout))
+        return [value for _, value in outcomes]
+
+    def _get_version_info(self, subsystems, max_workers=8, timeout=30,
+                          version_cache=None):
         # Version info is only available for "real" subsystems like
         # 'ts' or 'ts8-bench', not whatever things like
         # 'ts/Monochromator' are called in CCS parlance.  So extract
         # the parts before the '/' as the "real" subsystem names of
         # interest
-        real_subsystems = set([x.split('/')[0] for x in subsystems.values()
-                               if x not in self._proxy_subsystems])
+        real_subsystems = sorted(set([x.split('/')[0] for x in
+                                      subsystems.values()
+                                      if x not in self._proxy_subsystems]))
+        def query(subsystem):
+            if version_cache is None:
+                return self._query_version_info(subsystem)
+            probe_value = version_cache.probe(subsystem)
+            version_info = version_cache.get(subsystem, probe_value)
+            if version_info is None:
+                version_info = self._query_version_info(subsystem)
+                if version_info is not None:
+                    version_cache.update(subsystem, version_info,
+                                         probe_value)
+            return version_info
+        outcomes = _parallel_map(query, real_subsystems,
+                                 max_workers=max_workers, timeout=timeout)
         self.subsystems = OrderedDict()
-        for subsystem in real_subsystems:
-            print "getting info for subsystem - ",subsystem
-            my_subsystem = CCS.attachSubsystem(subsystem)
-            reply = my_subsystem.sendSynchCommand('getDistributionInfo')
-#            reply = my_subsystem('getDistributionInfo')
-            try:
-                result = reply.getResult().toString()
-                self.subsystems[subsystem] = self._parse_version_info(result)
-            except AttributeError:
-                # Running in python for unit tests.
-                pass
+        for subsystem, (status, value) in zip(real_subsystems, outcomes):
+            if status == 'ok':
+                if value is not None:
+                    self.subsystems[subsystem] = value
+                continue
+            print("getDistributionInfo %s for subsystem %s: %s"
+                  % (status, subsystem, value))
+            self.subsystems[subsystem] \
+                = CcsVersionInfo(subsystem, 'unavailable (%s)' % status, None)
+        if version_cache is not None:
+            version_cache.save()
+
+    @staticmethod
+    def _query_version_info(subsystem):
+        "Attach a subsystem and query its distribution info."
+        my_subsystem = CCS.attachSubsystem(subsystem)
+        reply = my_subsystem.sendSynchCommand('getDistributionInfo')
+        try:
+            result = reply.getResult().toString()
+        except AttributeError:
+            # Running in python for unit tests.
+            return None
+        return CcsSubsystems._parse_version_info(result)
 
     @staticmethod
     def _parse_version_info(ccs_result):
@@ -108,3 +807,25 @@ class CcsSubsystems(object):
         with open(outfile, 'w') as output:
             for key, value in self.subsystems.items():
                 output.write('%s = %s\n' % (value.project, value.version))
+
+    def queue_wait_stats(self):
+        """
+        Queue-wait statistics of the subsystems with command limits,
+        keyed by attribute name.
+        """
+        stats = OrderedDict()
+        for key, value in sorted(self.__dict__.items()):
+            if (isinstance(value, SubsystemDecorator)
+                    and value.governor is not None):
+                stats[key] = value.governor.stats()
+        return stats
+
+    def write_journal(self, outfile='ccs_commands.jsonl',
+                      summary_file='ccs_command_latencies.txt'):
+        """
+        Write the command journal and, if summary_file is not None,
+        the per-command latency summary.
+        """
+        self.journal.write(outfile)
+        if summary_file is not None:
+            self.journal.write_latency_summary(summary_file)
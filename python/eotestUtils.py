@@ -1,6 +1,5 @@
 from __future__ import print_function
 import os
-import shutil
 import socket
 import datetime
 import json
@@ -125,7 +124,9 @@ def eotestCalibsPersist(*keys, **kwds):
     """
     Loop through specified list of keys in eotest calibration config
     file and persist as lcatr.schema.filerefs.  Return the list of
-    filerefs.
+    filerefs.  The files are staged into the current directory with
+    siteUtils.stage_file, using the staging_methods keyword value, if
+    given.
     """
     pars = getEotestCalibs()
     results = []
@@ -134,7 +135,8 @@ def eotestCalibsPersist(*keys, **kwds):
         if filename is not None:
             if not os.path.isfile(filename):
                 raise RuntimeError("eotest calibration parameter %s = %s is not a valid file" % (key, filename))
-            shutil.copy(filename, '.')
+            siteUtils.stage_file(filename, os.path.basename(filename),
+                                 methods=kwds.get('staging_methods'))
             try:
                 md = kwds['metadata'][key]
             except KeyError:
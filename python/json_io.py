@@ -0,0 +1,45 @@
+"""
+Atomic writes of the JSON cache files shared by concurrent jobs.  This
+module only uses the standard library, so that it can be imported by
+both the jython scripts and the python harnessed jobs.
+"""
+import os
+import json
+import tempfile
+
+__all__ = ['write_json']
+
+# The permissions that open(filename, 'w') would give a new file.
+_umask = os.umask(0)
+os.umask(_umask)
+_file_mode = 0o666 & ~_umask
+
+def write_json(filename, obj, **kwds):
+    """
+    Write obj to filename as JSON, so that readers see either the
+    previous or the new contents.  The data are written to a uniquely
+    named temporary file in the same directory, which then replaces
+    filename, so that concurrent writers in other threads or
+    processes do not interfere.
+
+    Parameters
+    ----------
+    filename : str
+        The output file.
+    obj : JSON-serializable object
+        The data to write.
+    kwds : dict
+        Keyword arguments passed to json.dump, e.g., indent or default.
+    """
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    fd, tmpfile = tempfile.mkstemp(prefix=basename + '.', suffix='.tmp',
+                                   dir=dirname)
+    try:
+        with os.fdopen(fd, 'w') as output:
+            json.dump(obj, output, **kwds)
+        os.chmod(tmpfile, _file_mode)
+        os.rename(tmpfile, filename)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
@@ -3,102 +3,242 @@ Site-specific utilities for harnessed jobs.
 """
 from __future__ import print_function
 import os
+import re
 import sys
+import errno
+import time
 import glob
 import shutil
 import pickle
 import fnmatch
+import threading
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 import json
 try:
     import ConfigParser as configparser
 except ImportError:
     import configparser
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 import matplotlib.pyplot as plt
 import lcatr.schema
 import lcatr.harness.helpers
 from eTraveler.clientAPI.connection import Connection
+from ccs_geometry import wg_reb_name
+from json_io import write_json
 
 def getWGSlotNames(raft):
     wgslot = {}
     for slot,sensor_id in zip(raft.slot_names,raft.sensor_names):
-        if "ccd1" in slot or "ccd2" in slot :
-            wgslot[sensor_id] = 'WREB0'
-        elif "guidesensor1" in slot :
-            wgslot[sensor_id] = 'GREB0'
-        elif "guidesensor2" in slot  :
-            wgslot[sensor_id] = 'GREB1'
+        reb_name = wg_reb_name(slot)
+        if reb_name is not None:
+            wgslot[sensor_id] = reb_name
     return wgslot
 
-def getCCDNames():
+def _ccd_rows(hierarchy):
+    """
+    The (slot name, CCD serial number, hardware type) tuples of the CCD
+    entries in a getHardwareHierarchy response.
+    """
+    rows = []
+    for entry in hierarchy:
+        htype = str(entry.get('child_hardwareTypeName', ''))
+        if 'itl-ccd' in htype.lower() or 'e2v-ccd' in htype.lower():
+            rows.append((str(entry.get('slotName', '')),
+                         str(entry.get('child_experimentSN', '')), htype))
+    return rows
+
+def _ccd_names_cache_file():
+    "The CCD names cache file from LCATR_CCD_NAMES_CACHE, or None."
+    return os.getenv('LCATR_CCD_NAMES_CACHE')
+
+def _read_json_cache(cache_file):
+    if cache_file is None or not os.path.isfile(cache_file):
+        return dict()
+    try:
+        with open(cache_file) as fd:
+            return json.load(fd)
+    except ValueError:
+        # Ignore a corrupted cache file.
+        return dict()
+
+class ETravelerConnections(object):
+    """
+    Process-wide manager of authenticated eTraveler connections that
+    also memoizes the results of read-only queries.
+
+    The database, Prod or Dev, is chosen from LCATR_LIMS_URL when the
+    manager is created.  If cache_file is given, the memoized query
+    results are also written to that file, so that later jobs in the
+    same run can reuse them.
+    """
+    def __init__(self, cache_file=None, operator='homer'):
+        limsurl = os.getenv('LCATR_LIMS_URL', default='')
+        self.db_name = 'Prod' if '/Prod' in limsurl else 'Dev'
+        self.cache_file = cache_file
+        self.operator = operator
+        self.results = _read_json_cache(cache_file)
+        self._connections = dict()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    def connection(self, db_name=None, prodServer=False):
+        "Return the, possibly shared, Connection to the database."
+        if db_name is None:
+            db_name = self.db_name
+        key = (db_name, prodServer)
+        with self._lock:
+            if key not in self._connections:
+                print("Connecting to eTraveler %s" % db_name)
+                conn = Connection(self.operator, db_name,
+                                  prodServer=prodServer)
+                if not conn:
+                    raise RuntimeError('unable to authenticate')
+                self._connections[key] = conn
+            return self._connections[key]
+
+    def query(self, method, db_name=None, refresh=False, save=True, **kwds):
+        """
+        Return the result of a read-only Connection method, e.g.,
+        'getHardwareHierarchy', called with the keyword arguments.
+        Results are memoized unless refresh is True.  Exceptions are
+        not memoized.  If save is True, the memoized results are
+        written to the cache file, if there is one.  Batches of
+        concurrent queries should pass save=False and call save()
+        once they have completed.
+        """
+        if db_name is None:
+            db_name = self.db_name
+        key = json.dumps([db_name, method, kwds], sort_keys=True)
+        with self._lock:
+            if not refresh and key in self.results:
+                return self.results[key]
+        result = getattr(self.connection(db_name), method)(**kwds)
+        with self._lock:
+            self.results[key] = result
+        if save:
+            self.save()
+        return result
+
+    def getHardwareHierarchy(self, **kwds):
+        "Memoized Connection.getHardwareHierarchy."
+        return self.query('getHardwareHierarchy', **kwds)
+
+    def getManufacturerId(self, **kwds):
+        "Memoized Connection.getManufacturerId."
+        return self.query('getManufacturerId', **kwds)
+
+    def save(self):
+        "Write the memoized query results to the cache file, if any."
+        if self.cache_file is None:
+            return
+        with self._save_lock:
+            with self._lock:
+                results = dict(self.results)
+            try:
+                write_json(self.cache_file, results)
+            except (IOError, OSError, TypeError) as eobj:
+                print('Unable to write eTraveler query cache:', eobj)
+
+_etraveler_connections = None
+
+def eTraveler_connections():
+    """
+    Return the process-wide ETravelerConnections manager.  The query
+    cache file is taken from the LCATR_ETRAVELER_CACHE environment
+    variable, if it is set.
+    """
+    global _etraveler_connections
+    if _etraveler_connections is None:
+        _etraveler_connections = ETravelerConnections(
+            cache_file=os.getenv('LCATR_ETRAVELER_CACHE'))
+    return _etraveler_connections
+
+def getCCDNames(cache_file=None, max_age=86400, processes=None,
+                refresh=False):
+    """
+    Return dictionaries of the CCD serial numbers and manufacturer
+    serial numbers, keyed by slot name, of the unit under test.
+
+    If cache_file is given, or if cache_file is None and the
+    LCATR_CCD_NAMES_CACHE environment variable is set, the results are
+    cached in that file, keyed by unit id and eTraveler database, for
+    max_age seconds.  Otherwise, the eTraveler is always queried.  The
+    manufacturer ids are looked up concurrently on a pool of processes
+    threads.
+    """
     topdir = os.getcwd()
-    topparts = topdir.split('/')
-    activity_id = topparts[len(topparts)-1]
     if not topdir:
         raise RuntimeError('cannot determine top-level data directory')
-    limsurl = os.getenv('LCATR_LIMS_URL', default='')
-    if '/Prod' in limsurl:
-        print("Connecting to eTraveler Prod")
-        conn = Connection('homer', 'Prod', prodServer=False)
-    else:
-        print("Connecting to eTraveler Dev")
-        conn = Connection('homer', 'Dev', prodServer=False)
-    if not conn:
-        raise RuntimeError('unable to authenticate')
-
-    ccdnames = {}
-    ccdmanunames = {}
-    rsp = []
+    etraveler = eTraveler_connections()
+    db_name = etraveler.db_name
+
+    if cache_file is None:
+        cache_file = _ccd_names_cache_file()
+    cache_key = '%s:%s' % (db_name, getUnitId())
+    cache = _read_json_cache(cache_file)
+    entry = cache.get(cache_key)
+    if (not refresh and entry is not None
+            and time.time() - entry['timestamp'] < max_age):
+        return entry['ccdnames'], entry['ccdmanunames']
+
+    etraveler.connection()
     try:
-        rsp = conn.getHardwareHierarchy(experimentSN=getUnitId(),
-                                        htype=getUnitType(),
-                                        noBatched='false')
-        print("Results from getHardwareHierarchy unfiltered:")
-        iDict = 0
-        for d in rsp:
-#            print('Examining array element %d' % (iDict))
-            isaccd = False
-            ccd_sn = ""
-            ccd_slot = ""
-            ccd_htype = ""
-            ccd_manu_sn = ""
-            got_ccd_manu = False
-            for k in d:
-#                print('For key {0} value is {1}'.format(k, d[k]))
-                if ('child_hardwareTypeName' in str(k) and
-                    ('itl-ccd' in str(d[k].lower()) or
-                     'e2v-ccd' in str(d[k].lower()))):
-                    isaccd = True
-                    print("found CCD specs")
-                if isaccd and 'child_experimentSN' in str(k):
-                    ccd_sn = str(d[k])
-                    print("CCD SN = %s" % ccd_sn)
-                if isaccd and 'slotName' in str(k):
-                    ccd_slot = str(d[k])
-                    print("slot = %s" % ccd_slot)
-                if isaccd and 'child_hardwareTypeName' in str(k):
-                    ccd_htype = str(d[k])
-                if (isaccd and ccd_sn != "" and ccd_htype != "" and
-                    not got_ccd_manu):
-                    print("trying to get Manufacturer ID for ccd_sn=%s , ccd_htype=%s" % (ccd_sn, ccd_htype))
-                    try:
-                        ccd_manu_sn = conn.getManufacturerId(experimentSN=ccd_sn,
-                                                             htype=ccd_htype)
-                        print('Manufacturer ID: ', ccd_manu_sn)
-                        got_ccd_manu = True
-                    except ValueError as eobj:
-                        print('Operation failed with ValueError:', eobj)
-                    except Exception as eobj:
-                        print('Operation failed with exception:', eobj)
-                        sys.exit(1)
-            iDict += 1
-            if isaccd:
-                ccdnames[ccd_slot] = ccd_sn
-                ccdmanunames[ccd_slot] = ccd_manu_sn
+        rsp = etraveler.query('getHardwareHierarchy', refresh=refresh,
+                              experimentSN=getUnitId(),
+                              htype=getUnitType(), noBatched='false')
     except Exception as eobj:
         print('Operation failed with exception: ')
         print(str(eobj))
         sys.exit(1)
+    rows = _ccd_rows(rsp)
+
+    def get_manufacturer_id(row):
+        _, ccd_sn, ccd_htype = row
+        if ccd_sn == "" or ccd_htype == "":
+            return "", None
+        try:
+            return etraveler.query('getManufacturerId', refresh=refresh,
+                                   save=False, experimentSN=ccd_sn,
+                                   htype=ccd_htype), None
+        except ValueError as eobj:
+            print('Operation failed with ValueError:', eobj)
+            return "", None
+        except Exception as eobj:
+            return "", eobj
+
+    if processes is None:
+        processes = max(1, min(len(rows), 8))
+    pool = ThreadPool(processes)
+    try:
+        manu_ids = pool.map(get_manufacturer_id, rows)
+    finally:
+        pool.close()
+        pool.join()
+    etraveler.save()
+
+    ccdnames = {}
+    ccdmanunames = {}
+    for (ccd_slot, ccd_sn, _), (ccd_manu_sn, error) in zip(rows, manu_ids):
+        if error is not None:
+            print('Operation failed with exception:', error)
+            sys.exit(1)
+        print("slot = %s, CCD SN = %s, Manufacturer ID = %s"
+              % (ccd_slot, ccd_sn, ccd_manu_sn))
+        ccdnames[ccd_slot] = ccd_sn
+        ccdmanunames[ccd_slot] = ccd_manu_sn
+
+    if cache_file is not None and all(ccdmanunames.values()):
+        cache = _read_json_cache(cache_file)
+        cache[cache_key] = dict(timestamp=time.time(), ccdnames=ccdnames,
+                                ccdmanunames=ccdmanunames)
+        try:
+            write_json(cache_file, cache)
+        except (IOError, OSError) as eobj:
+            print('Unable to write CCD names cache:', eobj)
 
     print("Returning the following list of CCD names and locations")
     print("ccdnames")
@@ -216,14 +356,14 @@ def configDir():
         os.path.join(os.environ['HARNESSEDJOBSDIR'], 'config', getSiteName())
     return os.environ.get('LCATR_CONFIG_DIR', hj_config)
 
-def datacatalog_query(query, folder=None, site=None):
+def datacatalog_query(query, folder=None, site=None, job_id=None):
     from DataCatalog import DataCatalog
     if folder is None:
         folder = os.environ['LCATR_DATACATALOG_FOLDER']
     if site is None:
         site = getSiteName()
     datacat = DataCatalog(folder=folder, site=site)
-    return datacat.find_datasets(query)
+    return datacat.find_datasets(query, job_id=job_id)
 
 def print_file_list(description, file_list, use_basename=False):
     if description is not None:
@@ -247,16 +387,28 @@ def datacatalog_glob(pattern, testtype=None, imgtype=None, description=None,
     query = ' && '.join(('LSST_NUM=="%(sensor_id)s"',
                          'TESTTYPE=="%(testtype)s"',
                          'IMGTYPE=="%(imgtype)s"')) % locals()
-    datasets = datacatalog_query(query)
+    datasets = datacatalog_query(query, job_id=job_id)
+    # Index the matching paths by job id in a single pass over the
+    # datasets, keeping only the lists for the latest job seen so far
+    # if no job id was requested.
+    matches = re.compile(fnmatch.translate(pattern)).match
     file_lists = {}
-    for item in datasets.full_paths():
-        if fnmatch.fnmatch(os.path.basename(item), pattern):
-            my_job_id = extractJobId(item)
-            if my_job_id not in file_lists:
-                file_lists[my_job_id] = []
-            file_lists[my_job_id].append(item)
+    latest = None
+    for item in datasets.iter_full_paths():
+        if not matches(os.path.basename(item)):
+            continue
+        my_job_id = extractJobId(item)
+        if job_id is None:
+            if latest is not None and my_job_id < latest:
+                continue
+            if my_job_id != latest:
+                file_lists.clear()
+                latest = my_job_id
+        file_lists.setdefault(my_job_id, []).append(item)
     if job_id is None:
-        job_id = max(file_lists.keys())
+        if latest is None:
+            raise ValueError("No datasets found matching %s" % pattern)
+        job_id = latest
     file_list = file_lists[job_id]
     if sort:
         file_list = sorted(file_list)
@@ -308,18 +460,27 @@ def persist_ccs_versions(results, version_file='ccs_versions.txt'):
                                               version=tokens[1]))
     return results
 
-def persist_reb_info(results, reb_info_file='reb_info.txt'):
-    if not os.path.isfile(reb_info_file):
+def persist_reb_info(results, reb_info_file='reb_info.txt',
+                     reb_inventory=None):
+    """
+    Persist the REB names, firmware versions, and serial numbers from
+    the file written by ts8_utils.write_REB_info or, if it is given,
+    directly from a ts8_utils.RebInventory object.
+    """
+    if reb_inventory is not None:
+        rows = reb_inventory.rows()
+    elif not os.path.isfile(reb_info_file):
         raise RuntimeError("persist_reb_info: REB info file not found.")
+    else:
+        with open(reb_info_file) as fp:
+            rows = [line.strip().split() for line in fp]
     schema = lcatr.schema.get('REBVersionsBefore')
-    with open(reb_info_file) as fp:
-        kwds = dict()
-        for i, line in enumerate(fp):
-            reb_name, firmware, sn = line.strip().split()
-            kwds['REB%iname' % i] = reb_name
-            kwds['REB%ifirmware' % i] = firmware
-            kwds['REB%iSN' % i] = sn
-        results.append(lcatr.schema.valid(schema, **kwds))
+    kwds = dict()
+    for i, (reb_name, firmware, sn) in enumerate(rows):
+        kwds['REB%iname' % i] = reb_name
+        kwds['REB%ifirmware' % i] = firmware
+        kwds['REB%iSN' % i] = sn
+    results.append(lcatr.schema.valid(schema, **kwds))
     return results
 
 def jobInfo():
@@ -407,18 +568,212 @@ def aggregate_job_ids():
     pickle.dump(my_dependencies, open(pickle_file, 'w'))
     return my_dependencies
 
+# Linux FICLONE ioctl request number for reflinks (copy-on-write
+# clones) on btrfs, XFS, etc.
+_FICLONE = 0x40049409
+
+STAGING_METHODS = ('hardlink', 'reflink', 'copy')
+
+# The staging method used for each staged file, keyed by destination.
+staged_files = OrderedDict()
+
+def _reflink(src, dest):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported')
+    with open(src, 'rb') as src_fd:
+        with open(dest, 'wb') as dest_fd:
+            fcntl.ioctl(dest_fd.fileno(), _FICLONE, src_fd.fileno())
+    shutil.copymode(src, dest)
+
+def _staging_methods(methods=None):
+    if methods is None:
+        methods = os.environ.get('LCATR_STAGING_METHODS')
+    if methods is None:
+        return STAGING_METHODS
+    if isinstance(methods, str):
+        methods = [x.strip() for x in methods.split(',') if x.strip()]
+    for method in methods:
+        if method not in STAGING_METHODS:
+            raise ValueError("Invalid staging method: %s" % method)
+    return methods
+
+def stage_file(src, dest, methods=None):
+    """
+    Make the file src available at dest, using the first of the
+    staging methods that works: 'hardlink', 'reflink' (a copy-on-write
+    clone), or 'copy'.  Hard links and reflinks avoid copying the
+    data, but only work within a filesystem, and a hard link shares
+    later modifications with src.
+
+    Parameters
+    ----------
+    src : str
+        The file to stage.
+    dest : str
+        The destination path.  An existing file is replaced.
+    methods : sequence of str or str, optional
+        The methods to try, in order, as a sequence or comma-separated
+        string.  If None, the LCATR_STAGING_METHODS environment
+        variable is used, if it is set, or else STAGING_METHODS.
+
+    Returns
+    -------
+    str : The method used, or 'none' if dest is already src.
+    """
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src))
+    if os.path.exists(dest):
+        if os.path.samefile(src, dest):
+            staged_files[dest] = 'none'
+            return 'none'
+        os.remove(dest)
+    methods = _staging_methods(methods)
+    for i, method in enumerate(methods):
+        try:
+            if method == 'hardlink':
+                os.link(src, dest)
+            elif method == 'reflink':
+                _reflink(src, dest)
+            else:
+                shutil.copy(src, dest)
+        except (IOError, OSError):
+            if os.path.exists(dest):
+                os.remove(dest)
+            if i == len(methods) - 1:
+                raise
+            continue
+        staged_files[dest] = method
+        return method
+
 def make_fileref(current_path, folder=None, metadata=None,
-                 datatype='LSSTSENSORTEST'):
+                 datatype='LSSTSENSORTEST', staging_methods=None):
+    """
+    Return the lcatr.schema fileref for current_path, after staging
+    the file into folder, if it is given, with stage_file.
+    """
     if folder is not None:
         filename = os.path.basename(current_path)
         if not os.path.isdir(folder):
             os.mkdir(folder)
         new_path = os.path.join(folder, filename)
-        shutil.copy(current_path, new_path)
+        stage_file(current_path, new_path, methods=staging_methods)
         current_path = new_path
     return lcatr.schema.fileref.make(current_path, datatype=datatype,
                                      metadata=metadata)
 
+class FilerefCache(object):
+    """
+    Persistent cache of lcatr.schema filerefs, keyed by file path and
+    validated against the file size and modification time, so that
+    re-validation only needs to checksum new or changed files.
+    """
+    def __init__(self, cache_file='.fileref_cache.json'):
+        self.cache_file = cache_file
+        self.entries = dict()
+        if os.path.isfile(cache_file):
+            try:
+                with open(cache_file) as fd:
+                    self.entries = json.load(fd)
+            except ValueError:
+                # Ignore a corrupted cache file.
+                pass
+
+    @staticmethod
+    def _options(kwds):
+        return json.dumps(kwds, sort_keys=True)
+
+    def get(self, path, **kwds):
+        """
+        Return the cached fileref for path, or None if it is missing or
+        stale.  The keyword arguments are those passed to
+        lcatr.schema.fileref.make.
+        """
+        entry = self.entries.get(path)
+        if entry is None or entry['options'] != self._options(kwds):
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            return None
+        return entry['fileref']
+
+    def put(self, path, fileref, stat, **kwds):
+        "Add the fileref for path, given its os.stat result before hashing."
+        self.entries[path] = dict(size=stat.st_size, mtime=stat.st_mtime,
+                                  options=self._options(kwds),
+                                  fileref=dict(fileref))
+
+    def make(self, path, **kwds):
+        """
+        Return the fileref for path, creating it with
+        lcatr.schema.fileref.make and adding it to the cache if it is
+        missing or stale.
+        """
+        fileref = self.get(path, **kwds)
+        if fileref is None:
+            stat, fileref = _stat_and_make_fileref((path, kwds))
+            self.put(path, fileref, stat, **kwds)
+        return fileref
+
+    def save(self):
+        "Write the cache file."
+        write_json(self.cache_file, self.entries)
+
+def _stat_and_make_fileref(args):
+    path, kwds = args
+    stat = os.stat(path)
+    return stat, lcatr.schema.fileref.make(path, **kwds)
+
+def make_filerefs(files, processes=None, cache_file='.fileref_cache.json',
+                  **kwds):
+    """
+    Create lcatr.schema filerefs for a collection of files, computing
+    the checksums of new or changed files in parallel.
+
+    Parameters
+    ----------
+    files : sequence of str
+        The file paths.  Duplicates are removed.
+    processes : int, optional
+        Number of worker threads.  Default: None (number of cores).
+    cache_file : str, optional
+        The FilerefCache file.  If None, no cache is used.
+        Default: '.fileref_cache.json'.
+    **kwds :
+        Keyword arguments for lcatr.schema.fileref.make.
+
+    Returns
+    -------
+    list : The filerefs sorted by file path.
+    """
+    paths = sorted(set(files))
+    cache = FilerefCache(cache_file) if cache_file is not None else None
+    filerefs = dict()
+    todo = []
+    for path in paths:
+        fileref = cache.get(path, **kwds) if cache is not None else None
+        if fileref is None:
+            todo.append(path)
+        else:
+            filerefs[path] = fileref
+    if todo:
+        pool = ThreadPool(processes)
+        try:
+            outputs = pool.map(_stat_and_make_fileref,
+                               [(path, kwds) for path in todo])
+        finally:
+            pool.close()
+            pool.join()
+        for path, (stat, fileref) in zip(todo, outputs):
+            filerefs[path] = fileref
+            if cache is not None:
+                cache.put(path, fileref, stat, **kwds)
+        if cache is not None:
+            cache.save()
+    return [filerefs[path] for path in paths]
+
 def make_png_file(callback, png_file, *args, **kwds):
     try:
         result = callback(*args, **kwds)
@@ -441,7 +796,8 @@ def png_data_product(pngfile, lsst_num):
         pass
     return pngfile[len(file_prefix)+1:-len('.png')]
 
-def persist_png_files(file_pattern, lsst_id, folder=None, metadata=None):
+def persist_png_files(file_pattern, lsst_id, folder=None, metadata=None,
+                      staging_methods=None):
     if metadata is None:
         metadata = dict()
     md = DataCatalogMetadata(**metadata)
@@ -451,5 +807,6 @@ def persist_png_files(file_pattern, lsst_id, folder=None, metadata=None):
         dp = png_data_product(png_file, lsst_id)
         png_filerefs.append(make_fileref(png_file, folder=folder,
                                          metadata=md(DATA_PRODUCT=dp,
-                                                     LsstId=lsst_id)))
+                                                     LsstId=lsst_id),
+                                         staging_methods=staging_methods))
     return png_filerefs
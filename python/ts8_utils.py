@@ -1,13 +1,110 @@
 """
 Utilities to work with the ts8 subsystem.
 """
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from ccs_scripting_tools import CommandExecutor, wait_all, gather
+from ccs_geometry import CcsGeometry
 #try:
 #    from org.lsst.ccs.scripting import CCS
 #except ImportError:
 #    CCS = ccs_python_proxies.CCS
 
-def write_REB_info(ts8sub, outfile='reb_info.txt'):
+RebInfo = namedtuple('RebInfo', 'deviceName hwVersion serialNumber'.split())
+CcdInfo = namedtuple('CcdInfo', 'ccd_id reb_name temperature hv_bias'.split())
+
+# printGeometry output for the corner raft test stand.
+CR_GEOMETRY = ("--> GREB\n---> GREB.S10\n---> GREB.S11\n"
+               "--> WREB\n---> WREB.S00\n")
+
+_executor = CommandExecutor(max_workers=4)
+
+def _result(reply):
+    "Unwrap a command result from its response object if needed."
+    try:
+        return reply.getResult()
+    except AttributeError:
+        return reply
+
+def _command_result(ccs_sub, command):
+    """
+    Send a command to a CCS subsystem object or SubsystemDecorator and
+    return the result, unwrapping it from the response object if
+    needed.
+    """
+    try:
+        send = ccs_sub.sendSynchCommand
+    except AttributeError:
+        send = ccs_sub.synchCommand
+    return _result(send(command))
+
+class RebInventory(object):
+    """
+    Snapshot of the REB ids, device names, hardware versions, and
+    manufacturer serial numbers reported by the ts8 subsystem.  The
+    four list queries are sent concurrently, and the entries are
+    indexed by REB id and by device name.
+    """
+    _commands = ('getREBIds', 'getREBDevices', 'getREBHwVersions',
+                 'getREBSerialNumbers')
+
+    def __init__(self, ts8sub, timeout=60):
+        """
+        Parameters
+        ----------
+        ts8sub : CCS subsystem
+            The ts8 subsystem.
+        timeout : float, optional
+            Time in seconds to wait for the REB queries.  Default: 60.
+        """
+        self.ts8sub = ts8sub
+        self.timeout = timeout
+        self.refresh()
+
+    def refresh(self):
+        "Re-query the REB information from the ts8 subsystem."
+        futures = [_executor.submit(_command_result, self.ts8sub, command)
+                   for command in self._commands]
+        rebids, dev_names, hw_versions, serial_numbers \
+            = [list(x) for x in wait_all(futures, timeout=self.timeout)]
+        self.rebids = [x % 4 for x in rebids]
+        self.dev_names = [str(x) for x in dev_names]
+        self.hw_versions = hw_versions
+        self.serial_numbers = serial_numbers
+        self._index_by_id = dict([(rebid, i) for i, rebid
+                                  in enumerate(self.rebids)])
+        self._index_by_name = dict([(name, i) for i, name
+                                    in enumerate(self.dev_names)])
+
+    def __len__(self):
+        return len(self.rebids)
+
+    def _reb_info(self, index):
+        return RebInfo(self.dev_names[index], self.hw_versions[index],
+                       '%x' % self.serial_numbers[index])
+
+    def __getitem__(self, rebid):
+        "The RebInfo for the specified REB ID."
+        return self._reb_info(self._index_by_id[rebid])
+
+    def by_name(self, dev_name):
+        "The RebInfo for the specified REB device name."
+        return self._reb_info(self._index_by_name[dev_name])
+
+    def rows(self):
+        """
+        The (device name, firmware version, serial number) entries as
+        strings, with hex-formatted version and serial numbers.
+        """
+        return [(name, '%x' % fw_ver, '%x' % sn) for name, fw_ver, sn in
+                zip(self.dev_names, self.hw_versions, self.serial_numbers)]
+
+    def write(self, outfile):
+        "Write the REB info to a text file for persisting to the eT tables."
+        with open(outfile, 'w') as output:
+            for row in self.rows():
+                output.write('%s  %s  %s\n' % row)
+
+def write_REB_info(ts8sub, outfile='reb_info.txt', reb_inventory=None):
     """
     Write the REB device names, firmware versions, and manufacturer
     serial numbers to a text file for persisting to the eT tables.
@@ -19,22 +116,15 @@ def write_REB_info(ts8sub, outfile='reb_info.txt'):
     outfile : str, optional
         The name of the text file to contain the REB info.
         Default: 'reb_info.txt'.
+    reb_inventory : RebInventory, optional
+        Previously retrieved REB info.  If None (default), it is
+        queried from ts8sub.
     """
-#    ts8sub = CCS.attachSubsystem('cr-raft')
-
-    reb_names = ts8sub.sendSynchCommand( 'getREBDeviceNames')
-    print("reb_names = ",reb_names)
-#.getResult()
-    fw_vers = ts8sub.sendSynchCommand( 'getREBHwVersions')
-#.getResult()
-    SNs = ts8sub.sendSynchCommand( 'getREBSerialNumbers')
-#.getResult()
-    print("SNs = ",SNs)
-    with open(outfile, 'w') as output:
-        for reb_info in zip(reb_names, fw_vers, SNs):
-            output.write('%s  %x  %x\n' % reb_info)
-
-def get_REB_info(ts8sub, rebid):
+    if reb_inventory is None:
+        reb_inventory = RebInventory(ts8sub)
+    reb_inventory.write(outfile)
+
+def get_REB_info(ts8sub, rebid, reb_inventory=None):
     """
     Retrieve the REB device name, firmware version, and manufacturer
     serial number for the specified REB ID.
@@ -45,23 +135,39 @@ def get_REB_info(ts8sub, rebid):
         The ts8 subsystem.
     rebid : int
         The REB ID.
+    reb_inventory : RebInventory, optional
+        Previously retrieved REB info.  If None (default), it is
+        queried from ts8sub.
 
     Returns
     -------
     namedtuple : (REB device name, firmware version, serial number)
     """
-    RebInfo = namedtuple('RebInfo', 'deviceName hwVersion serialNumber'.split())
-    rebids = list(ts8sub.sendSynchCommand( 'getREBIds').getResult())
-    rebids[:] = [x % 4 for x in rebids]
-    dev_names = list(ts8sub.sendSynchCommand( 'getREBDevices').getResult())
-    hw_versions = list(ts8sub.sendSynchCommand( 'getREBHwVersions').getResult())
-    serial_numbers \
-        = ['%x' % x for x in
-           ts8sub.sendSynchCommand( 'getREBSerialNumbers').getResult()]
-    index = rebids.index(rebid)
-    return RebInfo(dev_names[index], hw_versions[index], serial_numbers[index])
-
-def set_ccd_info(ccs_sub, ccd_names, logger):
+    if reb_inventory is None:
+        reb_inventory = RebInventory(ts8sub)
+    return reb_inventory[rebid]
+
+def ccd_slot_map(geometry):
+    """
+    Map of CCD slot name to Ccd (CCD ID, REB name, CCD number on the
+    REB, slot name, raft name) for the first raft in the printGeometry
+    output.  The parsed geometry is cached for the session.
+
+    Parameters
+    ----------
+    geometry : str or ccs_geometry.CcsGeometry
+        Output of the ts8 'printGeometry 3' command or the geometry
+        model created from it.
+
+    Returns
+    -------
+    OrderedDict : Ccd tuples keyed by slot name, e.g., 'S20'.
+    """
+    if not isinstance(geometry, CcsGeometry):
+        geometry = CcsGeometry.from_text(geometry)
+    return geometry.slot_map()
+
+def set_ccd_info(ccs_sub, ccd_names, logger, geometry=None, timeout=60):
     """
     Set the CCD serial numbers in the CCS code.  Get the CCD
     temperature and BSS voltages from the ts8 and ccs-rebps
@@ -76,71 +182,92 @@ def set_ccd_info(ccs_sub, ccd_names, logger):
         .maufacturer_sn information, keyed by slot name.
     logger : logging.Logger
         Log commands using the logger.info(...) function.
+    geometry : str or ccs_geometry.CcsGeometry, optional
+        Output of the ts8 'printGeometry 3' command, e.g., from
+        CcsGeometry.from_subsystem(ccs_sub.ts8).  If None (default),
+        the corner raft geometry, CR_GEOMETRY, is used.
+    timeout : float, optional
+        Time in seconds to wait for each batch of commands.
+        Default: 60.
+
+    Returns
+    -------
+    OrderedDict : CcdInfo tuples keyed by slot name.  The temperature
+        or hv_bias is None if it could not be read.
 
     Notes
     -----
     This is function is a refactored version of
-    harnessed-jobs/python/eolib.EOTS8SetupCCDInfo.
+    harnessed-jobs/python/eolib.EOTS8SetupCCDInfo.  The temperatures,
+    and the BSS voltage of each REB<n>.hvbias.VbefSwch channel of the
+    rebps subsystem, if there is one, are read concurrently in one
+    batch.  The header keyword and measured BSS settings are sent in a
+    second batch.  A failed command is logged and skipped, so that it
+    does not prevent the other values from being set.
     """
-    # Parse the printGeometry output to map CCD values to REBs.
-#    geo = ccs_sub.ts8.sendSynchCommand( "printGeometry 3").getResult()
-    geo = "--> GREB\n---> GREB.S10\n---> GREB.S11\n--> WREB\n---> WREB.S00\n"
-#--> R00
-#---> R00.Reb2
-#----> R00.Reb2.S20
-#----> R00.Reb2.S21
-#----> R00.Reb2.S22
-#---> R00.Reb1
-#----> R00.Reb1.S10
-
-    for line in geo.split('\n'):
-        # The lines with the CCD IDs and slot names will be of the form
-        # '---> R00.Reb2.S20'.  So we'll extract the last three
-        # non-whitespace letters to get the slot name and the full
-        # entry to get the CCD ID.
-        my_line = line.strip()     # remove any trailing whitespace
-        slot = my_line.split('.')[-1]
-
-        if len(slot) != 3 or slot[0] != 'S':
+    if geometry is None:
+        geometry = CR_GEOMETRY
+    slots = OrderedDict([(slot, ccd_slot) for slot, ccd_slot
+                         in ccd_slot_map(geometry).items()
+                         if slot in ccd_names])
+
+    # Read the CCD temperatures and the BSS voltage of each REB.  The
+    # REB number is the first digit of the slot name.
+    readings = [('CCDTemp', slot, ccs_sub.ts8,
+                 '%s.CCDTemp%d' % (ccd_slot.reb_name, ccd_slot.ccd_num))
+                for slot, ccd_slot in slots.items()
+                if ccd_slot.ccd_num is not None]
+    rebps = getattr(ccs_sub, 'rebps', None)
+    if rebps is not None:
+        reb_ids = []
+        for slot in slots:
+            if slot[1].isdigit() and slot[1] not in reb_ids:
+                reb_ids.append(slot[1])
+        readings.extend([('hvbias', reb_id, rebps,
+                          'REB%s.hvbias.VbefSwch' % reb_id)
+                         for reb_id in reb_ids])
+    requests = [(subsystem, 'getChannelValue', channel)
+                for _, _, subsystem, channel in readings]
+    values = dict()
+    for (quantity, key, _, channel), reply \
+            in zip(readings, gather(requests, timeout=timeout,
+                                    return_exceptions=True)):
+        if isinstance(reply, Exception):
+            _log_failure(logger, 'getChannelValue %s' % channel, reply)
             continue
-        print "slot = ",slot
+        values[(quantity, key)] = _result(reply)
 
-        ccd_id = my_line.split(' ')[1]
+    # Set the CCD-specific header keywords and the measured BSS.
+    ccd_info = OrderedDict()
+    requests = []
+    for slot, ccd_slot in slots.items():
         sensor = ccd_names[slot]
+        ccdtemp = values.get(('CCDTemp', slot))
+        hv_bias = values.get(('hvbias', slot[1]))
+        ccd_info[slot] = CcdInfo(ccd_slot.ccd_id, ccd_slot.reb_name,
+                                 ccdtemp, hv_bias)
+        keywords = [('CCDSerialLSST', sensor.sensor_id),
+                    ('CCDSerialManufacturer', sensor.manufacturer_sn)]
+        if ccdtemp is not None:
+            keywords.append(('MeasuredTemperature', ccdtemp))
+        requests.extend([(ccs_sub.ts8, 'ccdSpecificHeaderKeywords', keyword,
+                          ccd_slot.ccd_id, value)
+                         for keyword, value in keywords])
+        if hv_bias is not None:
+            requests.append((ccs_sub.ts8, 'setMeasuredCCDBSS',
+                             ccd_slot.ccd_id, hv_bias))
+    for request, reply in zip(requests,
+                              gather(requests, timeout=timeout,
+                                     return_exceptions=True)):
+        if isinstance(reply, Exception):
+            _log_failure(logger, ' '.join(str(x) for x in request[1:4]),
+                         reply)
+    return ccd_info
 
-        # Set the LSST serial number.
-#        command = 'setLsstSerialNumber %s %s' % (ccd_id, sensor.sensor_id)
-#need something to make a map of ccdSpecificHeaderKeywords
-        command = 'ccdSpecificHeaderKeywords CCDSerialLSST  %s %s' % (ccd_id, sensor.sensor_id)
-
-#        ccs_sub.ts8.sendSynchCommand( command)
-
-        # Set the manufacturer serial number.
-#        command = ('setManufacturerSerialNumber %s %s'
-#                   % (ccd_id, sensor.manufacturer_sn))
-        command = 'ccdSpecificHeaderKeywords CCDSerialManufacturer  %s %s' % (ccd_id, sensor.sensor_id)
-#fix        ccs_sub.ts8.sendSynchCommand( command)
-
-        # Set the CCD temperature.
-#        reb_id = int(slot[1])
-#        ccd_num = int(slot[2])
-        
-        rebname = my_line.split('.')[0].split(' ')[1]
-        ccd_num = int(slot[2])
-
-        print("rebname = ",rebname)
-        print("ccd_num = ",ccd_num)
-
-#        command = "getChannelValue R00.Reb%d.CCDTemp%d" % (reb_id, ccd_num)
-        command = "getChannelValue %s.CCDTemp%d" % (rebname, ccd_num)
-        ccdtemp = ccs_sub.ts8.sendSynchCommand( command)
-#.getResult()
-#        command = "setMeasuredCCDTemperature %s %s" % (ccd_id, ccdtemp)
-        command = 'ccdSpecificHeaderKeywords MeasuredTemperature %s %s' % (ccd_id, sensor.sensor_id)
-#fix        ccs_sub.ts8.sendSynchCommand( command)
-
-        # Set the BSS voltage.
-#        command = "getChannelValue REB%s.hvbias.VbefSwch"  % reb_id
-#        hv = ccs_sub.rebps.sendSynchCommand( command).getResult()
-#        command = "setMeasuredCCDBSS %s %s" % (ccd_id, hv)
-#        ccs_sub.ts8.sendSynchCommand( command)
+def _log_failure(logger, description, eobj):
+    "Report a failed command with logger, or print it if there is none."
+    message = '%s failed: %s' % (description, eobj)
+    if logger is None:
+        print(message)
+    else:
+        logger.info(message)
@@ -0,0 +1,423 @@
+"""
+Unit tests for DataCatalog module.
+"""
+import os
+import shutil
+import hashlib
+import unittest
+import DataCatalog
+
+class Location(object):
+    def __init__(self, site, resource, size=None, checksum=None):
+        self.site = site
+        self.resource = resource
+        self.size = size
+        self.checksum = checksum
+
+class Dataset(object):
+    def __init__(self, job_id, name, metadata=None):
+        self.name = name
+        self.path = '/LSST/mirror/SLAC/fe55_acq/v0/%s/%s' % (job_id, name)
+        self.locations = [Location('BNL', '/bnl/%s/%s' % (job_id, name)),
+                          Location('SLAC', '/slac/%s/%s' % (job_id, name))]
+        self.metadata = metadata
+
+class Client(object):
+    def __init__(self, datasets, recursive_only=False, max_page=None):
+        self.datasets = datasets
+        self.recursive_only = recursive_only
+        self.max_page = max_page
+        self.searches = []
+    def search(self, path, query=None, offset=None, max_num=None):
+        self.searches.append((path, query, offset))
+        if self.recursive_only and not path.endswith('**'):
+            return []
+        if offset is None:
+            return list(self.datasets)
+        if self.max_page is not None:
+            max_num = min(max_num, self.max_page)
+        return self.datasets[offset:offset + max_num]
+
+class DatasetListTestCase(unittest.TestCase):
+    "TestCase class for DatasetList selections."
+    def setUp(self):
+        class Catalog(object):
+            folder = '/LSST/mirror/SLAC'
+            remote_login = 'user'
+            site = 'SLAC'
+        self.catalog = Catalog()
+        self.datasets = [Dataset(job_id, 'flat_%02i.fits' % i,
+                                 metadata=dict(EXPTIME=i*2.5,
+                                               IMGTYPE='FLAT'))
+                         for job_id in ('998', '1020', '1100')
+                         for i in range(4)]
+
+    def test_select(self):
+        "Test equality, set, range, and metadata selections."
+        datasets = DataCatalog.DatasetList(self.datasets, self.catalog,
+                                           job_id=set([998, 1100]))
+        self.assertEqual(len(datasets), 8)
+        self.assertEqual(sorted(set(datasets.job_ids())), ['1100', '998'])
+        self.assertEqual(datasets.full_paths(job_id='998')[0],
+                         '/slac/998/flat_00.fits')
+        self.assertEqual(datasets.filenames(job_id=DataCatalog.Range(1000),
+                                            EXPTIME=DataCatalog.Range(5)),
+                         ['flat_02.fits', 'flat_03.fits'])
+        self.assertEqual(len(datasets.select(IMGTYPE='FLAT',
+                                             job_name='fe55_acq')), 8)
+        self.assertEqual(datasets.select(IMGTYPE='BIAS'), [])
+        self.assertEqual(len(datasets.full_paths(job_id=['998', '1020'])), 4)
+
+    def test_columns(self):
+        "Test column access, mask selection, and pickling."
+        datasets = DataCatalog.DatasetList(self.datasets, self.catalog,
+                                           metadata_fields=('EXPTIME',))
+        self.assertTrue(all(isinstance(x, DataCatalog.DatasetRecord)
+                            for x in datasets))
+        self.assertEqual(datasets[0].metadata, dict(EXPTIME=0))
+        self.assertEqual(datasets.column('name')[:2],
+                         ['flat_00.fits', 'flat_00.fits'])
+        self.assertEqual(datasets.resources()[0], '/slac/998/flat_00.fits')
+        self.assertEqual(datasets.resources('BNL')[0],
+                         '/bnl/998/flat_00.fits')
+        mask = datasets.mask(job_id='998')
+        self.assertEqual(sum(mask), 4)
+        subset = datasets.subset(mask)
+        self.assertEqual(subset.job_ids(), ['998']*4)
+        self.assertEqual(subset.filenames(EXPTIME=DataCatalog.Range(5)),
+                         ['flat_02.fits', 'flat_03.fits'])
+
+        pickle_file = 'test_dataset_list.pickle'
+        try:
+            subset.save(pickle_file)
+            restored = DataCatalog.DatasetList.load(pickle_file)
+        finally:
+            os.remove(pickle_file)
+        self.assertEqual(list(restored), list(subset))
+        self.assertEqual(restored.site, 'SLAC')
+        self.assertEqual(restored.full_paths(), subset.full_paths())
+
+    def test_subset_mutation(self):
+        "Test that subsets and restored lists follow in-place changes."
+        datasets = DataCatalog.DatasetList(self.datasets, self.catalog)
+        subset = datasets.subset(datasets.mask(job_id='1100'))
+        subset[0] = datasets[0]
+        self.assertEqual(subset.job_ids(), ['998'] + ['1100']*3)
+        self.assertEqual(subset.full_paths(job_id='998'),
+                         ['/slac/998/flat_00.fits'])
+        self.assertEqual(len(datasets.select(job_id='998')), 4)
+
+        pickle_file = 'test_dataset_list.pickle'
+        try:
+            subset.save(pickle_file)
+            restored = DataCatalog.DatasetList.load(pickle_file)
+        finally:
+            os.remove(pickle_file)
+        restored[1:3] = restored[2:0:-1]
+        self.assertEqual(restored.full_paths(job_id='1100'),
+                         ['/slac/1100/flat_02.fits',
+                          '/slac/1100/flat_01.fits',
+                          '/slac/1100/flat_03.fits'])
+
+    def test_in_place_sort(self):
+        "Test that selections follow in-place changes to the list."
+        datasets = DataCatalog.DatasetList(self.datasets, self.catalog)
+        self.assertEqual(datasets.job_ids()[0], '998')
+        datasets.sort(key=lambda x: int(x.path.split('/')[-2]),
+                      reverse=True)
+        self.assertEqual(datasets.job_ids()[0], '1100')
+        self.assertTrue(all('/998/' in x.path
+                            for x in datasets.select(job_id='998')))
+        self.assertEqual(datasets.full_paths(job_id='998')[0],
+                         '/slac/998/flat_00.fits')
+
+class DownloadTestCase(unittest.TestCase):
+    "TestCase class for DatasetList.download."
+    def setUp(self):
+        self.remote_dir = 'test_remote_dir'
+        self.rootpath = 'test_download_dir'
+        os.makedirs(os.path.join(self.remote_dir, '1020'))
+        self.datasets = []
+        for i in range(5):
+            name = 'dark_%02i.fits' % i
+            data = ('dark exposure %i\n' % i).encode('utf-8')
+            resource = os.path.join(self.remote_dir, '1020', name)
+            with open(resource, 'wb') as output:
+                output.write(data)
+            dataset = Dataset('1020', name)
+            checksum = hashlib.md5(data).hexdigest()
+            if i == 4:
+                checksum = hashlib.md5(b'other data').hexdigest()
+            elif i == 3:
+                checksum = 'unknown checksum format'
+            elif i == 2:
+                checksum = hashlib.sha1(data).hexdigest().upper()
+            dataset.locations = [Location('SLAC', resource, len(data),
+                                          checksum)]
+            self.datasets.append(dataset)
+        self.commands = []
+        def call(command):
+            # Emulate rsync by copying the files locally.
+            self.commands.append(command)
+            files_from = [x for x in command
+                          if x.startswith('--files-from=')][0][13:]
+            remote, local = command[-2:]
+            remote = remote.split(':', 1)[1]
+            with open(files_from) as fd:
+                for line in fd:
+                    shutil.copy(os.path.join(remote, line.strip()), local)
+            return 0
+        self.call = DataCatalog.subprocess.call
+        DataCatalog.subprocess.call = call
+        class Catalog(object):
+            folder = '/LSST/mirror/SLAC'
+            remote_login = 'user'
+            site = 'SLAC'
+        self.catalog = Catalog()
+
+    def tearDown(self):
+        DataCatalog.subprocess.call = self.call
+        for item in (self.remote_dir, self.rootpath):
+            if os.path.isdir(item):
+                shutil.rmtree(item)
+
+    def test_download(self):
+        "Test batched downloads, verification, and skipping existing files."
+        datasets = DataCatalog.DatasetList(self.datasets, self.catalog)
+        summary = datasets.download(rootpath=self.rootpath, dryrun=True)
+        self.assertEqual(self.commands, [])
+        self.assertEqual(summary['nfiles'], 0)
+
+        summary = datasets.download(rootpath=self.rootpath, dryrun=False,
+                                    nfiles=4, batch_size=3)
+        self.assertEqual(len(self.commands), 2)
+        self.assertEqual(summary['nfiles'], 4)
+        self.assertEqual(summary['failed'], [])
+
+        summary = datasets.download(rootpath=self.rootpath, dryrun=False)
+        self.assertEqual(len(self.commands), 3)
+        self.assertEqual(summary['nfiles'], 0)
+        self.assertEqual(len(summary['failed']), 1)
+        self.assertFalse(os.path.isfile(summary['failed'][0]))
+        self.assertTrue(os.path.isfile(summary['failed'][0] + '.failed'))
+
+        summary = datasets.download(rootpath=self.rootpath, dryrun=False,
+                                    nfiles=2, clobber=True)
+        self.assertEqual(summary['nfiles'], 2)
+
+    def test_download_after_sort(self):
+        "Test that downloads follow in-place changes to the list."
+        datasets = DataCatalog.DatasetList(self.datasets[:4], self.catalog)
+        self.assertEqual(datasets.column('name')[0], 'dark_00.fits')
+        datasets.reverse()
+        summary = datasets.download(rootpath=self.rootpath, dryrun=False,
+                                    nfiles=1)
+        self.assertEqual(summary['nfiles'], 1)
+        self.assertEqual(summary['failed'], [])
+        output = os.path.join(self.rootpath, 'fe55_acq', 'v0', '1020',
+                              'dark_03.fits')
+        with open(output) as fd:
+            self.assertEqual(fd.read(), 'dark exposure 3\n')
+
+class MirrorIndexTestCase(unittest.TestCase):
+    "TestCase class for MirrorIndex."
+    def setUp(self):
+        self.mirror = 'test_mirror'
+        self.index_file = 'test_mirror_index.json'
+        self.job_dir = os.path.join(self.mirror, 'fe55_acq', 'v0', '1020')
+        os.makedirs(self.job_dir)
+        for i in range(3):
+            with open(os.path.join(self.job_dir, 'fe55_%02i.fits' % i),
+                      'w') as output:
+                output.write('fe55 exposure\n')
+        self.listdir = os.listdir
+        self.listed = []
+        def listdir(path):
+            self.listed.append(path)
+            return self.listdir(path)
+        os.listdir = listdir
+
+    def tearDown(self):
+        os.listdir = self.listdir
+        shutil.rmtree(self.mirror)
+        if os.path.isfile(self.index_file):
+            os.remove(self.index_file)
+
+    def test_mirror_index(self):
+        "Test the incremental index and local path resolution."
+        folder = '/LSST/mirror/SLAC'
+        os.symlink(os.path.abspath(self.mirror),
+                   os.path.join(self.job_dir, 'loop'))
+        index = DataCatalog.MirrorIndex([self.mirror],
+                                        index_file=self.index_file)
+        self.assertEqual(self.listed, [])
+        self.assertEqual(sorted(index.files[(None, os.path.abspath(
+            self.mirror))].keys()),
+                         ['fe55_acq/v0/1020/fe55_%02i.fits' % i
+                          for i in range(3)])
+        dataset = Dataset('1020', 'fe55_01.fits')
+        for location in dataset.locations:
+            location.size = 14
+        local_path = index.local_path(dataset.path, folder, 14)
+        self.assertEqual(local_path, os.path.abspath(
+            os.path.join(self.job_dir, 'fe55_01.fits')))
+        self.assertEqual(index.local_path(dataset.path, folder, 1), None)
+        self.assertEqual(index.local_path(dataset.path, folder, None), None)
+        self.assertEqual(index.local_path(dataset.path, '/LSST/mirror/BNL3',
+                                          14), None)
+        self.assertEqual(index.local_path(Dataset('998', 'fe55_01.fits').path,
+                                          folder, 14), None)
+
+        # A root bound to another folder is not used.
+        bound = DataCatalog.MirrorIndex([('/LSST/mirror/BNL3', self.mirror)])
+        self.assertEqual(bound.local_path(dataset.path, folder, 14), None)
+
+        # The default index is created once per process, and built lazily.
+        saved_env = dict((key, os.environ.get(key)) for key in
+                         ('DATACAT_MIRROR_ROOTS', 'DATACAT_MIRROR_INDEX'))
+        os.environ['DATACAT_MIRROR_ROOTS'] = '%s=%s' % (folder, self.mirror)
+        os.environ['DATACAT_MIRROR_INDEX'] = self.index_file
+        try:
+            default_index = DataCatalog._default_mirror_index()
+            self.assertIs(DataCatalog._default_mirror_index(), default_index)
+            self.assertEqual(default_index.dirs, None)
+        finally:
+            for key, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+        self.assertEqual(default_index.local_path(dataset.path, None, 14),
+                         local_path)
+
+        # A new index reuses the saved listings of unchanged directories.
+        self.listed[:] = []
+        index = DataCatalog.MirrorIndex([self.mirror],
+                                        index_file=self.index_file)
+        self.assertEqual(len(index.files[(None, os.path.abspath(
+            self.mirror))]), 3)
+        self.assertEqual(self.listed, [])
+
+        class Catalog(object):
+            folder = '/LSST/mirror/SLAC'
+            remote_login = 'user'
+            site = 'SLAC'
+            mirror_index = index
+        datasets = DataCatalog.DatasetList([dataset, Dataset('1020', 'x')],
+                                           Catalog())
+        self.assertEqual(datasets.full_paths(),
+                         [local_path, '/slac/1020/x'])
+        self.assertEqual(datasets.full_paths(prefer_local=False)[0],
+                         '/slac/1020/fe55_01.fits')
+        rootpath = os.path.join(self.mirror, 'download')
+        summary = datasets.download(rootpath=rootpath, dryrun=False,
+                                    nfiles=1)
+        self.assertEqual(summary['nfiles'], 0)
+        output = os.path.join(rootpath, 'fe55_acq/v0/1020/fe55_01.fits')
+        self.assertEqual(os.path.realpath(output), os.path.realpath(local_path))
+
+class SearchTestCase(unittest.TestCase):
+    "TestCase class for concurrent and paginated searches."
+    def setUp(self):
+        self.datasets = [Dataset('1020', 'dark_%02i.fits' % i)
+                         for i in range(25)]
+
+    def _datacatalog(self, client):
+        datacat = DataCatalog.DataCatalog(folder='/LSST/mirror/SLAC',
+                                          remote_login='user', cache_ttl=0)
+        datacat.client = client
+        return datacat
+
+    def test_concurrent(self):
+        "Test the concurrent recursive-search fallback."
+        client = Client(self.datasets, recursive_only=True)
+        datasets = self._datacatalog(client).find_datasets('', concurrent=True)
+        self.assertEqual(len(datasets), 25)
+        self.assertEqual(sorted(x[0] for x in client.searches),
+                         ['/LSST/mirror/SLAC', '/LSST/mirror/SLAC/**'])
+
+    def test_iter_datasets(self):
+        "Test the paginated iterator."
+        client = Client(self.datasets)
+        names = [x.name for x in
+                 self._datacatalog(client).iter_datasets('', page_size=10)]
+        self.assertEqual(names, [x.name for x in self.datasets])
+        self.assertEqual([x[2] for x in client.searches], [0, 10, 20, 25])
+
+        # Pages truncated by a server-side limit are followed.
+        client = Client(self.datasets, max_page=4)
+        names = [x.name for x in
+                 self._datacatalog(client).iter_datasets('', page_size=10)]
+        self.assertEqual(names, [x.name for x in self.datasets])
+        self.assertEqual([x[2] for x in client.searches],
+                         [0, 4, 8, 12, 16, 20, 24, 25])
+
+        client = Client(self.datasets, recursive_only=True)
+        names = [x.name for x in
+                 self._datacatalog(client).iter_datasets('', page_size=25)]
+        self.assertEqual(len(names), 25)
+        self.assertEqual([x[0] for x in client.searches],
+                         ['/LSST/mirror/SLAC', '/LSST/mirror/SLAC/**',
+                          '/LSST/mirror/SLAC/**'])
+
+class QueryCacheTestCase(unittest.TestCase):
+    "TestCase class for the find_datasets query cache."
+    def setUp(self):
+        self.cache_dir = 'test_datacat_cache'
+        datasets = [Dataset('1020', 'fe55_%02i.fits' % i,
+                            metadata=dict(TESTTYPE='FE55'))
+                    for i in range(3)]
+        datasets.append(Dataset('1030', 'fe55_00.fits'))
+        self.client = Client(datasets)
+
+    def tearDown(self):
+        if os.path.isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def _datacatalog(self, **kwds):
+        datacat = DataCatalog.DataCatalog(folder='/LSST/mirror/SLAC',
+                                          remote_login='user',
+                                          cache_dir=self.cache_dir, **kwds)
+        datacat.client = self.client
+        return datacat
+
+    def test_find_datasets(self):
+        "Test that repeated queries are served from the cache."
+        query = 'LSST_NUM=="ITL-3800C-023" && TESTTYPE=="FE55"'
+        datasets = self._datacatalog().find_datasets(query)
+        self.assertEqual(len(self.client.searches), 1)
+        expected = datasets.full_paths()
+        self.assertEqual(expected[0], '/slac/1020/fe55_00.fits')
+
+        datasets = self._datacatalog().find_datasets(query, job_id='1020')
+        self.assertEqual(len(self.client.searches), 1)
+        self.assertEqual(datasets.full_paths(),
+                         [x for x in expected if '/1020/' in x])
+        self.assertEqual(datasets[0].metadata, dict(TESTTYPE='FE55'))
+
+        self._datacatalog().find_datasets(query, refresh=True)
+        self.assertEqual(len(self.client.searches), 2)
+        self._datacatalog().find_datasets(query + ' && IMGTYPE=="FE55"')
+        self.assertEqual(len(self.client.searches), 3)
+        self._datacatalog(cache_ttl=0).find_datasets(query)
+        self.assertEqual(len(self.client.searches), 4)
+
+    def test_opt_in(self):
+        "Test that the cache is only used if a directory is given."
+        cache_dir = os.environ.pop('DATACAT_CACHE_DIR', None)
+        try:
+            datacat = DataCatalog.DataCatalog(folder='/LSST/mirror/SLAC',
+                                              remote_login='user')
+            self.assertEqual(datacat.query_cache, None)
+            os.environ['DATACAT_CACHE_DIR'] = self.cache_dir
+            datacat = DataCatalog.DataCatalog(folder='/LSST/mirror/SLAC',
+                                              remote_login='user')
+            self.assertEqual(datacat.query_cache.cache_dir, self.cache_dir)
+        finally:
+            if cache_dir is None:
+                os.environ.pop('DATACAT_CACHE_DIR', None)
+            else:
+                os.environ['DATACAT_CACHE_DIR'] = cache_dir
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,7 @@
 "Unit tests for ccsTools module."
 import os
+import time
+import threading
 import unittest
 import ccsTools
 
@@ -15,6 +17,9 @@ class CcsSubsystemMappingTestCase(unittest.TestCase):
             output.write('pd = ts/PhotoDiode\n')
             output.write('mono = ts/Monochromator\n')
             output.write('rebps = ccs-rebps\n')
+            output.write('[ccs_subsystem_limits]\n')
+            output.write('rebps = max_concurrent=1, rate=5, burst=2\n')
+            output.write('mono = max_concurrent=1\n')
 
     def tearDown(self):
         try:
@@ -66,5 +71,266 @@ subsystems['rebps'] = 'ccs-rebps'
         self.assertEqual(len(commands), 1)
         self.assertEqual(commands[0], 'subsystems = None')
 
+    def test_ccs_subsystem_limits(self):
+        "Test code for ccs_subsystem_limits function."
+        limits = ccsTools.ccs_subsystem_limits(self.config_file)
+        self.assertEqual(list(limits.keys()), ['rebps', 'mono'])
+        self.assertEqual(limits['rebps'],
+                         dict(max_concurrent=1, rate=5., burst=2))
+        self.assertEqual(limits['mono'], dict(max_concurrent=1))
+        self.assertEqual(ccsTools.ccs_subsystem_limits(
+            self.config_file, section='no_such_section'), None)
+
+        os.environ['LCATR_CCS_SUBSYSTEM_CONFIG'] = self.config_file
+        commands = ccsTools.CcsSetup.set_ccs_subsystem_limits()
+        self.assertEqual(commands[0], 'subsystem_limits = dict()')
+        self.assertEqual(len(commands), 3)
+        del os.environ['LCATR_CCS_SUBSYSTEM_CONFIG']
+        self.assertEqual(ccsTools.CcsSetup.set_ccs_subsystem_limits(),
+                         ['subsystem_limits = None'])
+
+class CcsSetupTestCase(unittest.TestCase):
+    "TestCase class for the CcsSetup class."
+    def setUp(self):
+        self.acq_cfg = 'test_acq.cfg'
+        with open(self.acq_cfg, 'w') as output:
+            output.write('bias_count = bias_count.cfg\n')
+        self.env = dict(SITENAME='test_site', LCATR_JOB='test_job',
+                        LCATR_UNIT_ID='ITL-3800C-000',
+                        LCATR_UNIT_TYPE='ITL-CCD',
+                        LCATR_RUN_NUMBER='1234', LCATR_INSTALL_AREA='.',
+                        LCATR_VERSION='.', LCATR_CONFIG_DIR='/config',
+                        HARNESSEDJOBSDIR='/harnessed-jobs',
+                        JHCRCCSUTILSDIR='/jh-ccs-utils')
+        self.saved_env = dict((key, os.environ.get(key)) for key in
+                              list(self.env) + ['LCATR_CCS_SUBSYSTEM_CONFIG'])
+        os.environ.update(self.env)
+        os.environ.pop('LCATR_CCS_SUBSYSTEM_CONFIG', None)
+
+    def tearDown(self):
+        for key, value in self.saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        os.remove(self.acq_cfg)
+
+    def test_preamble(self):
+        "Test that the preamble is idempotent and tracks changes."
+        setup = ccsTools.CcsSetup(os.path.abspath(self.acq_cfg),
+                                  sys_paths=('/a', '/b'))
+        setup.commands.append('import time')
+        commands = setup()
+        self.assertEqual(commands[:5],
+                         ['import sys',
+                          'sys.path.append("/jh-ccs-utils/python")',
+                          'sys.path.append("/b")', 'sys.path.append("/a")',
+                          'import time'])
+        self.assertIn("bias_count = '/config/bias_count.cfg'", commands)
+        self.assertEqual(commands[-2:], ['subsystems = None',
+                                         'subsystem_limits = None'])
+        self.assertEqual(setup(), commands)
+        self.assertEqual(setup.render(), '\n'.join(commands) + '\n')
+
+        digest = setup.digest
+        setup['CCDID'] = 'E2V-CCD250-000'
+        self.assertNotEqual(setup.digest, digest)
+        self.assertIn("CCDID = 'E2V-CCD250-000'", setup())
+        self.assertEqual(len(setup()), len(commands))
+
+    def test_preamble_subsystem_config(self):
+        "Test that the preamble tracks the CCS subsystem config file."
+        setup = ccsTools.CcsSetup(os.path.abspath(self.acq_cfg))
+        self.assertIn('subsystems = None', setup())
+        config_file = 'test_ccs_subsystems.cfg'
+        try:
+            with open(config_file, 'w') as output:
+                output.write('[ccs_subsystems]\nts8 = ts8\n')
+            os.environ['LCATR_CCS_SUBSYSTEM_CONFIG'] = config_file
+            self.assertIn("subsystems['ts8'] = 'ts8'", setup())
+            with open(config_file, 'w') as output:
+                output.write('[ccs_subsystems]\nts8 = ts8-bench\n')
+            self.assertIn("subsystems['ts8'] = 'ts8-bench'", setup())
+        finally:
+            os.environ.pop('LCATR_CCS_SUBSYSTEM_CONFIG', None)
+            os.remove(config_file)
+        self.assertIn('subsystems = None', setup())
+
+class CcsStandOrchestratorTestCase(unittest.TestCase):
+    "TestCase class for the CcsStandOrchestrator class."
+    def setUp(self):
+        self.ccsProducer = ccsTools.ccsProducer
+        self.CcsJythonInterpreter = ccsTools.CcsJythonInterpreter
+        class CcsJythonInterpreter(object):
+            def __init__(self, name=None, host=None, port=4444):
+                self.closed = threading.Event()
+            def close(self):
+                self.closed.set()
+        def ccsProducer(jobName, ccsScript, output_monitor=None,
+                        cancel_event=None, ccs=None, **kwds):
+            if jobName == 'silent':
+                # No script output until the connection is closed.
+                ccs.closed.wait(10)
+                raise RuntimeError('aborted')
+            if jobName == 'stuck':
+                time.sleep(1)
+                return
+            for i in range(200):
+                if jobName == 'fail' and i == 20:
+                    raise RuntimeError('bench failure')
+                if output_monitor('line %i\n' % i):
+                    raise RuntimeError('cancelled')
+                if jobName == 'fast' and i == 5:
+                    return
+                time.sleep(0.01)
+        ccsTools.ccsProducer = ccsProducer
+        ccsTools.CcsJythonInterpreter = CcsJythonInterpreter
+        self.log_files = []
+
+    def tearDown(self):
+        ccsTools.ccsProducer = self.ccsProducer
+        ccsTools.CcsJythonInterpreter = self.CcsJythonInterpreter
+        for item in self.log_files:
+            if os.path.isfile(item):
+                os.remove(item)
+
+    def _runs(self, job_names):
+        runs = [ccsTools.CcsStandRun('stand%i' % i, job_name, 'acq.py',
+                                     host='host%i' % i)
+                for i, job_name in enumerate(job_names)]
+        self.log_files.extend([x.log_file for x in runs])
+        return runs
+
+    def test_cancel_on_failure(self):
+        "Test that a failure cancels the other stands."
+        orchestrator = ccsTools.CcsStandOrchestrator(
+            self._runs(('fast', 'fail', 'slow')))
+        orchestrator.run(timeout=10)
+        self.assertEqual([x['status'] for x in orchestrator.status()],
+                         ['succeeded', 'failed', 'cancelled'])
+        self.assertEqual(orchestrator.runs[0].monitor.nlines, 6)
+        self.assertIn('bench failure', orchestrator.report())
+
+    def test_cancel_silent_stand(self):
+        "Test that cancellation stops a stand that produces no output."
+        orchestrator = ccsTools.CcsStandOrchestrator(
+            self._runs(('fail', 'silent')))
+        t0 = time.time()
+        orchestrator.run(timeout=10)
+        self.assertLess(time.time() - t0, 5)
+        self.assertEqual([x['status'] for x in orchestrator.status()],
+                         ['failed', 'cancelled'])
+        self.assertTrue(all(x.ccs is None for x in orchestrator.runs))
+
+    def test_timeout(self):
+        "Test that the executions are cancelled and joined at the timeout."
+        orchestrator = ccsTools.CcsStandOrchestrator(
+            self._runs(('silent', 'slow')))
+        orchestrator.run(timeout=0.2)
+        self.assertEqual(orchestrator.running(), [])
+        self.assertEqual([x['status'] for x in orchestrator.status()],
+                         ['cancelled', 'cancelled'])
+        orchestrator = ccsTools.CcsStandOrchestrator(
+            self._runs(('stuck', 'silent')), join_timeout=0.1)
+        orchestrator.run(timeout=0.2)
+        self.assertEqual(orchestrator.running(), ['stand0'])
+        self.assertTrue(orchestrator.wait(5))
+
+    def test_ccsMultiProducer(self):
+        "Test the ccsMultiProducer entry point."
+        self.log_files.append('test_stands_report.txt')
+        orchestrator = ccsTools.ccsMultiProducer(
+            self._runs(('fast', 'fast')),
+            report_file='test_stands_report.txt')
+        self.assertTrue(all(x.status == 'succeeded'
+                            for x in orchestrator.runs))
+        self.assertRaises(RuntimeError, ccsTools.ccsMultiProducer,
+                          self._runs(('fast', 'fail')),
+                          report_file='test_stands_report.txt')
+
+class CcsOutputMonitorTestCase(unittest.TestCase):
+    "TestCase class for the CcsOutputMonitor class."
+    def setUp(self):
+        self.log_file = 'test_ccs_output.log'
+
+    def tearDown(self):
+        if os.path.isfile(self.log_file):
+            os.remove(self.log_file)
+
+    def test_abort(self):
+        "Test streaming and abort pattern matching across chunks."
+        monitor = ccsTools.CcsOutputMonitor(
+            self.log_file, abort_patterns=(ccsTools.JAVA_EXCEPTION_PATTERN,),
+            context_lines=2)
+        self.assertFalse(monitor('line 1\nline 2\nline'))
+        self.assertFalse(monitor(' 3\njava.lang.Null'))
+        with open(self.log_file) as fd:
+            self.assertEqual(fd.read(), 'line 1\nline 2\nline 3\njava.lang.Null')
+        self.assertTrue(monitor('PointerException: foo\nline 5\n'))
+        monitor.close()
+        self.assertEqual(monitor.abort_line,
+                         'java.lang.NullPointerException: foo')
+        self.assertEqual(list(monitor.context),
+                         ['line 3', 'java.lang.NullPointerException: foo'])
+
+    def test_abort_on_partial_line(self):
+        "Test that a trailing partial line is checked on close."
+        monitor = ccsTools.CcsOutputMonitor(
+            self.log_file, abort_patterns=(ccsTools.JAVA_EXCEPTION_PATTERN,))
+        self.assertFalse(monitor('line 1\njava.lang.IllegalStateException'))
+        self.assertEqual(monitor.abort_line, None)
+        monitor.close()
+        monitor.close()
+        self.assertEqual(monitor.abort_line,
+                         'java.lang.IllegalStateException')
+        self.assertEqual(monitor.nlines, 2)
+
+class FilerefWatcherTestCase(unittest.TestCase):
+    "TestCase class for the FilerefWatcher class."
+    def setUp(self):
+        self.files = ['test_watcher_%i.txt' % i for i in range(3)]
+        self.cache_file = 'test_watcher_cache.json'
+        self.calls = []
+        self.make = ccsTools.siteUtils.lcatr.schema.fileref.make
+        def make(path, **kwds):
+            self.calls.append(path)
+            return dict(path=path, size=os.path.getsize(path))
+        ccsTools.siteUtils.lcatr.schema.fileref.make = make
+
+    def tearDown(self):
+        ccsTools.siteUtils.lcatr.schema.fileref.make = self.make
+        for item in self.files + [self.cache_file]:
+            if os.path.isfile(item):
+                os.remove(item)
+
+    def test_polling(self):
+        "Test that completed files are processed while they are written."
+        watcher = ccsTools.FilerefWatcher(patterns=('test_watcher_*.txt',),
+                                          cache_file=self.cache_file,
+                                          poll_interval=0.05,
+                                          settle_time=0, use_inotify=False)
+        with watcher:
+            for item in self.files:
+                with open(item, 'w') as output:
+                    output.write('data\n')
+            for _ in range(100):
+                if watcher.nprocessed == len(self.files):
+                    break
+                time.sleep(0.05)
+        self.assertEqual(sorted(self.calls), self.files)
+
+        self.calls[:] = []
+        filerefs = ccsTools.siteUtils.make_filerefs(self.files,
+                                                    cache_file=self.cache_file)
+        self.assertEqual(self.calls, [])
+        self.assertEqual([x['path'] for x in filerefs], self.files)
+
+    def test_matches(self):
+        "Test that glob patterns do not match across directories."
+        watcher = ccsTools.FilerefWatcher(cache_file=self.cache_file)
+        self.assertTrue(watcher._matches('flat/foo.fits'))
+        self.assertFalse(watcher._matches('a/b/foo.fits'))
+        self.assertTrue(watcher._matches('pd-values_1.txt'))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,98 @@
+"""
+Unit tests for ccs_geometry module.
+"""
+import gc
+import unittest
+from ccs_geometry import CcsGeometry, wg_reb_name
+
+raft_geometry = """--> R00
+---> R00.Reb2
+----> R00.Reb2.S20
+----> R00.Reb2.S21
+----> R00.Reb2.S22
+---> R00.Reb1
+----> R00.Reb1.S10
+----> R00.Reb1.S11
+----> R00.Reb1.S12
+---> R00.Reb0
+----> R00.Reb0.S00
+----> R00.Reb0.S01
+----> R00.Reb0.S02
+"""
+
+class CcsGeometryTestCase(unittest.TestCase):
+    "TestCase class for the CcsGeometry class."
+    def test_raft_geometry(self):
+        "Test the lookups for a science raft."
+        geometry = CcsGeometry.from_text(raft_geometry)
+        self.assertEqual(list(geometry.rafts.keys()), ['R00'])
+        self.assertEqual(geometry.rafts['R00'],
+                         ['R00.Reb2', 'R00.Reb1', 'R00.Reb0'])
+        self.assertEqual(len(geometry.ccds), 9)
+        ccd = geometry.slot('S12')
+        self.assertEqual(ccd.ccd_id, 'R00.Reb1.S12')
+        self.assertEqual(ccd.reb_name, 'R00.Reb1')
+        self.assertEqual(ccd.ccd_num, 2)
+        self.assertEqual(ccd.raft_name, 'R00')
+        self.assertEqual(geometry.slot('S12', raft_name='R00'), ccd)
+        self.assertEqual(geometry.ccd('R00.Reb1.S12'), ccd)
+        self.assertEqual([x.slot for x in geometry.reb_ccds('R00.Reb0')],
+                         ['S00', 'S01', 'S02'])
+        self.assertEqual(list(geometry.slot_map().keys())[:3],
+                         ['S20', 'S21', 'S22'])
+        self.assertEqual(geometry.render(), raft_geometry)
+        self.assertTrue(CcsGeometry.from_text(raft_geometry) is geometry)
+
+    def test_from_layout(self):
+        "Test the construction of a geometry from a layout."
+        layout = [('Reb%i' % reb, ['S%i%i' % (reb, ccd) for ccd in range(3)])
+                  for reb in (2, 1, 0)]
+        geometry = CcsGeometry.from_layout(layout, raft_name='R00')
+        self.assertEqual(geometry.render(), raft_geometry)
+        geometry = CcsGeometry.from_layout([('GREB', ['S10', 'S11']),
+                                            ('WREB', ['S00'])])
+        self.assertEqual(geometry.rafts, {})
+        self.assertEqual(geometry.slot('S00').reb_name, 'WREB')
+        self.assertEqual(list(geometry.slot_map().keys()),
+                         ['S10', 'S11', 'S00'])
+
+    def test_multiple_rafts(self):
+        "Test the slot lookups for multiple rafts."
+        text = raft_geometry + raft_geometry.replace('R00', 'R10')
+        geometry = CcsGeometry(text)
+        self.assertEqual(list(geometry.rafts.keys()), ['R00', 'R10'])
+        self.assertEqual(len(geometry.ccds), 18)
+        self.assertEqual(geometry.slot('S00', raft_name='R10').ccd_id,
+                         'R10.Reb0.S00')
+        self.assertEqual(geometry.slot('S00').ccd_id, 'R00.Reb0.S00')
+        self.assertEqual(geometry.slot_map('R10')['S22'].reb_name,
+                         'R10.Reb2')
+
+    def test_from_subsystem(self):
+        "Test the per-subsystem cache, which does not keep them alive."
+        class Subsystem(object):
+            nqueries = 0
+            def sendSynchCommand(self, command):
+                Subsystem.nqueries += 1
+                return raft_geometry
+        subsystem = Subsystem()
+        geometry = CcsGeometry.from_subsystem(subsystem)
+        self.assertTrue(CcsGeometry.from_subsystem(subsystem) is geometry)
+        self.assertEqual(Subsystem.nqueries, 1)
+        CcsGeometry.from_subsystem(subsystem, refresh=True)
+        self.assertEqual(Subsystem.nqueries, 2)
+        nsubsystems = len(CcsGeometry._subsystem_cache)
+        del subsystem
+        gc.collect()
+        self.assertEqual(len(CcsGeometry._subsystem_cache), nsubsystems - 1)
+
+    def test_wg_reb_name(self):
+        "Test the corner raft slot to REB mapping."
+        self.assertEqual(wg_reb_name('ccd1'), 'WREB0')
+        self.assertEqual(wg_reb_name('ccd2'), 'WREB0')
+        self.assertEqual(wg_reb_name('guidesensor1'), 'GREB0')
+        self.assertEqual(wg_reb_name('guidesensor2'), 'GREB1')
+        self.assertEqual(wg_reb_name('S00'), None)
+
+if __name__ == '__main__':
+    unittest.main()
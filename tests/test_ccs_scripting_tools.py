@@ -1,8 +1,11 @@
 "Unit tests for ccs_scripting_tools module."
 import os
+import json
 import unittest
 import io
+import time
 import logging
+import ccs_python_proxies
 import ccs_scripting_tools
 
 CCS_version_text = """        Project        : org-lsst-ccs-subsystem-teststand-main
@@ -41,6 +44,44 @@ class FileStreamProxy(object):
         self.output.close()
         self.output = io.StringIO()
 
+class VersionInfoResponse(object):
+    "Response to getDistributionInfo with a CCS-like result object."
+    def __init__(self, text):
+        self.text = text
+
+    def getResult(self):
+        "Return an object with a java-like toString method."
+        text = self.text
+        class Result(object):
+            def toString(self):
+                return text
+        return Result()
+
+class VersionInfoSubsystem(object):
+    "Fake CCS subsystem that answers getDistributionInfo after a delay."
+    def __init__(self, delay, ccs):
+        self.delay = delay
+        self.ccs = ccs
+
+    def sendSynchCommand(self, *args):
+        if args[0] == 'getBuildId':
+            return self.ccs.build_id
+        self.ccs.nqueries += 1
+        time.sleep(self.delay)
+        return VersionInfoResponse(CCS_version_text)
+
+class VersionInfoCcs(object):
+    "Fake CCS object with per-subsystem response delays."
+    def __init__(self, delays, attach_delay=0):
+        self.delays = delays
+        self.attach_delay = attach_delay
+        self.nqueries = 0
+        self.build_id = '41'
+
+    def attachSubsystem(self, name):
+        time.sleep(self.attach_delay)
+        return VersionInfoSubsystem(self.delays.get(name, 0), self)
+
 class CcsSubsystemsTestCase(unittest.TestCase):
     "TestCase subclass for testing the CcsSubsystems class."
     def test_interface(self):
@@ -55,6 +96,97 @@ class CcsSubsystemsTestCase(unittest.TestCase):
         self.assertTrue(hasattr(sub, 'mono'))
         self.assertTrue(hasattr(sub, 'proxy'))
 
+    def test_get_version_info_timeout(self):
+        "Test that a slow subsystem is recorded with placeholder info."
+        ccs = ccs_scripting_tools.CCS
+        ccs_scripting_tools.CCS = VersionInfoCcs({'ts8': 0, 'ts': 0,
+                                                  'ccs-rebps': 5})
+        try:
+            t0 = time.time()
+            sub = ccs_scripting_tools.CcsSubsystems(dict(ts8='ts8',
+                                                         rebps='ccs-rebps',
+                                                         pd='ts/PhotoDiode'),
+                                                    version_file=None,
+                                                    version_timeout=0.5)
+            self.assertLess(time.time() - t0, 2)
+        finally:
+            ccs_scripting_tools.CCS = ccs
+        self.assertEqual(list(sub.subsystems.keys()),
+                         ['ccs-rebps', 'ts', 'ts8'])
+        self.assertEqual(sub.subsystems['ts'].version, '1.2.0-SNAPSHOT')
+        self.assertEqual(sub.subsystems['ts8'].version, '1.2.0-SNAPSHOT')
+        self.assertEqual(sub.subsystems['ccs-rebps'].project, 'ccs-rebps')
+        self.assertEqual(sub.subsystems['ccs-rebps'].version,
+                         'unavailable (timeout)')
+
+    def test_attach_subsystems(self):
+        "Test that the subsystems are attached concurrently."
+        ccs = ccs_scripting_tools.CCS
+        subsystems = dict(ts8='ts8', rebps='ccs-rebps', pd='ts/PhotoDiode',
+                          mono='ts/Monochromator')
+        try:
+            ccs_scripting_tools.CCS = VersionInfoCcs({}, attach_delay=0.3)
+            t0 = time.time()
+            sub = ccs_scripting_tools.CcsSubsystems(subsystems,
+                                                    version_file=None)
+            self.assertLess(time.time() - t0, 0.9)
+            self.assertTrue(all(hasattr(sub, key) for key in subsystems))
+
+            ccs_scripting_tools.CCS = VersionInfoCcs({}, attach_delay=2)
+            self.assertRaises(ccs_scripting_tools.CcsCommandTimeout,
+                              ccs_scripting_tools.CcsSubsystems, subsystems,
+                              version_file=None, version_timeout=0.2)
+        finally:
+            ccs_scripting_tools.CCS = ccs
+
+    def test_version_cache(self):
+        "Test the reuse of cached version info."
+        cache_file = 'test_ccs_version_cache.json'
+        fake_ccs = VersionInfoCcs(dict())
+        ccs = ccs_scripting_tools.CCS
+        ccs_scripting_tools.CCS = fake_ccs
+        subsystems = dict(ts8='ts8', pd='ts/PhotoDiode')
+        try:
+            sub = ccs_scripting_tools.CcsSubsystems(subsystems,
+                                                    version_file=None,
+                                                    version_cache=cache_file)
+            self.assertEqual(fake_ccs.nqueries, 2)
+            sub = ccs_scripting_tools.CcsSubsystems(subsystems,
+                                                    version_file=None,
+                                                    version_cache=cache_file)
+            self.assertEqual(fake_ccs.nqueries, 2)
+            self.assertEqual(sub.subsystems['ts'].version, '1.2.0-SNAPSHOT')
+
+            cache = ccs_scripting_tools.CcsVersionCache(
+                cache_file, probe_command='getBuildId')
+            sub = ccs_scripting_tools.CcsSubsystems(subsystems,
+                                                    version_file=None,
+                                                    version_cache=cache)
+            self.assertEqual(fake_ccs.nqueries, 4)
+            sub = ccs_scripting_tools.CcsSubsystems(subsystems,
+                                                    version_file=None,
+                                                    version_cache=cache)
+            self.assertEqual(fake_ccs.nqueries, 4)
+            fake_ccs.build_id = '42'
+            sub = ccs_scripting_tools.CcsSubsystems(subsystems,
+                                                    version_file=None,
+                                                    version_cache=cache)
+            self.assertEqual(fake_ccs.nqueries, 6)
+            self.assertEqual(sub.subsystems['ts8'].rev,
+                             '45b7e551b75b8771f6deadb4bbd7c7cf79e699b1')
+
+            # Without a probe, expired records are queried again.
+            cache = ccs_scripting_tools.CcsVersionCache(cache_file)
+            self.assertEqual(cache.max_age, 600)
+            cache.max_age = 0
+            sub = ccs_scripting_tools.CcsSubsystems(subsystems,
+                                                    version_file=None,
+                                                    version_cache=cache)
+            self.assertEqual(fake_ccs.nqueries, 8)
+        finally:
+            ccs_scripting_tools.CCS = ccs
+            os.remove(cache_file)
+
     def test_parse_version_info(self):
         "Test the _parse_version_info function."
         version_info = ccs_scripting_tools.CcsSubsystems.\
@@ -80,6 +212,17 @@ class CcsSubsystemsTestCase(unittest.TestCase):
         self.assertEqual(expected_text, open(version_file).readlines())
         os.remove(version_file)
 
+class SlowSubsystem(object):
+    "Fake CCS subsystem that echoes its commands after a delay."
+    def __init__(self, delay):
+        self.delay = delay
+
+    def sendSynchCommand(self, *args):
+        time.sleep(self.delay)
+        if args[0] == 'fail':
+            raise RuntimeError('command failed')
+        return ' '.join([str(x) for x in args])
+
 class SubsystemDecoratorTestCase(unittest.TestCase):
     "TestCase subclass for SubsystemDecorator."
     def test_logging(self):
@@ -100,8 +243,152 @@ class SubsystemDecoratorTestCase(unittest.TestCase):
         self.assertEqual(fs.get_value(), '10 setTestType FE55\n')
         sub.ts8.synchCommand(10, 'accumBuffer', 100, 0.183)
         self.assertEqual(fs.get_value(), '10 accumBuffer 100 0.183\n')
-        sub.ts8.asynchCommand("setTestType", "FE55")
+        sub.ts8.asynchCommand("setTestType", "FE55").result(1)
         self.assertEqual(fs.get_value(), 'setTestType FE55\n')
 
+    def test_asynchCommand_future(self):
+        "Test the CommandFuture semantics of asynchCommand."
+        sub = ccs_scripting_tools.SubsystemDecorator(SlowSubsystem(0.2))
+        future = sub.asynchCommand('getChannelValue', 'R00.Reb0.CCDTemp0')
+        self.assertFalse(future.done())
+        self.assertRaises(ccs_scripting_tools.CcsCommandTimeout,
+                          future.result, 0.01)
+        self.assertEqual(future.result(1),
+                         'getChannelValue R00.Reb0.CCDTemp0')
+        self.assertTrue(future.done())
+        self.assertEqual(future.exception(), None)
+
+        future = sub.asynchCommand('fail')
+        self.assertRaises(RuntimeError, future.result, 1)
+        self.assertTrue(isinstance(future.exception(), RuntimeError))
+
+        completed = []
+        future.add_done_callback(completed.append)
+        self.assertEqual(completed, [future])
+
+    def test_asynchCommand_getResult(self):
+        "Test the getResult method of the asynchCommand futures."
+        sub = ccs_scripting_tools.SubsystemDecorator(SlowSubsystem(0))
+        future = sub.asynchCommand('getChannelValue', 'R00.Reb0.CCDTemp0')
+        self.assertEqual(future.getResult(1),
+                         'getChannelValue R00.Reb0.CCDTemp0')
+        ts8 = ccs_scripting_tools.SubsystemDecorator(
+            ccs_python_proxies.CCS.attachSubsystem('ts8-proxy'))
+        self.assertEqual(ts8.asynchCommand('getREBIds').getResult(1),
+                         ts8.synchCommand('getREBIds').getResult())
+        self.assertRaises(RuntimeError,
+                          sub.asynchCommand('fail').getResult, 1)
+
+    def test_gather(self):
+        "Test that gathered commands are executed concurrently."
+        executor = ccs_scripting_tools.CommandExecutor(max_workers=9)
+        ts8 = ccs_scripting_tools.SubsystemDecorator(SlowSubsystem(0.2),
+                                                     executor=executor)
+        rebps = ccs_scripting_tools.SubsystemDecorator(SlowSubsystem(0.2),
+                                                       executor=executor)
+        requests = [(ts8, 'getChannelValue', 'R00.Reb%i.CCDTemp%i'
+                     % (i//3, i % 3)) for i in range(6)]
+        requests += [(rebps, 'getChannelValue', 'REB%i.hvbias.VbefSwch' % i)
+                     for i in range(3)]
+        t0 = time.time()
+        results = ccs_scripting_tools.gather(requests, timeout=5)
+        self.assertLess(time.time() - t0, 1)
+        self.assertEqual(results[0], 'getChannelValue R00.Reb0.CCDTemp0')
+        self.assertEqual(results[5], 'getChannelValue R00.Reb1.CCDTemp2')
+        self.assertEqual(results[8], 'getChannelValue REB2.hvbias.VbefSwch')
+
+        results = ccs_scripting_tools.gather([(ts8, 'fail'), (ts8, 'ok')],
+                                             return_exceptions=True)
+        self.assertTrue(isinstance(results[0], RuntimeError))
+        self.assertEqual(results[1], 'ok')
+
+class CommandGovernorTestCase(unittest.TestCase):
+    "TestCase class for the CommandGovernor class."
+    def test_concurrency_limit(self):
+        "Test the per-subsystem concurrency limit."
+        ccs_python_proxies.CCS.proxies['slow-proxy'] = SlowSubsystem(0.1)
+        try:
+            sub = ccs_scripting_tools.CcsSubsystems(
+                dict(ts8='ts8-proxy', rebps='slow-proxy'),
+                version_file=None, limits=dict(rebps=dict(max_concurrent=1)))
+        finally:
+            del ccs_python_proxies.CCS.proxies['slow-proxy']
+        futures = [sub.rebps.asynchCommand('getChannelValue', i)
+                   for i in range(4)]
+        t0 = time.time()
+        self.assertEqual(sub.ts8.asynchCommand('getREBIds').result(1)
+                         .getResult(), (0, 1, 2))
+        self.assertLess(time.time() - t0, 0.1)
+        results = ccs_scripting_tools.wait_all(futures, timeout=2)
+        self.assertGreaterEqual(time.time() - t0, 0.35)
+        self.assertEqual(results, ['getChannelValue %i' % i
+                                   for i in range(4)])
+        stats = sub.queue_wait_stats()
+        self.assertEqual(list(stats.keys()), ['rebps'])
+        self.assertEqual(stats['rebps']['count'], 4)
+        self.assertGreaterEqual(stats['rebps']['max'], 0.25)
+
+    def test_rate_limit(self):
+        "Test the token-bucket rate limit and FIFO admission."
+        governor = ccs_scripting_tools.CommandGovernor(rate=20., burst=2)
+        order = []
+        def send(i):
+            governor.acquire()
+            order.append(i)
+            governor.release()
+        t0 = time.time()
+        executor = ccs_scripting_tools.CommandExecutor(max_workers=1)
+        futures = [executor.submit(send, i) for i in range(6)]
+        ccs_scripting_tools.wait_all(futures, timeout=2)
+        # Two commands are sent immediately, the remaining four at 20 Hz.
+        self.assertGreaterEqual(time.time() - t0, 0.18)
+        self.assertEqual(order, list(range(6)))
+        self.assertEqual(governor.stats()['count'], 6)
+
+class CommandJournalTestCase(unittest.TestCase):
+    "TestCase class for the CommandJournal class."
+    def setUp(self):
+        self.journal_file = 'test_ccs_commands.jsonl'
+        self.summary_file = 'test_ccs_command_latencies.txt'
+
+    def tearDown(self):
+        for item in (self.journal_file, self.summary_file):
+            if os.path.isfile(item):
+                os.remove(item)
+
+    def test_journal(self):
+        "Test the recording of commands sent via SubsystemDecorator."
+        journal = ccs_scripting_tools.CommandJournal()
+        sub = ccs_scripting_tools.SubsystemDecorator(SlowSubsystem(0.01),
+                                                     name='ts8',
+                                                     journal=journal)
+        for i in range(3):
+            sub.synchCommand('getChannelValue', 'R00.Reb0.CCDTemp%i' % i)
+        sub.asynchCommand('setTestType', 'FE55').result(1)
+        self.assertRaises(RuntimeError, sub.synchCommand, 'fail')
+        self.assertEqual(len(journal), 5)
+
+        stats = journal.latency_stats()
+        count, p50, p95, max_duration, total = \
+            stats[('ts8', 'getChannelValue')]
+        self.assertEqual(count, 3)
+        self.assertTrue(0.01 <= p50 <= p95 <= max_duration <= total)
+        self.assertEqual(list(stats.keys())[0], ('ts8', 'getChannelValue'))
+
+        journal.write(self.journal_file)
+        with open(self.journal_file) as fd:
+            entries = [json.loads(line) for line in fd]
+        self.assertEqual(len(entries), 5)
+        self.assertEqual(entries[0]['command'], 'getChannelValue')
+        self.assertEqual(entries[0]['args'],
+                         ['getChannelValue', 'R00.Reb0.CCDTemp0'])
+        self.assertEqual(entries[3]['outcome'], 'ok')
+        self.assertEqual(entries[4]['outcome'], 'RuntimeError')
+
+        journal.write_latency_summary(self.summary_file)
+        with open(self.summary_file) as fd:
+            lines = fd.readlines()
+        self.assertEqual(len(lines), 4)
+
 if __name__ == '__main__':
     unittest.main()
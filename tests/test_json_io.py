@@ -0,0 +1,46 @@
+"""
+Unit tests for json_io module.
+"""
+import os
+import json
+import shutil
+import threading
+import unittest
+from json_io import write_json
+
+class WriteJsonTestCase(unittest.TestCase):
+    "TestCase class for write_json."
+    def setUp(self):
+        self.outdir = 'test_json_io_dir'
+        os.makedirs(self.outdir)
+        self.outfile = os.path.join(self.outdir, 'cache.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def test_concurrent_writes(self):
+        "Test that concurrent writers leave a complete file and no temps."
+        def write(i):
+            for j in range(20):
+                write_json(self.outfile, dict(writer=i, data=list(range(100))))
+        threads = [threading.Thread(target=write, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with open(self.outfile) as fd:
+            self.assertEqual(json.load(fd)['data'], list(range(100)))
+        self.assertEqual(os.listdir(self.outdir), ['cache.json'])
+
+    def test_failed_write(self):
+        "Test that a failed write keeps the previous contents."
+        write_json(self.outfile, dict(a=1), indent=1)
+        self.assertRaises(TypeError, write_json, self.outfile,
+                          dict(a=object()))
+        with open(self.outfile) as fd:
+            self.assertEqual(json.load(fd), dict(a=1))
+        self.assertEqual(os.listdir(self.outdir), ['cache.json'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 from __future__ import print_function
 import os
+import shutil
 import unittest
 import siteUtils
 
@@ -94,5 +95,251 @@ class PngDataProductTestCase(unittest.TestCase):
         self.assertEqual(siteUtils.png_data_product(pngfile, lsst_num),
                          data_product)
 
+class GetCCDNamesTestCase(unittest.TestCase):
+    "TestCase class for getCCDNames."
+    def setUp(self):
+        self.cache_file = 'test_ccd_names_cache.json'
+        self.connections = []
+        self.lookups = []
+        lookups = self.lookups
+        class Connection(object):
+            def __init__(conn, *args, **kwds):
+                self.connections.append(args)
+            def getHardwareHierarchy(conn, **kwds):
+                return [dict(child_hardwareTypeName='LCA-13574',
+                             child_experimentSN='LCA-13574-017',
+                             slotName='REB0'),
+                        dict(child_hardwareTypeName='ITL-CCD',
+                             child_experimentSN='ITL-3800C-023',
+                             slotName='S00'),
+                        dict(child_hardwareTypeName='ITL-CCD',
+                             child_experimentSN='ITL-3800C-032',
+                             slotName='S01')]
+            def getManufacturerId(conn, experimentSN=None, htype=None):
+                lookups.append(experimentSN)
+                return experimentSN.replace('ITL-3800C-', '')
+        self.Connection = siteUtils.Connection
+        siteUtils.Connection = Connection
+        self.saved_env = dict((key, os.environ.get(key)) for key in
+                              ('LCATR_UNIT_ID', 'LCATR_UNIT_TYPE',
+                               'LCATR_LIMS_URL'))
+        os.environ['LCATR_UNIT_ID'] = 'LCA-11021_RTM-004'
+        os.environ['LCATR_UNIT_TYPE'] = 'LCA-11021_RTM'
+        os.environ['LCATR_LIMS_URL'] = 'http://host/eTraveler/Prod'
+        siteUtils._etraveler_connections = None
+
+    def tearDown(self):
+        siteUtils._etraveler_connections = None
+        siteUtils.Connection = self.Connection
+        for key, value in self.saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        if os.path.isfile(self.cache_file):
+            os.remove(self.cache_file)
+
+    def test_getCCDNames(self):
+        "Test the lookups and the disk cache."
+        ccdnames, ccdmanunames \
+            = siteUtils.getCCDNames(cache_file=self.cache_file)
+        self.assertEqual(ccdnames, dict(S00='ITL-3800C-023',
+                                        S01='ITL-3800C-032'))
+        self.assertEqual(ccdmanunames, dict(S00='023', S01='032'))
+        self.assertEqual(self.connections, [('homer', 'Prod')])
+        self.assertEqual(sorted(self.lookups),
+                         ['ITL-3800C-023', 'ITL-3800C-032'])
+
+        self.assertEqual(siteUtils.getCCDNames(cache_file=self.cache_file),
+                         (ccdnames, ccdmanunames))
+        self.assertEqual(len(self.connections), 1)
+
+        # The connection and the query results are reused in-process.
+        siteUtils.getCCDNames(cache_file=self.cache_file, max_age=0)
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(len(self.lookups), 2)
+
+        siteUtils.getCCDNames(cache_file=self.cache_file, refresh=True)
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(len(self.lookups), 4)
+
+        os.environ['LCATR_LIMS_URL'] = 'http://host/eTraveler/Dev'
+        siteUtils._etraveler_connections = None
+        siteUtils.getCCDNames(cache_file=self.cache_file)
+        self.assertEqual(self.connections[-1], ('homer', 'Dev'))
+
+    def test_no_cache(self):
+        "Test that the CCD names are not cached by default."
+        cache_file = os.environ.pop('LCATR_CCD_NAMES_CACHE', None)
+        connection = siteUtils.Connection
+        class Connection(connection):
+            def getHardwareHierarchy(conn, **kwds):
+                return (connection.getHardwareHierarchy(conn, **kwds)
+                        + [dict(child_hardwareTypeName='ITL-CCD',
+                                child_experimentSN='', slotName='S02')])
+        siteUtils.Connection = Connection
+        try:
+            ccdnames, ccdmanunames = siteUtils.getCCDNames()
+            siteUtils._etraveler_connections = None
+            siteUtils.getCCDNames()
+        finally:
+            if cache_file is not None:
+                os.environ['LCATR_CCD_NAMES_CACHE'] = cache_file
+        self.assertEqual(ccdnames['S02'], '')
+        self.assertEqual(ccdmanunames['S02'], '')
+        self.assertEqual(sorted(self.lookups), ['ITL-3800C-023']*2
+                         + ['ITL-3800C-032']*2)
+
+    def test_query_cache(self):
+        "Test the ETravelerConnections disk persistence."
+        query_cache = 'test_etraveler_cache.json'
+        try:
+            etraveler = siteUtils.ETravelerConnections(cache_file=query_cache)
+            self.assertEqual(etraveler.db_name, 'Prod')
+            self.assertEqual(etraveler.getManufacturerId(
+                experimentSN='ITL-3800C-023', htype='ITL-CCD'), '023')
+            etraveler = siteUtils.ETravelerConnections(cache_file=query_cache)
+            self.assertEqual(etraveler.getManufacturerId(
+                experimentSN='ITL-3800C-023', htype='ITL-CCD'), '023')
+            self.assertEqual(self.lookups, ['ITL-3800C-023'])
+            self.assertEqual(self.connections, [('homer', 'Prod')])
+        finally:
+            os.remove(query_cache)
+
+    def test_query_cache_batch(self):
+        "Test that getCCDNames saves the query cache after the batch."
+        query_cache = 'test_etraveler_cache.json'
+        saved = []
+        write_json = siteUtils.write_json
+        def counting_write_json(filename, obj, **kwds):
+            saved.append((filename, len(obj)))
+            return write_json(filename, obj, **kwds)
+        siteUtils.write_json = counting_write_json
+        os.environ['LCATR_ETRAVELER_CACHE'] = query_cache
+        try:
+            siteUtils.getCCDNames(cache_file=self.cache_file)
+        finally:
+            siteUtils.write_json = write_json
+            del os.environ['LCATR_ETRAVELER_CACHE']
+            os.remove(query_cache)
+        self.assertEqual(saved, [(query_cache, 1), (query_cache, 3),
+                                 (self.cache_file, 1)])
+
+class DatacatalogGlobTestCase(unittest.TestCase):
+    "TestCase class for datacatalog_glob."
+    def setUp(self):
+        self.queries = []
+        paths = ['/nfs/farm/%s/%s' % (job_id, name) for job_id in
+                 ('1020', '998', '1203', '1100')
+                 for name in ('dark_000.fits', 'flat_001.fits',
+                              'dark_002.fits')]
+        class Datasets(object):
+            def iter_full_paths(datasets):
+                for item in paths:
+                    yield item
+        def datacatalog_query(query, job_id=None):
+            self.queries.append((query, job_id))
+            return Datasets()
+        self.datacatalog_query = siteUtils.datacatalog_query
+        siteUtils.datacatalog_query = datacatalog_query
+        self.unit_id = os.environ.get('LCATR_UNIT_ID')
+        os.environ['LCATR_UNIT_ID'] = 'ITL-3800C-023'
+
+    def tearDown(self):
+        siteUtils.datacatalog_query = self.datacatalog_query
+        if self.unit_id is None:
+            del os.environ['LCATR_UNIT_ID']
+        else:
+            os.environ['LCATR_UNIT_ID'] = self.unit_id
+
+    def test_datacatalog_glob(self):
+        "Test that the latest job's matching files are returned."
+        files = siteUtils.datacatalog_glob('dark_*.fits', testtype='DARK',
+                                           imgtype='DARK', sort=True)
+        self.assertEqual(files, ['/nfs/farm/1203/dark_000.fits',
+                                 '/nfs/farm/1203/dark_002.fits'])
+        files = siteUtils.datacatalog_glob('*_001.fits', testtype='FLAT',
+                                           imgtype='FLAT', job_id=998)
+        self.assertEqual(files, ['/nfs/farm/998/flat_001.fits'])
+        self.assertEqual(self.queries[-1][1], 998)
+        self.assertRaises(ValueError, siteUtils.datacatalog_glob,
+                          'bias_*.fits', testtype='BIAS', imgtype='BIAS')
+
+class StageFileTestCase(unittest.TestCase):
+    "TestCase class for stage_file."
+    def setUp(self):
+        self.src = 'test_stage_src.txt'
+        self.folder = 'test_stage_folder'
+        with open(self.src, 'w') as output:
+            output.write('calibration data\n')
+        os.mkdir(self.folder)
+
+    def tearDown(self):
+        os.remove(self.src)
+        shutil.rmtree(self.folder)
+
+    def test_stage_file(self):
+        "Test the staging methods and their fallbacks."
+        dest = os.path.join(self.folder, self.src)
+        self.assertEqual(siteUtils.stage_file(self.src, self.folder),
+                         'hardlink')
+        self.assertTrue(os.path.samefile(self.src, dest))
+        self.assertEqual(siteUtils.staged_files[dest], 'hardlink')
+        self.assertEqual(siteUtils.stage_file(self.src, dest), 'none')
+
+        os.remove(dest)
+        self.assertEqual(siteUtils.stage_file(self.src, dest, methods='copy'),
+                         'copy')
+        self.assertFalse(os.path.samefile(self.src, dest))
+        method = siteUtils.stage_file(self.src, dest,
+                                      methods=('reflink', 'copy'))
+        self.assertIn(method, ('reflink', 'copy'))
+        with open(dest) as fd:
+            self.assertEqual(fd.read(), 'calibration data\n')
+        self.assertRaises(ValueError, siteUtils.stage_file, self.src, dest,
+                          methods='symlink')
+
+class MakeFilerefsTestCase(unittest.TestCase):
+    "TestCase class for make_filerefs and FilerefCache."
+    def setUp(self):
+        self.files = ['test_fileref_%i.txt' % i for i in range(5)]
+        for i, item in enumerate(self.files):
+            with open(item, 'w') as output:
+                output.write('%i\n' % i)
+        self.cache_file = 'test_fileref_cache.json'
+        self.calls = []
+        self.make = siteUtils.lcatr.schema.fileref.make
+        def make(path, **kwds):
+            self.calls.append(path)
+            return dict(path=path, size=os.path.getsize(path))
+        siteUtils.lcatr.schema.fileref.make = make
+
+    def tearDown(self):
+        siteUtils.lcatr.schema.fileref.make = self.make
+        for item in self.files + [self.cache_file]:
+            if os.path.isfile(item):
+                os.remove(item)
+
+    def test_make_filerefs(self):
+        "Test that only new or changed files are processed."
+        files = list(reversed(self.files)) + self.files[:2]
+        filerefs = siteUtils.make_filerefs(files, processes=2,
+                                           cache_file=self.cache_file)
+        self.assertEqual([x['path'] for x in filerefs], self.files)
+        self.assertEqual(sorted(self.calls), self.files)
+
+        self.calls[:] = []
+        with open(self.files[3], 'a') as output:
+            output.write('more data\n')
+        filerefs = siteUtils.make_filerefs(files, processes=2,
+                                           cache_file=self.cache_file)
+        self.assertEqual(self.calls, [self.files[3]])
+        self.assertEqual(filerefs[3]['size'], len('3\nmore data\n'))
+
+        self.calls[:] = []
+        siteUtils.make_filerefs(files, cache_file=self.cache_file,
+                                datatype='LSSTSENSORTEST')
+        self.assertEqual(sorted(self.calls), self.files)
+
 if __name__ == '__main__':
     unittest.main()
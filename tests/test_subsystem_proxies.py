@@ -1,8 +1,11 @@
 """
 Unit tests for ccs_python_proxies.py module.
 """
+import os
+import time
 import unittest
 import ccs_python_proxies
+from ccs_scripting_tools import CcsSubsystems, gather
 
 class Ts8RebCommandTestCase(unittest.TestCase):
     "Test case class for command REBs via the ts8 subsystem."
@@ -35,5 +38,120 @@ class Ts8RebCommandTestCase(unittest.TestCase):
         for reb_sn, expected_sn in zip(reb_SNs, expected_sns):
             self.assertEqual(reb_sn, expected_sn)
 
+class FailingSubsystem(ccs_python_proxies.NullSubsystem):
+    "Proxy subsystem whose 'fail' command raises an exception."
+    def sendSynchCommand(self, *args):
+        if args[0] == 'fail':
+            raise RuntimeError('command failed')
+        time.sleep(0.05)
+        return args[0] + ' done'
+
+class RecordReplayTestCase(unittest.TestCase):
+    "Test case class for SessionRecorder and ReplaySubsystem."
+    def setUp(self):
+        self.session_file = 'test_ccs_session.json'
+
+    def tearDown(self):
+        if os.path.isfile(self.session_file):
+            os.remove(self.session_file)
+
+    def test_record_replay(self):
+        "Record a session from proxy subsystems and replay it."
+        ccs = ccs_python_proxies.CcsType()
+        ccs.proxies['fail-proxy'] = FailingSubsystem()
+        recorder = ccs_python_proxies.SessionRecorder()
+        recording_ccs = recorder.wrap_ccs(ccs)
+
+        ts8 = recording_ccs.attachSubsystem('ts8-proxy')
+        self.assertEqual(ts8.sendSynchCommand('getREBIds').getResult(),
+                         (0, 1, 2))
+        self.assertEqual(ts8.synchCommand(10, 'getREBHwVersions').getResult(),
+                         [808599560, 808599560, 808599560])
+        other = recording_ccs.attachSubsystem('fail-proxy')
+        self.assertEqual(other.sendSynchCommand('setup'), 'setup done')
+        self.assertRaises(RuntimeError, other.sendSynchCommand, 'fail')
+        recorder.save(self.session_file)
+
+        replay_ccs = ccs_python_proxies.CcsType()
+        names = replay_ccs.load_session(self.session_file)
+        self.assertEqual(set(names), set(('ts8-proxy', 'fail-proxy')))
+
+        ts8 = replay_ccs.attachSubsystem('ts8-proxy')
+        self.assertEqual(list(ts8.sendSynchCommand('getREBIds').getResult()),
+                         [0, 1, 2])
+        self.assertEqual(ts8.synchCommand(5, 'getREBHwVersions').getResult(),
+                         [808599560, 808599560, 808599560])
+        self.assertEqual(ts8.sendSynchCommand('unrecorded').getResult(), 1)
+        other = replay_ccs.attachSubsystem('fail-proxy')
+        self.assertEqual(other.sendSynchCommand('setup'), 'setup done')
+        self.assertRaises(ccs_python_proxies.ReplayError,
+                          other.sendSynchCommand, 'fail')
+
+        replay_ccs.load_session(self.session_file, realtime=True)
+        other = replay_ccs.attachSubsystem('fail-proxy')
+        t0 = time.time()
+        other.sendSynchCommand('setup')
+        self.assertGreaterEqual(time.time() - t0, 0.04)
+
+    def test_CcsSubsystems_recorder(self):
+        "Test recording of the commands sent via CcsSubsystems."
+        recorder = ccs_python_proxies.SessionRecorder()
+        sub = CcsSubsystems(dict(ts8='ts8'), version_file=None,
+                            recorder=recorder)
+        sub.ts8.synchCommand('setTestType', 'FE55')
+        self.assertEqual(recorder.subsystems['ts8'][0]['command'],
+                         'setTestType FE55')
+
+class SimulatedSubsystemTestCase(unittest.TestCase):
+    "Test case class for the simulated subsystems."
+    def test_latency_model(self):
+        "Test the LatencyModel distributions."
+        self.assertEqual(ccs_python_proxies.LatencyModel(
+            0.1, 0.05, distribution='fixed').sample(), 0.1)
+        for distribution in ('uniform', 'gauss', 'lognormal'):
+            model = ccs_python_proxies.LatencyModel(0.1, 0.05,
+                                                    distribution=distribution)
+            values = [model.sample() for _ in range(100)]
+            self.assertGreaterEqual(min(values), 0)
+            self.assertGreater(len(set(values)), 1)
+        self.assertRaises(RuntimeError, ccs_python_proxies.LatencyModel,
+                          distribution='poisson')
+
+    def test_errors_and_timeouts(self):
+        "Test injected errors and timeouts."
+        LatencyModel = ccs_python_proxies.LatencyModel
+        sub = ccs_python_proxies.SimulatedSubsystem(
+            responses=dict(getWave=500.),
+            latencies=dict(setWave=LatencyModel(1., distribution='fixed')),
+            error_rates=dict(openShutter=1.), timeout=0.05, seed=1)
+        self.assertEqual(sub.sendSynchCommand('getWave').getResult(), 500.)
+        self.assertRaises(ccs_python_proxies.SimulatedCommandError,
+                          sub.sendSynchCommand, 'openShutter')
+        t0 = time.time()
+        self.assertRaises(ccs_python_proxies.SimulatedTimeout,
+                          sub.sendSynchCommand, 'setWave', 500)
+        self.assertLess(time.time() - t0, 0.5)
+        self.assertEqual(sub.ncalls, 3)
+
+    def test_simulated_subsystems(self):
+        "Test concurrent commands to the simulated subsystems."
+        names = ccs_python_proxies.CCS.add_simulated_subsystems(seed=1)
+        try:
+            sub = CcsSubsystems(dict(ts8='ts8-sim', rebps='rebps-sim',
+                                     pd='pd-sim', mono='mono-sim'),
+                                version_file=None)
+            geo = sub.ts8.synchCommand('printGeometry', 3).getResult()
+            self.assertTrue(geo.startswith('--> R00'))
+            requests = [(sub.ts8, 'getChannelValue', 'R00.Reb0.CCDTemp%i' % i)
+                        for i in range(3)]
+            requests.append((sub.rebps, 'getChannelValue',
+                             'REB0.hvbias.VbefSwch'))
+            results = [x.getResult() for x in gather(requests, timeout=5)]
+            self.assertEqual(results, [-95., -95., -95., -50.])
+            self.assertGreater(sub.ts8.ccs_subsystem.max_in_flight, 1)
+        finally:
+            for name in names:
+                del ccs_python_proxies.CCS.proxies[name]
+
 if __name__ == '__main__':
     unittest.main()
@@ -5,8 +5,10 @@ import os
 import logging
 import unittest
 from collections import namedtuple, defaultdict
+import ccs_python_proxies
+import ts8_utils
 from ccs_scripting_tools import CcsSubsystems
-from ts8_utils import set_ccd_info
+from ts8_utils import set_ccd_info, RebInventory, get_REB_info, write_REB_info
 
 SensorInfo = namedtuple('SensorInfo', 'sensor_id manufacturer_sn'.split())
 ccd_names = {slot: SensorInfo('ITL-{}'.format(i), i) for i, slot in
@@ -46,5 +48,82 @@ class Ts8UtilsTestCase(unittest.TestCase):
             elif command == 'getChannelValue':
                 self.assertEqual(ccs_commands[command], 18)
 
+    def test_set_ccd_info_raft_geometry(self):
+        """Test set_ccd_info for the printGeometry output of a raft."""
+        subsystems = dict(ts8='ts8-proxy', rebps='subsystem-proxy')
+        ccs_sub = CcsSubsystems(subsystems, version_file=None)
+        geometry = ccs_sub.ts8.synchCommand('printGeometry 3').getResult()
+        ccd_info = set_ccd_info(ccs_sub, ccd_names, None, geometry=geometry)
+        self.assertEqual(len(ccd_info), 9)
+        self.assertEqual(ccd_info['S21'].ccd_id, 'R00.Reb2.S21')
+        self.assertEqual(ccd_info['S21'].reb_name, 'R00.Reb2')
+        stats = ccs_sub.journal.latency_stats()
+        self.assertEqual(stats[('ts8-proxy', 'getChannelValue')][0], 9)
+        self.assertEqual(stats[('subsystem-proxy', 'getChannelValue')][0], 3)
+        self.assertEqual(stats[('ts8-proxy', 'ccdSpecificHeaderKeywords')][0],
+                         27)
+        self.assertEqual(stats[('ts8-proxy', 'setMeasuredCCDBSS')][0], 9)
+        self.assertTrue(all(x.hv_bias is not None for x in ccd_info.values()))
+
+    def test_set_ccd_info_failures(self):
+        """Test that failed or impossible reads are skipped."""
+        subsystems = dict(ts8='ts8-proxy')
+        ccs_sub = CcsSubsystems(subsystems, version_file=None)
+        ts8 = ccs_sub.ts8.ccs_subsystem
+        send = ts8.sendSynchCommand
+        def failing_send(*args):
+            if 'GREB.CCDTemp1' in args:
+                raise RuntimeError('channel not found')
+            return send(*args)
+        ts8.sendSynchCommand = failing_send
+        names = dict(ccd_names)
+        names['SGX'] = SensorInfo('ITL-X', 'X')
+        geometry = ts8_utils.CR_GEOMETRY + '---> WREB.SGX\n'
+        ccd_info = set_ccd_info(ccs_sub, names, None, geometry=geometry)
+        self.assertEqual(list(ccd_info.keys()), ['S10', 'S11', 'S00', 'SGX'])
+        self.assertEqual(ccd_info['S11'].temperature, None)
+        self.assertEqual(ccd_info['SGX'].temperature, None)
+        self.assertNotEqual(ccd_info['S10'].temperature, None)
+        stats = ccs_sub.journal.latency_stats()
+        self.assertEqual(stats[('ts8-proxy', 'getChannelValue')][0], 3)
+        self.assertEqual(stats[('ts8-proxy', 'ccdSpecificHeaderKeywords')][0],
+                         10)
+
+    def test_ccd_slot_map(self):
+        """Test the parsing of the printGeometry output."""
+        slots = ts8_utils.ccd_slot_map(ts8_utils.CR_GEOMETRY)
+        self.assertEqual(list(slots.keys()), ['S10', 'S11', 'S00'])
+        self.assertEqual(slots['S11'], ('GREB.S11', 'GREB', 1, 'S11', None))
+        self.assertEqual(ts8_utils.ccd_slot_map(ts8_utils.CR_GEOMETRY),
+                         slots)
+
+class RebInventoryTestCase(unittest.TestCase):
+    "TestCase class for the RebInventory class."
+    def setUp(self):
+        self.outfile = 'test_reb_info.txt'
+
+    def tearDown(self):
+        if os.path.isfile(self.outfile):
+            os.remove(self.outfile)
+
+    def test_reb_inventory(self):
+        "Test the REB lookups and output file."
+        ts8 = ccs_python_proxies.CCS.attachSubsystem('ts8-proxy')
+        inventory = RebInventory(ts8)
+        self.assertEqual(len(inventory), 3)
+        self.assertEqual(inventory[1],
+                         ('R00.Reb1', 808599560, '%x' % 412223738))
+        self.assertEqual(inventory.by_name('R00.Reb2'), inventory[2])
+        self.assertEqual(get_REB_info(ts8, 0), inventory[0])
+        self.assertEqual(get_REB_info(None, 0, reb_inventory=inventory),
+                         inventory[0])
+
+        write_REB_info(ts8, outfile=self.outfile)
+        with open(self.outfile) as fd:
+            lines = fd.readlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0].split(),
+                         ['R00.Reb0', '%x' % 808599560, '%x' % 412165857])
+
 if __name__ == '__main__':
     unittest.main()